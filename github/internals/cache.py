@@ -0,0 +1,135 @@
+"""Caches of data the runner would otherwise download every cycle"""
+import copy
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Text, Tuple
+
+logger = logging.getLogger(__name__)
+
+TASKS_CACHE_SIZE = 256
+
+
+class LRUCache(object):
+    """Bounded mapping which drops the least recently used items"""
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.items
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+
+        self.items[key] = value
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+class TasksDataCache(object):
+    """Parsed tasks definitions of the pull requests
+
+    The definitions only change with the PR's head commit, so they're
+    looked up by (commit sha, tasks path). Many PRs share the same tasks
+    file, so the parsed definitions are stored by the hash of the file
+    content and parsed only once.
+
+    Callers get a deep copy, because the tasks modify their definitions.
+    """
+    def __init__(
+        self, maxsize: int=TASKS_CACHE_SIZE, path: Text=None
+    ) -> None:
+        self.commits = LRUCache(maxsize)
+        self.contents = LRUCache(maxsize)
+        self.path = path
+        if self.path is not None:
+            self.load()
+
+    @staticmethod
+    def digest(*contents: bytes) -> Text:
+        sha = hashlib.sha256()
+        for content in contents:
+            sha.update(content)
+            sha.update(b"\0")
+        return sha.hexdigest()
+
+    def __contains__(self, key: Tuple[Text, Text]) -> bool:
+        digest = self.commits.get(key)
+        return digest is not None and digest in self.contents
+
+    def get(self, sha: Text, path: Text) -> Optional[Dict]:
+        """Gets the tasks definitions of the given commit"""
+        digest = self.commits.get((sha, path))
+        if digest is None:
+            return None
+
+        jobs = self.contents.get(digest)
+        if jobs is None:
+            return None
+
+        return copy.deepcopy(jobs)
+
+    def parse(
+        self, sha: Text, path: Text, parser: Callable[..., Dict],
+        *contents: bytes
+    ) -> Dict:
+        """Parses the tasks definitions unless the same content was seen
+
+        Raises:
+            whatever the parser raises, nothing is cached then
+        """
+        digest = self.digest(*contents)
+        jobs = self.contents.get(digest)
+        if jobs is None:
+            jobs = parser(*contents)
+            self.contents.put(digest, jobs)
+
+        self.commits.put((sha, path), digest)
+        if self.path is not None:
+            self.save()
+
+        return copy.deepcopy(jobs)
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        except (IOError, ValueError) as e:
+            logger.debug("Not loading tasks cache: %s", e)
+            return
+
+        for digest, jobs in data.get("contents", []):
+            self.contents.put(digest, jobs)
+        for sha, path, digest in data.get("commits", []):
+            self.commits.put((sha, path), digest)
+
+    def save(self) -> None:
+        data = {
+            "contents": list(self.contents.items.items()),
+            "commits": [
+                [sha, path, digest]
+                for (sha, path), digest in self.commits.items.items()
+            ],
+        }
+        tmp_path = "{}.tmp".format(self.path)
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w") as cache_file:
+                json.dump(data, cache_file)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            logger.warning("Failed to save tasks cache: %s", e)
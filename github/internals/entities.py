@@ -1,11 +1,16 @@
 import operator
+import os
+import re
 import sys
+import threading
 from collections.abc import Callable as AbcCallable
 from datetime import datetime, timedelta
 from enum import Enum, unique
-from random import randint
-from time import sleep
-from typing import Callable, ByteString, Dict, List, Text, Tuple, SupportsFloat
+from time import sleep, time
+from typing import (
+    Any, Callable, ByteString, Dict, Hashable, List, Mapping, Optional, Text,
+    Tuple, SupportsFloat
+)
 
 import psutil
 import pytz
@@ -13,13 +18,18 @@ import yaml
 from dateutil import parser
 from github3 import GitHub
 from github3.exceptions import ServerError
+from github3.issues.issue import Issue
+from github3.repos.repo import Repository
 from requests.sessions import Session
 
 import parse
 import raven
+from .cache import LRUCache, TasksDataCache
+from .monitor import ResourceMonitor, available_disk
 from .gql import util, queries
 
 from tasks import tasks
+from tasks.constants import JOBS_DIR, LIBVIRT_POOL_DIR
 from tasks.common import TaskException
 
 API_CHECK_TRIES = 5
@@ -36,7 +46,20 @@ SENTRY_URL = (
 # When runner reaches this remaining API limit value, it will sleep
 # until the reset time will come.
 EPHEMERAL_LIMIT = 60
+# Rate limit known from API responses is trusted for this many seconds
+RATE_LIMIT_MAX_AGE = 300
+# Statuses fetched this many seconds ago are good enough for the checks
+# which don't lock anything (unassigning, re-running)
+STATUS_SNAPSHOT_MAX_AGE = 60
+STATUS_POLL_BATCH = 50
 STALE_TASK_EXTRA_TIME = 60
+# Cached repository and issue handles are refreshed after this many seconds
+HANDLE_MAX_AGE = 3600
+ISSUE_HANDLES_SIZE = 256
+# Disk space (MB) a VM's image takes in the libvirt pool by the job's end
+VM_DISK = 4096
+# Disk space (MB) of a job's directory: logs, built RPMs
+JOB_DISK = 1024
 
 
 def sentry_report_exception(context: Dict):
@@ -119,13 +142,17 @@ class RateLimit(object):
     def available(self) -> bool:
         return self.remaining >= EPHEMERAL_LIMIT
 
+    @property
+    def expired(self) -> bool:
+        return self.reset_at <= time()
+
     def wait(self) -> None:
         if not self.available:
             reset_time = datetime.fromtimestamp(self.reset_at)
             now_time = datetime.now()
             sleep_time = reset_time - now_time
 
-            sleep(sleep_time.total_seconds())
+            sleep(max(0, sleep_time.total_seconds()))
 
     @staticmethod
     def from_dict(data_dict: Dict) -> "RateLimit":
@@ -136,55 +163,435 @@ class RateLimit(object):
             reset_at=data_dict["reset"]
         )
 
+    @staticmethod
+    def from_headers(headers: Mapping) -> "RateLimit":
+        """Fabric of RateLimit from X-RateLimit-* response headers"""
+        return RateLimit(
+            limit=int(headers["X-RateLimit-Limit"]),
+            remaining=int(headers["X-RateLimit-Remaining"]),
+            reset_at=int(headers["X-RateLimit-Reset"])
+        )
+
+    @staticmethod
+    def from_graphql_dict(data_dict: Dict) -> "RateLimit":
+        """Fabric of RateLimit from the GraphQL rateLimit object"""
+        return RateLimit(
+            limit=data_dict["limit"],
+            remaining=data_dict["remaining"],
+            reset_at=int(parser.parse(data_dict["resetAt"]).timestamp())
+        )
+
+
+class RateLimitTracker(object):
+    """Keeps track of the rate limits seen in the API responses
+
+    Every REST response carries X-RateLimit-* headers and every GraphQL
+    query asks for the rateLimit object, so the limits are known without
+    asking the API. A limit is only considered stale once it's reset or
+    it wasn't updated for RATE_LIMIT_MAX_AGE seconds.
+    """
+    def __init__(self, max_age: int=RATE_LIMIT_MAX_AGE) -> None:
+        self.max_age = max_age
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def get(self, resource: Text) -> Optional[RateLimit]:
+        """Returns the rate limit if it's fresh enough"""
+        with self.lock:
+            rate_limit, updated_at = self.limits.get(resource, (None, 0))
+
+        if rate_limit is None or rate_limit.expired:
+            return None
+        if time() - updated_at > self.max_age:
+            return None
+
+        return rate_limit
+
+    def update(self, resource: Text, rate_limit: RateLimit) -> None:
+        with self.lock:
+            self.limits[resource] = (rate_limit, time())
+
+    def update_from_headers(
+        self, headers: Mapping, default_resource: Text="core"
+    ) -> None:
+        try:
+            rate_limit = RateLimit.from_headers(headers)
+        except (KeyError, ValueError):
+            return
+
+        resource = headers.get("X-RateLimit-Resource", default_resource)
+        self.update(resource, rate_limit)
+
+    def update_from_graphql(self, response: Dict) -> None:
+        data = response.get("data") or {}
+        try:
+            rate_limit = RateLimit.from_graphql_dict(data["rateLimit"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        self.update("graphql", rate_limit)
+
+    def response_hook(self, default_resource: Text) -> Callable:
+        """Creates a requests response hook feeding the tracker"""
+        def hook(response, *args, **kwargs):
+            self.update_from_headers(response.headers, default_resource)
+            return response
+
+        return hook
+
+
+class StatusSnapshot(object):
+    """Last known commit statuses of the PRs' head commits
+
+    Statuses are stored per PR along with the time they were fetched, so
+    checks which don't need up to the second data can skip the API.
+    """
+    def __init__(self) -> None:
+        self.pull_requests = {}
+
+    def get(
+        self, pr_number: int, max_age: float
+    ) -> Optional[Dict[Text, "Status"]]:
+        """Returns PR's statuses if they're at most max_age seconds old"""
+        statuses, updated_at = self.pull_requests.get(pr_number, (None, 0))
+        if statuses is None or time() - updated_at > max_age:
+            return None
+
+        return statuses
+
+    def update(self, pr_number: int, statuses: Dict[Text, "Status"]) -> None:
+        self.pull_requests[pr_number] = (dict(statuses), time())
+
+    def set(self, pr_number: int, status: "Status") -> None:
+        """Records a status written by this runner"""
+        statuses, updated_at = self.pull_requests.get(pr_number, ({}, 0))
+        statuses[status.context] = status
+        self.pull_requests[pr_number] = (statuses, updated_at)
+
+
+def load_jobs(task_link: ByteString, tasks_file_content: ByteString) -> Dict:
+    """Parses the jobs out of the tasks file
+
+    Raises:
+        (yaml.error.YAMLError, TypeError, KeyError)
+    """
+    try:
+        return yaml.safe_load(tasks_file_content)["jobs"]
+    # FIXME: for older PRs to pass. Can be later deleted
+    except KeyError:
+        return yaml.safe_load(task_link)["jobs"]
+
+
+class HandleCache(object):
+    """Keeps github3 objects, so writes don't need to GET them first
+
+    Handles older than max_age are refreshed by a conditional request,
+    which doesn't count against the rate limit when nothing changed.
+    """
+    def __init__(self, maxsize: int, max_age: float=HANDLE_MAX_AGE) -> None:
+        self.handles = LRUCache(maxsize)
+        self.max_age = max_age
+
+    def get(self, key: Hashable, factory: Callable) -> Any:
+        """Returns the cached handle, the factory creates a missing one"""
+        now = time()
+        entry = self.handles.get(key)
+        if entry is None:
+            handle = factory()
+        else:
+            handle, fetched_at = entry
+            if now - fetched_at < self.max_age:
+                return handle
+            handle = handle.refresh(conditional=True)
+
+        self.handles.put(key, (handle, now))
+        return handle
+
+
+class LockBackend(object):
+    """Decides which runner processes a task
+
+    Backends raise EnvironmentError from acquire() when the task is taken
+    by someone else. Once the lock is won, the "Taken by" commit status is
+    written, so the others can see who's processing the task.
+    """
+    def acquire(self, world: "World", task: "Task") -> Text:
+        """Locks the task
+
+        Returns:
+            Text: description of the status written on GitHub
+
+        Raises:
+            EnvironmentError
+        """
+        raise NotImplementedError
+
+    # Seconds between renewals of the running tasks' locks, None for locks
+    # which don't expire
+    renew_interval = None
+
+    def release(self, world: "World", task: "Task") -> None:
+        """Unlocks the task, it's already finished on GitHub by then"""
+        pass
+
+    def renew(self, world: "World", task: "Task") -> None:
+        """Keeps the lock of the running task from expiring
+
+        Raises:
+            EnvironmentError
+        """
+        pass
+
+    @staticmethod
+    def check(world: "World", task: "Task") -> None:
+        """Checks that the task's commit status allows locking it
+
+        Raises:
+            EnvironmentError
+        """
+        status = world.poll_status(task.pr_number, task.name)
+
+        if status.failed or status.succeeded:
+            raise EnvironmentError(
+                "Task '{}' PR#{} was already processed.".format(
+                    task.name, task.pr_number
+                )
+            )
+
+        if status.pending and status.taken:
+            raise EnvironmentError(
+                "Task '{}' PR#{} is already locked.".format(
+                    task.name, task.pr_number
+                )
+            )
+
+    @staticmethod
+    def notify(world: "World", task: "Task") -> Text:
+        """Creates the "Taken by" commit status on GitHub"""
+        time_now = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
+        description = TASK_TAKEN_FMT.format(
+            runner_id=world.runner_id,
+            date=time_now
+        )
+        world.create_status(task, State.PENDING, description)
+        return description
+
+
+class GitHubStatusLock(LockBackend):
+    """Locks tasks through their commit statuses on GitHub
+
+    Every runner writes its own "Taken by" status and reads it back after
+    RACE_TIMEOUT. The one whose status survived won the race.
+    """
+    def acquire(self, world: "World", task: "Task") -> Text:
+        self.check(world, task)
+        description = self.notify(world, task)
+
+        sleep(RACE_TIMEOUT)
+
+        status = world.poll_status(task.pr_number, task.name)
+
+        if status.description != description:
+            raise EnvironmentError(
+                "Task '{}' PR#{} changed. Unable to lock.".format(
+                    task.name, task.pr_number
+                )
+            )
+
+        return description
+
 
 class World(object):
     """Represents the outside world state"""
     def __init__(
         self, graphql_request: Callable, github_api: GitHub,
         session: Session, repo_owner: Text, repo_name: Text,
-        runner_id: Text, tasks_path: Text, whitelist: List[Text]
+        runner_id: Text, tasks_path: Text, whitelist: List[Text],
+        tasks_cache: TasksDataCache=None, lock_backend: LockBackend=None,
+        resource_monitor: ResourceMonitor=None
     ) -> None:
-        self.available_resources = AvailableResources()
-        self.graphql_request = graphql_request
+        self.available_resources = AvailableResources(resource_monitor)
+        self.rate_limits = RateLimitTracker()
+        self.status_snapshot = StatusSnapshot()
+        self.graphql_request = self.__tracked(graphql_request)
         self.github_api = github_api
         self.session = session
+        if github_api is not None:
+            github_api.session.hooks["response"].append(
+                self.rate_limits.response_hook("core")
+            )
+        if session is not None:
+            session.hooks["response"].append(
+                self.rate_limits.response_hook("graphql")
+            )
         self.repo_owner = repo_owner
         self.repo_name = repo_name
         self.runner_id = runner_id
         self.tasks_path = tasks_path
         self.whitelist = whitelist
+        self.tasks_cache = (
+            tasks_cache if tasks_cache is not None else TasksDataCache()
+        )
+        self.lock_backend = (
+            lock_backend if lock_backend is not None else GitHubStatusLock()
+        )
+        self.repository_handle = HandleCache(1)
+        self.issue_handles = HandleCache(ISSUE_HANDLES_SIZE)
         self.instance = self
 
+    def __tracked(self, graphql_request: Callable) -> Callable:
+        def request(*args, **kwargs) -> Dict:
+            response = graphql_request(*args, **kwargs)
+            self.rate_limits.update_from_graphql(response)
+            return response
+
+        return request
+
     def get_rate_limit(self, resource: Text=None) -> RateLimit:
-        """Calls GitHub API and returns RateLimit instance"""
+        """Returns RateLimit instance, calls GitHub API if it's stale"""
         if resource not in RateLimit.valid_resources:
-            ValueError("Supported resources are graphql and core")
+            raise ValueError("Supported resources are graphql and core")
 
-        return RateLimit.from_dict(
+        rate_limit = self.rate_limits.get(resource)
+        if rate_limit is not None:
+            return rate_limit
+
+        rate_limit = RateLimit.from_dict(
             self.github_api.rate_limit()["resources"][resource]
         )
+        self.rate_limits.update(resource, rate_limit)
+        return rate_limit
+
+    def prefetch_tasks_files(
+        self, pull_requests: List["PullRequest"]
+    ) -> None:
+        """Gets the tasks files the PRs' links point to using GraphQL API
+
+        The links come with the pull requests query already, so all the
+        files the links point to are fetched by a single aliased query.
+        PRs which are in the cache or have no link are left alone and
+        get_tasks_data falls back to fetching them over HTTP.
+        """
+        expressions = {}
+        for pr in pull_requests:
+            if pr.tasks_link is None:
+                continue
+            if (pr.commit.sha, self.tasks_path) in self.tasks_cache:
+                continue
+            if "\n" in pr.tasks_link.strip():
+                # FIXME: older PRs have the tasks in the file itself
+                pr.tasks_file_content = pr.tasks_link.encode()
+                continue
+
+            expressions["pr{}".format(pr.number)] = "{}:{}".format(
+                pr.commit.sha, pr.tasks_link.strip()
+            )
+
+        if not expressions:
+            return
+
+        self.check_graphql_limit()
+        response = self.graphql_request(
+            query=queries.make_blobs_query(
+                self.repo_owner, self.repo_name, expressions
+            )
+        )
+        repository = util.get_repository(util.get_data(response))
+        for pr in pull_requests:
+            text = util.get_blob_text(repository, "pr{}".format(pr.number))
+            if text is not None:
+                pr.tasks_file_content = text.encode()
+
+    def update_status_snapshot(
+        self, pull_requests: List["PullRequest"]
+    ) -> None:
+        """Seeds the status snapshot with freshly fetched pull requests"""
+        for pr in pull_requests:
+            self.status_snapshot.update(pr.number, pr.commit.statuses)
+
+    def poll_statuses(
+        self, pairs: List[Tuple[int, Text]], max_age: float=0
+    ) -> Dict[Tuple[int, Text], "Status"]:
+        """Gets many commit statuses on GitHub using one GraphQL query
+
+        Statuses of PRs seen in the snapshot within max_age seconds are
+        not fetched again. Pairs without a status are left out of the
+        result.
+        """
+        statuses = {}
+        stale = set()
+        for pr_number, _name in pairs:
+            pr_statuses = self.status_snapshot.get(pr_number, max_age)
+            if pr_statuses is None:
+                stale.add(pr_number)
+            else:
+                statuses[pr_number] = pr_statuses
+
+        if stale:
+            statuses.update(self.__fetch_statuses(sorted(stale)))
+
+        return {
+            (pr_number, name): statuses[pr_number][name]
+            for pr_number, name in pairs
+            if name in statuses.get(pr_number, {})
+        }
+
+    def __fetch_statuses(
+        self, pr_numbers: List[int]
+    ) -> Dict[int, Dict[Text, "Status"]]:
+        statuses = {}
+        for start in range(0, len(pr_numbers), STATUS_POLL_BATCH):
+            batch = pr_numbers[start:start + STATUS_POLL_BATCH]
+            self.check_graphql_limit()
+            response = self.graphql_request(
+                query=queries.make_pull_requests_statuses_query(
+                    self.repo_owner, self.repo_name, batch
+                )
+            )
+            repository = util.get_repository(util.get_data(response))
+            for pr_number in batch:
+                pull_request = util.get_aliased_pull_request(
+                    repository, pr_number
+                )
+                if pull_request is None:
+                    continue
+                commit = util.get_last_commit(pull_request)
+                statuses[pr_number] = {
+                    name: Status.from_dict(status_data)
+                    for name, status_data in util.get_statuses(commit).items()
+                }
+                self.status_snapshot.update(pr_number, statuses[pr_number])
+
+        return statuses
 
     def poll_status(
-        self, pr_number: int, task_name: Text
+        self, pr_number: int, task_name: Text, max_age: float=0
     ) -> "Status":
         """Gets commit status on GitHub using GraphQL API"""
-        sleep(randint(3, 8))  # FIXME: We're polling too concurrently
-        pr_query = queries.make_pull_request_query(
-            self.repo_owner, self.repo_name, pr_number
-        )
-        self.check_graphql_limit()
-        response = self.graphql_request(query=pr_query)
-
-        data = util.get_data(response)
-        repository = util.get_repository(data)
-        pull_request = util.get_pull_request(repository)
-        commit = util.get_last_commit(pull_request)
-        statuses = util.get_statuses(commit)
-        status = util.get_status(statuses, task_name)
-        if not status:
+        status = self.poll_statuses(
+            [(pr_number, task_name)], max_age
+        ).get((pr_number, task_name))
+        if status is None:
             raise EnvironmentError("Can't parse status data.")
 
-        return Status.from_dict(status)
+        return status
+
+    def repository(self) -> Repository:
+        """Returns the long-lived handle of the monitored repository"""
+        return self.repository_handle.get(
+            (self.repo_owner, self.repo_name),
+            lambda: self.github_api.repository(self.repo_owner, self.repo_name)
+        )
+
+    def issue(self, pr_number: int) -> Issue:
+        """Returns the long-lived handle of the PR's issue
+
+        The issue is taken from the repository directly, the pull request
+        itself isn't needed for labels.
+        """
+        return self.issue_handles.get(
+            pr_number, lambda: self.repository().issue(pr_number)
+        )
 
     def create_status(
         self, task: "Task", state: State,
@@ -199,12 +606,13 @@ class World(object):
             raise ValueError("Can't create status. Wrong state.")
 
         self.check_rest_limit()
-        self.github_api.repository(
-            self.repo_owner, self.repo_name
-        ).create_status(
+        self.repository().create_status(
             task.commit_sha, state.value.lower(),
             target_url, description, task.name
         )
+        self.status_snapshot.set(
+            task.pr_number, Status(task.name, description, state, target_url)
+        )
 
     def create_error_status(
         self, commit_sha: Text, name: Text, description: Text
@@ -215,9 +623,7 @@ class World(object):
             github3.exceptions.GitHubError, ValueError
         """
         self.check_rest_limit()
-        self.github_api.repository(
-            self.repo_owner, self.repo_name
-        ).create_status(
+        self.repository().create_status(
             commit_sha, "error",
             "", description, name
         )
@@ -247,8 +653,14 @@ class World(object):
 
 
 class Topology(object):
+    """Resources the VMs of a job need
+
+    Disk (MB in the libvirt pool) and I/O (in units of one VM's image I/O)
+    default to the topology's number of VMs, which is derived from its name.
+    """
     def __init__(
-        self, name: Text=None, memory: SupportsFloat=None, cpu: int=None
+        self, name: Text=None, memory: SupportsFloat=None, cpu: int=None,
+        disk: SupportsFloat=None, io: SupportsFloat=None
     ) -> None:
         if memory is None:
             memory = AvailableResources.initial_memory
@@ -256,48 +668,160 @@ class Topology(object):
         self.memory = float(memory)
         self.name = name if name is not None else "undefined"
         self.cpu = cpu if cpu is not None else AvailableResources.initial_cpu
+        vms = self.vm_count(self.name)
+        self.disk = float(disk) if disk is not None else vms * VM_DISK
+        self.io = float(io) if io is not None else vms
 
     def __eq__(self, other) -> bool:
         return all((
             self.name == other.name,
             self.memory == other.memory,
-            self.cpu == other.cpu
+            self.cpu == other.cpu,
+            self.disk == other.disk,
+            self.io == other.io
         ))
 
+    @staticmethod
+    def vm_count(name: Text) -> int:
+        """Number of VMs of the topology by its name
+
+        "master_2repl_1client" has a controller, a master, two replicas and
+        a client, topologies without replicas or clients have a single VM.
+        """
+        hosts = re.findall(r"(\d+)(?:repl|client)", name)
+        if not hosts:
+            return 1
+        return 2 + sum(int(count) for count in hosts)
+
     @staticmethod
     def from_dict(dict_data: Dict) -> "Topology":
         """Factory for Topology"""
         if not isinstance(dict_data, dict):
             raise JobYAMLError
-        return Topology(
-            name=dict_data.get("name"),
-            memory=dict_data.get("memory"),
-            cpu=dict_data.get("cpu")
-        )
+        try:
+            return Topology(
+                name=dict_data.get("name"),
+                memory=dict_data.get("memory"),
+                cpu=dict_data.get("cpu"),
+                disk=dict_data.get("disk"),
+                io=dict_data.get("io")
+            )
+        except (TypeError, ValueError):
+            raise JobYAMLError
 
 
 class AvailableResources(object):
+    """Ledger of the resources the runner's jobs can take
+
+    Without a monitor, the ledger starts with the CPU count and the memory
+    available when the runner started. With a monitor, it starts with the
+    host's capacity and free() reconciles it with the sampled host state.
+
+    Disk space is checked in jobs_dir (logs, builds) and pool_dir (VM
+    images). The filesystems are sampled every time and the space reserved
+    by the running jobs is subtracted as a whole, because the jobs' images
+    keep growing until they finish. When both directories share a
+    filesystem, their needs add up.
+    """
     initial_cpu = psutil.cpu_count()
     initial_memory = psutil.virtual_memory().available / float(1024 ** 2)
-
-    def __init__(self) -> None:
-        self.cpu = AvailableResources.initial_cpu
-        self.memory = AvailableResources.initial_memory
+    # I/O capacity, the same as the CPU count when not set
+    initial_io = None
+    jobs_dir = JOBS_DIR
+    pool_dir = LIBVIRT_POOL_DIR
+
+    def __init__(self, monitor: ResourceMonitor=None) -> None:
+        self.monitor = monitor
+        if monitor is None:
+            self.total_cpu = AvailableResources.initial_cpu
+            self.total_memory = AvailableResources.initial_memory
+            io_capacity = AvailableResources.initial_io
+        else:
+            self.total_cpu, self.total_memory = monitor.capacity()
+            io_capacity = monitor.io_capacity
+        self.total_io = (
+            io_capacity if io_capacity is not None else self.total_cpu
+        )
+        self.cpu = self.total_cpu
+        self.memory = self.total_memory
+        self.io = self.total_io
+        # Disk (MB) reserved by the running jobs per filesystem
+        self.disk = {}
 
     def __str__(self) -> Text:
-        return "{cpu} CPU, {memory}MB".format(
-            cpu=self.cpu, memory=self.memory
+        return "{cpu} CPU, {memory}MB, {io} I/O".format(
+            cpu=self.cpu, memory=self.memory, io=self.io
+        )
+
+    def free(self) -> Tuple[float, float]:
+        """Returns CPU and memory which are free right now"""
+        if self.monitor is None:
+            return self.cpu, self.memory
+
+        return self.monitor.free(
+            (self.total_cpu, self.total_memory), (self.cpu, self.memory)
+        )
+
+    def filesystems(self) -> Dict[int, Text]:
+        """Directories to check disk space in by their filesystem"""
+        filesystems = {}
+        for path in (self.jobs_dir, self.pool_dir):
+            if path is None:
+                continue
+            try:
+                filesystems.setdefault(os.stat(path).st_dev, path)
+            except OSError:
+                # Not created yet, nothing to check there
+                continue
+        return filesystems
+
+    def disk_demand(self, topology: Topology) -> Dict[int, float]:
+        """Disk space (MB) the job needs per filesystem"""
+        demand = {}
+        for path, size in (
+            (self.jobs_dir, JOB_DISK), (self.pool_dir, topology.disk)
+        ):
+            if path is None:
+                continue
+            try:
+                device = os.stat(path).st_dev
+            except OSError:
+                continue
+            demand[device] = demand.get(device, 0) + size
+        return demand
+
+    def headroom(self) -> Tuple[float, ...]:
+        """Free CPU, memory, I/O and disk space of every filesystem
+
+        The disk space follows the order of demand()'s.
+        """
+        free_disk = [
+            available_disk(path) - self.disk.get(device, 0)
+            for device, path in sorted(self.filesystems().items())
+        ]
+        return self.free() + (self.io,) + tuple(free_disk)
+
+    def demand(self, topology: Topology) -> Tuple[float, ...]:
+        """What the job takes, in the order of headroom()"""
+        disk = self.disk_demand(topology)
+        return (topology.cpu, topology.memory, topology.io) + tuple(
+            disk.get(device, 0) for device in sorted(self.filesystems())
         )
 
     def check(self, task: "Task") -> bool:
-        return all([
-            self.cpu >= task.topology.cpu,
-            self.memory >= task.topology.memory
-        ])
+        return all(
+            needed <= free for needed, free in zip(
+                self.demand(task.topology), self.headroom()
+            )
+        )
 
     def __operate(self, task: "Task", op: Callable) -> None:
         self.cpu = op(self.cpu, task.topology.cpu)
         self.memory = op(self.memory, task.topology.memory)
+        self.io = op(self.io, task.topology.io)
+        for device, size in self.disk_demand(task.topology).items():
+            # Reservations grow when the free resources shrink
+            self.disk[device] = op(self.disk.get(device, 0), -size)
 
     def take(self, task: "Task") -> None:
         self.__operate(task, operator.sub)
@@ -389,8 +913,14 @@ class Status(Stateful):
 
 class Commit(object):
     """Represents the commit with GitHub's statuses"""
-    def __init__(self, sha: Text, statuses_data: Dict) -> None:
+    def __init__(
+        self, sha: Text, statuses_data: Dict, node_id: Text=None
+    ) -> None:
         self.sha = sha
+        self.node_id = node_id
+        self.update_statuses(statuses_data)
+
+    def update_statuses(self, statuses_data: Dict) -> None:
         self.statuses = {
             k: Status.from_dict(v) for k, v in statuses_data.items()
         }
@@ -405,7 +935,8 @@ class Commit(object):
         """Fabric for Commit"""
         return Commit(
             sha=util.get_commit_sha(data_dict),
-            statuses_data=util.get_statuses(data_dict)
+            statuses_data=util.get_statuses(data_dict),
+            node_id=util.get_commit_id(data_dict)
         )
 
 
@@ -422,6 +953,8 @@ class PullRequest(object):
         self.commit = Commit.from_dict(commit_data)
         self.mergeable = mergeable != "CONFLICTING"
         self.tasks_path = None
+        self.tasks_link = util.get_tasks_link(commit_data)
+        self.tasks_file_content = None
 
     def __eq__(self, other) -> bool:
         return all((
@@ -488,19 +1021,27 @@ class PullRequest(object):
         Returns:
             dict: Dictionary of a tasks defined in the tasks file.
         """
-        # the .freeipa-pr-ci is a link to a file, first we need to get it
-        # and then get the file it points
-        self.tasks_path = world.tasks_path
+        tasks_data = world.tasks_cache.get(self.commit.sha, world.tasks_path)
+        if tasks_data is not None:
+            return tasks_data
+
+        if self.tasks_file_content is not None:
+            # Prefetched by World.prefetch_tasks_files
+            task_link = self.tasks_link.encode()
+            tasks_file_content = self.tasks_file_content
+        else:
+            # the .freeipa-pr-ci is a link to a file, first we need to get
+            # it and then get the file it points
+            self.tasks_path = world.tasks_path
 
-        task_link = self.__get_tasks_file_content(world)
-        self.tasks_path = task_link.decode()
-        tasks_file_content = self.__get_tasks_file_content(world)
+            task_link = self.__get_tasks_file_content(world)
+            self.tasks_path = task_link.decode()
+            tasks_file_content = self.__get_tasks_file_content(world)
 
-        try:
-            return yaml.load(tasks_file_content)["jobs"]
-        # FIXME: for older PRs to pass. Can be later deleted
-        except KeyError:
-            return yaml.load(task_link)["jobs"]
+        return world.tasks_cache.parse(
+            self.commit.sha, world.tasks_path, load_jobs,
+            task_link, tasks_file_content
+        )
 
     def __remove_label(self, world: World, label: Label) -> None:
         """Removes PR's label on GitHub using REST API
@@ -508,19 +1049,13 @@ class PullRequest(object):
         Raises:
             github3.exceptions.NotFoundError
         """
-        world.check_graphql_limit()
-
-        world.github_api.pull_request(
-            world.repo_owner, world.repo_name, self.number
-        ).issue().remove_label(label.value)
+        world.check_rest_limit()
+        world.issue(self.number).remove_label(label.value)
 
     def __add_label(self, world: World, label: Label) -> None:
         """Adds PR's label on GitHub using REST API"""
-        world.check_graphql_limit()
-
-        world.github_api.pull_request(
-            world.repo_owner, world.repo_name, self.number
-        ).issue().add_labels(label.value)
+        world.check_rest_limit()
+        world.issue(self.number).add_labels(label.value)
 
     def remove_rerun_label(self, world: World) -> None:
         self.__remove_label(world, Label.RERUN)
@@ -595,6 +1130,10 @@ class Task(object):
         )
 
         self.dependencies = task_data["requires"]
+        try:
+            self.priority = int(task_data.get("priority", 0))
+        except (TypeError, ValueError):
+            raise JobYAMLError
         job_arguments_data = job_data["args"]
         self.timeout = job_arguments_data.get("timeout")
         topology_data = job_arguments_data.get("topology")
@@ -631,46 +1170,18 @@ class Task(object):
         return all(inner())
 
     def lock(self, world: World) -> None:
-        """Creates a commit status on GitHub using REST API
-
-        Tries to lock a task through creation of a commit status on GitHub
-        so the task could be later processed.
-        """
-        status = world.poll_status(self.pr_number, self.name)
-
-        if status.failed or status.succeeded:
-            raise EnvironmentError(
-                "Task '{}' PR#{} was already processed.".format(
-                    self.name, self.pr_number
-                )
-            )
-
-        if status.pending and status.taken:
-            raise EnvironmentError(
-                "Task '{}' PR#{} is already locked.".format(
-                    self.name, self.pr_number
-                )
-            )
+        """Locks the task, so no other runner takes it
 
-        time_now = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
-        description = TASK_TAKEN_FMT.format(
-            runner_id=world.runner_id,
-            date=time_now
-        )
-        world.create_status(self, State.PENDING, description)
-
-        sleep(RACE_TIMEOUT)
+        The locking itself is done by the world's lock backend.
 
-        status = world.poll_status(self.pr_number, self.name)
-
-        if status.description != description:
-            raise EnvironmentError(
-                "Task '{}' PR#{} changed. Unable to lock.".format(
-                    self.name, self.pr_number
-                )
-            )
+        Raises:
+            EnvironmentError: when the task can't be locked
+        """
+        self.description = world.lock_backend.acquire(world, self)
 
-        self.description = description
+    def unlock(self, world: World) -> None:
+        """Releases the lock once the task's result was reported"""
+        world.lock_backend.release(world, self)
 
     def set_unassigned(self, world: World) -> None:
         """Creates a commit status on GitHub using REST API
@@ -678,7 +1189,9 @@ class Task(object):
         Sets the status description to unassigned.
         """
         try:
-            status = world.poll_status(self.pr_number, self.name)
+            status = world.poll_status(
+                self.pr_number, self.name, STATUS_SNAPSHOT_MAX_AGE
+            )
         except EnvironmentError:
             world.create_status(self, State.PENDING, "unassigned")
             return
@@ -696,7 +1209,9 @@ class Task(object):
 
         Sets the status description to RERUN_PENDING value.
         """
-        status = world.poll_status(self.pr_number, self.name)
+        status = world.poll_status(
+            self.pr_number, self.name, STATUS_SNAPSHOT_MAX_AGE
+        )
         if status.succeeded or (status.taken and not status.stalled):
             raise EnvironmentError(
                 "Task {} PR#{} is changed".format(
@@ -712,8 +1227,12 @@ class Task(object):
 
         world.create_status(self, State.PENDING, RERUN_PENDING)
 
-    def execute(self, world: World, statuses: Dict) -> None:
-        """Runs the related task class defined in tasks/tasks.py"""
+    def get_dependencies_results(self, statuses: Dict) -> Dict:
+        """Collects results of the dependent tasks from commit statuses
+
+        Raises:
+            RuntimeError
+        """
         dependencies_results = {}
         for dep in self.dependencies:
             status = statuses.get(dep)
@@ -727,8 +1246,20 @@ class Task(object):
                 status.state, status.description, status.target_url
             )
 
+        return dependencies_results
+
+    def execute(self, world: World, statuses: Dict) -> None:
+        """Runs the related task class defined in tasks/tasks.py"""
+        dependencies_results = self.get_dependencies_results(statuses)
         result = self.job(world.repo_owner, dependencies_results)
+        self.report(world, result)
+
+    def report(self, world: World, result: "JobResult") -> None:
+        """Reports the job result as a commit status on GitHub
 
+        Raises:
+            ReferenceError, EnvironmentError
+        """
         try:
             status = world.poll_status(self.pr_number, self.name)
         except EnvironmentError:
@@ -748,9 +1279,10 @@ class Task(object):
 
 
 class ExitHandler(object):
-    done = False
-    aborted = False
-    task = None
+    def __init__(self) -> None:
+        self.done = False
+        self.aborted = False
+        self.tasks = []
 
     def finish(self, signum, frame):
         if self.done:
@@ -769,10 +1301,10 @@ class ExitHandler(object):
         sys.exit()
 
     def register_task(self, task):
-        self.task = task
+        self.tasks.append(task)
 
-    def unregister_task(self):
-        self.task = None
+    def unregister_task(self, task):
+        self.tasks.remove(task)
 
 
 class JobResult(Stateful):
@@ -814,6 +1346,25 @@ class JobDispatcher(AbcCallable):
     def timeout(self) -> int:
         return self.kwargs.get('timeout') or 0
 
+    @property
+    def template(self) -> Optional[Tuple[Text, Text]]:
+        """Name and version of the job's vagrant box"""
+        template = self.kwargs.get("template")
+        if not isinstance(template, dict):
+            return None
+        try:
+            return template["name"], template["version"]
+        except KeyError:
+            return None
+
+    @property
+    def warm_pool(self) -> bool:
+        """Tells if the job can take over a warm pool slot"""
+        return all((
+            getattr(self.task_class, "warm_pool_supported", False),
+            self.kwargs.get("warm_pool", True)
+        ))
+
     def __call__(
         self, repo_owner: Text, dependencies_results: Dict=None
     ) -> JobResult:
@@ -840,7 +1391,12 @@ class JobDispatcher(AbcCallable):
         except TaskException as e:
             description = str(e)
             state = State.ERROR
-            sentry_report_exception({"module": "tasks"})
+            context = {"module": "tasks"}
+            # Failed processes keep the tail of their output
+            tail = getattr(e, "tail", None)
+            if tail:
+                context["extra"] = {"output_tail": tail}
+            sentry_report_exception(context)
         else:
             description = job.description
             if job.returncode == 0:
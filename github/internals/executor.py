@@ -0,0 +1,252 @@
+"""Executors which run locked tasks on behalf of the runner"""
+import logging
+import multiprocessing
+import threading
+from multiprocessing.connection import Connection, wait
+from time import sleep, time
+from typing import Dict, List, Text, Tuple
+
+from .entities import (
+    ExitHandler, JobResult, State, Task, World, sentry_report_exception
+)
+
+logger = logging.getLogger(__name__)
+
+ERROR_BACKOFF_TIME = 600
+JOB_CRASHED_DESCRIPTION = "Job process terminated unexpectedly"
+
+
+class LockRenewer(object):
+    """Renews the locks of the running tasks from a daemon thread
+
+    Locks which expire (see LeaseLock) are kept while their jobs run, even
+    when the runner process is blocked by an inline job.
+    """
+    def __init__(self, world: World, interval: float) -> None:
+        self.world = world
+        self.interval = interval
+        self.tasks = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, task: Task) -> None:
+        with self.lock:
+            self.tasks.append(task)
+
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="lock-renewer", daemon=True
+            )
+            self.thread.start()
+
+    def remove(self, task: Task) -> None:
+        """Stops renewing the task's lock before it's released"""
+        with self.lock:
+            self.tasks = [t for t in self.tasks if t is not task]
+
+    def renew(self) -> None:
+        with self.lock:
+            for task in self.tasks:
+                try:
+                    self.world.lock_backend.renew(self.world, task)
+                except EnvironmentError as e:
+                    logger.warning(
+                        "Failed to renew lock of %s PR#%s: %s",
+                        task.name, task.pr_number, e
+                    )
+
+    def run(self) -> None:
+        while True:
+            sleep(self.interval)
+            self.renew()
+
+
+class Executor(object):
+    """Runs the tasks one by one in the runner process"""
+    def __init__(self, world: World, exit_handler: ExitHandler) -> None:
+        self.world = world
+        self.exit_handler = exit_handler
+        interval = world.lock_backend.renew_interval
+        self.renewer = LockRenewer(world, interval) if interval else None
+
+    @property
+    def full(self) -> bool:
+        """Tells if no more tasks can be submitted right now"""
+        return False
+
+    @property
+    def free_slots(self) -> int:
+        """Number of tasks which can be submitted right now"""
+        return 1
+
+    @property
+    def running_tasks(self) -> List[Tuple[Task, float]]:
+        """Tasks running in the background and their start times"""
+        return []
+
+    def _start(self, task: Task) -> None:
+        self.exit_handler.register_task(task)
+        self.world.available_resources.take(task)
+        if self.renewer is not None:
+            self.renewer.add(task)
+        logger.info(
+            "Available resources: %s", self.world.available_resources
+        )
+
+    def _finish(self, task: Task) -> None:
+        if self.renewer is not None:
+            self.renewer.remove(task)
+        task.unlock(self.world)
+        self.exit_handler.unregister_task(task)
+        self.world.available_resources.give(task)
+        logger.info(
+            "Available resources: %s", self.world.available_resources
+        )
+
+    def submit(self, task: Task, statuses: Dict) -> None:
+        """Executes the task and reports its result"""
+        self._start(task)
+        try:
+            task.execute(self.world, statuses)
+        except ReferenceError as e:
+            logger.warning(e)
+        except (EnvironmentError, RuntimeError) as e:
+            logger.error(e)
+            sentry_report_exception({"module": "github"})
+            sleep(ERROR_BACKOFF_TIME)
+        finally:
+            self._finish(task)
+
+    def wait(self, timeout: float=0) -> bool:
+        """Waits for finished tasks up to the given timeout
+
+        Returns:
+            bool: True if any task was finished while waiting.
+        """
+        sleep(timeout)
+        return False
+
+    def shutdown(self) -> None:
+        """Waits until all the submitted tasks are finished"""
+        pass
+
+
+def run_job(
+    connection: Connection, task: Task, repo_owner: Text,
+    dependencies_results: Dict
+) -> None:
+    """Runs the task's job in a worker process and sends back its result"""
+    try:
+        result = task.job(repo_owner, dependencies_results)
+    except Exception as e:
+        logger.exception(
+            "Job %s PR#%s crashed", task.name, task.pr_number
+        )
+        sentry_report_exception({"module": "tasks"})
+        result = JobResult(State.ERROR, str(e))
+
+    connection.send(result)
+    connection.close()
+
+
+class ProcessExecutor(Executor):
+    """Runs every task in its own worker process
+
+    The runner keeps dispatching tasks while there are free workers and
+    AvailableResources allows it. Finished tasks are collected by wait(),
+    which returns the resources and reports the results on GitHub, so
+    the runner is never blocked by a running job.
+    """
+    def __init__(
+        self, world: World, exit_handler: ExitHandler, workers: int
+    ) -> None:
+        super(ProcessExecutor, self).__init__(world, exit_handler)
+        self.workers = workers
+        self.running = {}
+        self.backoff_until = 0
+
+    @property
+    def full(self) -> bool:
+        return any((
+            len(self.running) >= self.workers,
+            time() < self.backoff_until
+        ))
+
+    @property
+    def free_slots(self) -> int:
+        if time() < self.backoff_until:
+            return 0
+        return max(self.workers - len(self.running), 0)
+
+    @property
+    def running_tasks(self) -> List[Tuple[Task, float]]:
+        return [
+            (task, started_at)
+            for _, task, started_at in self.running.values()
+        ]
+
+    def submit(self, task: Task, statuses: Dict) -> None:
+        """Starts the task's job in a new worker process"""
+        try:
+            dependencies_results = task.get_dependencies_results(statuses)
+        except RuntimeError as e:
+            logger.error(e)
+            sentry_report_exception({"module": "github"})
+            task.unlock(self.world)
+            return
+
+        self._start(task)
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=run_job,
+            args=(sender, task, self.world.repo_owner, dependencies_results),
+            name="{} PR#{}".format(task.name, task.pr_number)
+        )
+        process.start()
+        sender.close()
+        self.running[receiver] = (process, task, time())
+
+    def wait(self, timeout: float=0) -> bool:
+        if not self.running:
+            sleep(timeout)
+            return False
+
+        finished = wait(list(self.running), timeout)
+        for connection in finished:
+            self.__collect(connection)
+
+        return bool(finished)
+
+    def __collect(self, connection: Connection) -> None:
+        process, task, _ = self.running.pop(connection)
+        try:
+            result = connection.recv()
+        except EOFError:
+            result = JobResult(State.ERROR, JOB_CRASHED_DESCRIPTION)
+        finally:
+            connection.close()
+            process.join()
+
+        try:
+            task.report(self.world, result)
+        except ReferenceError as e:
+            logger.warning(e)
+        except (EnvironmentError, RuntimeError) as e:
+            logger.error(e)
+            sentry_report_exception({"module": "github"})
+            self.backoff_until = time() + ERROR_BACKOFF_TIME
+        finally:
+            self._finish(task)
+
+    def shutdown(self) -> None:
+        while self.running:
+            self.wait(None)
+
+
+def create_executor(
+    world: World, exit_handler: ExitHandler, workers: int=1
+) -> Executor:
+    """Factory for Executor"""
+    if workers > 1:
+        return ProcessExecutor(world, exit_handler, workers)
+    return Executor(world, exit_handler)
@@ -1,19 +1,18 @@
 """GitHub GraphQL queries module"""
-from typing import Dict, Text
+import json
+from typing import Dict, List, Text
 
-def make_pull_requests_query(owner: Text, repo: Text) -> Dict[Text, Text]:
-    return {"query": """{
-  repository(owner:"%s", name:"%s") {
-    url
-    pullRequests(last: 50, states: OPEN) {
-      nodes {
+# Number of pull requests in a single page of the paginated queries
+PAGE_SIZE = 50
+
+PULL_REQUEST_FIELDS = """
         number
         baseRefName
         mergeable
         author {
           login
         }
-        labels(last: 5) {
+        labels(first: 100) {
           nodes {
             name
           }
@@ -21,6 +20,7 @@ def make_pull_requests_query(owner: Text, repo: Text) -> Dict[Text, Text]:
         commits(last: 1) {
           nodes {
             commit {
+              id
               oid
               status {
                 contexts {
@@ -30,19 +30,150 @@ def make_pull_requests_query(owner: Text, repo: Text) -> Dict[Text, Text]:
                   targetUrl
                 }
               }
+              tasksLink: file(path: %s) {
+                object {
+                  ... on Blob {
+                    text
+                  }
+                }
+              }
             }
           }
-        }
-      }
-    }
-  }
+        }"""
+
+RATE_LIMIT_FIELDS = """
   rateLimit {
     limit
     cost
     remaining
     resetAt
-  }
-}""" % (owner, repo)}
+  }"""
+
+
+def make_pull_request_fields(tasks_path: Text) -> Text:
+    """Fields of a pull request node including its tasks file link"""
+    return PULL_REQUEST_FIELDS % json.dumps(tasks_path)
+
+
+def make_after(cursor: Text=None) -> Text:
+    """Pagination argument continuing after the given cursor"""
+    return ', after: "%s"' % cursor if cursor is not None else ""
+
+
+def make_pull_requests_query(
+    owner: Text, repo: Text, tasks_path: Text, cursor: Text=None,
+    labels: List[Text]=None
+) -> Dict[Text, Text]:
+    """A page of the open pull requests, optionally only the labeled ones"""
+    labels_filter = ", labels: %s" % json.dumps(labels) if labels else ""
+    return {"query": """{
+  repository(owner:"%s", name:"%s") {
+    url
+    pullRequests(first: %s, states: OPEN%s%s) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {%s
+      }
+    }
+  }%s
+}""" % (
+        owner, repo, PAGE_SIZE, labels_filter, make_after(cursor),
+        make_pull_request_fields(tasks_path), RATE_LIMIT_FIELDS
+    )}
+
+
+def make_updated_pull_requests_query(
+    owner: Text, repo: Text, tasks_path: Text, cursor: Text=None
+) -> Dict[Text, Text]:
+    """Pull requests of any state, the most recently updated first"""
+    return {"query": """{
+  repository(owner:"%s", name:"%s") {
+    url
+    pullRequests(
+      first: %s, orderBy: {field: UPDATED_AT, direction: DESC}%s
+    ) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        state
+        updatedAt%s
+      }
+    }
+  }%s
+}""" % (
+        owner, repo, PAGE_SIZE, make_after(cursor),
+        make_pull_request_fields(tasks_path), RATE_LIMIT_FIELDS
+    )}
+
+
+def make_commits_statuses_query(ids: List[Text]) -> Dict[Text, Text]:
+    """Statuses of the given commits looked up by their node IDs"""
+    return {"query": """{
+  nodes(ids: [%s]) {
+    ... on Commit {
+      id
+      oid
+      status {
+        contexts {
+          context
+          description
+          state
+          targetUrl
+        }
+      }
+    }
+  }%s
+}""" % (", ".join('"%s"' % i for i in ids), RATE_LIMIT_FIELDS)}
+
+
+def make_blobs_query(
+    owner: Text, repo: Text, expressions: Dict[Text, Text]
+) -> Dict[Text, Text]:
+    """Texts of the blobs given by aliased "<rev>:<path>" expressions"""
+    blobs = "".join("""
+    %s: object(expression: %s) {
+      ... on Blob {
+        text
+      }
+    }""" % (alias, json.dumps(expression))
+        for alias, expression in sorted(expressions.items())
+    )
+    return {"query": """{
+  repository(owner:"%s", name:"%s") {%s
+  }%s
+}""" % (owner, repo, blobs, RATE_LIMIT_FIELDS)}
+
+
+def make_pull_requests_statuses_query(
+    owner: Text, repo: Text, pr_numbers: List[int]
+) -> Dict[Text, Text]:
+    """Last commit statuses of the given PRs aliased as pr<number>"""
+    pull_requests = "".join("""
+    pr%s: pullRequest(number: %s) {
+      commits(last: 1) {
+        nodes {
+          commit {
+            oid
+            status {
+              contexts {
+                context
+                description
+                state
+                targetUrl
+              }
+            }
+          }
+        }
+      }
+    }""" % (number, number) for number in sorted(set(pr_numbers)))
+    return {"query": """{
+  repository(owner: "%s", name: "%s") {%s
+  }%s
+}""" % (owner, repo, pull_requests, RATE_LIMIT_FIELDS)}
 
 
 def make_pull_request_query(
@@ -1,11 +1,16 @@
 """GitHub GraphQL helpers module"""
 
 import json
-from typing import Dict, List, Text
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Optional, Text
+)
 
 from requests import Session
+from requests.adapters import HTTPAdapter
 
 GITHUB_ENDPOINT = 'https://api.github.com/graphql'
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 8
 
 
 def make_headers(token: Text) -> Dict[Text, Text]:
@@ -16,9 +21,17 @@ def make_headers(token: Text) -> Dict[Text, Text]:
     }
 
 
+def mount_pool(session: Session) -> Session:
+    """Makes the session keep its HTTPS connections to GitHub alive."""
+    session.mount("https://", HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+    ))
+    return session
+
+
 def create_session(headers: Dict[Text, Text]) -> Session:
     """Creates a session instance with given headers."""
-    session = Session()
+    session = mount_pool(Session())
     session.headers.update(headers)
     return session
 
@@ -52,11 +65,56 @@ def get_pull_request(repository: Dict) -> Dict:
     return repository["pullRequest"]
 
 
+def get_aliased_pull_request(repository: Dict, pr_number: int) -> Dict:
+    """Extracts a pull request aliased as pr<number> from given repository."""
+    return repository.get("pr{}".format(pr_number))
+
+
 def get_pull_requests(repository: Dict) -> List[Dict]:
     """Extract pull requests nodes from given repository."""
     return repository["pullRequests"]["nodes"]
 
 
+def get_page_info(pull_requests: Dict) -> Dict:
+    """Extracts pagination info from a pull requests connection."""
+    return pull_requests["pageInfo"]
+
+
+def paginate(
+    request: Callable[[Dict], Dict],
+    make_query: Callable[[Optional[Text]], Dict]
+) -> Iterator[Dict]:
+    """Requests pull requests page by page, yields the pages' repositories.
+
+    The request function gets the query and returns the response data,
+    the query maker gets the cursor to continue after (None at first).
+    The next page is only requested once the previous one was consumed.
+    """
+    cursor = None
+    while True:
+        repository = get_repository(request(make_query(cursor)))
+        yield repository
+
+        page_info = get_page_info(repository["pullRequests"])
+        if not page_info["hasNextPage"]:
+            return
+        cursor = page_info["endCursor"]
+
+
+def stream_pull_requests(
+    pages: Iterable[Dict], factory: Callable[[Dict], Any]
+) -> Iterator[Any]:
+    """Yields the pull requests made by factory as every page arrives."""
+    for repository in pages:
+        for pull_request in get_pull_requests(repository):
+            yield factory(pull_request)
+
+
+def get_nodes(data: Dict) -> List[Dict]:
+    """Extracts nodes looked up by their IDs, skipping the missing ones."""
+    return [n for n in data["nodes"] if n]
+
+
 def get_last_commit(pull_request: Dict) -> Dict:
     """Extracts last pull request from a given pull request."""
     return pull_request["commits"]["nodes"][0]["commit"]
@@ -67,6 +125,29 @@ def get_commit_sha(commit: Dict) -> Text:
     return commit["oid"]
 
 
+def get_commit_id(commit: Dict) -> Text:
+    """Extracts the GraphQL node ID from a given commit data."""
+    return commit.get("id")
+
+
+def get_tasks_link(commit: Dict) -> Optional[Text]:
+    """Extracts the tasks file link text from a given commit."""
+    tasks_link = commit.get("tasksLink")
+    if tasks_link is None or tasks_link.get("object") is None:
+        return None
+
+    return tasks_link["object"].get("text")
+
+
+def get_blob_text(repository: Dict, alias: Text) -> Optional[Text]:
+    """Extracts an aliased blob text from given repository."""
+    blob = repository.get(alias)
+    if blob is None:
+        return None
+
+    return blob.get("text")
+
+
 def get_status(statuses: Dict, status_name: Text) -> Dict:
     """Extracts the status info for a given status by name."""
     return statuses.get(status_name)
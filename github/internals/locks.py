@@ -0,0 +1,301 @@
+"""Lock backends which don't depend on GitHub's propagation timing
+
+GitHubStatusLock from entities stays the default. The backends here win
+the lock first and only then check the task's status and write the "Taken
+by" status as a notice to the others, so there's no race window to wait
+out.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler
+from time import time
+from typing import Dict, Optional, Text
+from urllib.parse import quote, unquote
+
+import requests
+
+from .entities import GitHubStatusLock, LockBackend, Task, World
+from .webhook import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+LOCK_DIR = "/var/lock/freeipa-pr-ci"
+# Runners renew the leases of their running tasks, so a crashed runner's
+# lease expires soon after it stopped renewing
+LEASE_TTL = 10 * 60
+LEASE_REQUEST_TIMEOUT = 10
+LEASE_PATH = "/leases/"
+
+
+def task_key(world: World, task: Task) -> Text:
+    """Identifies the task across all the runners"""
+    return "{}/{}/{}/{}".format(
+        world.repo_owner, world.repo_name, task.commit_sha, task.name
+    )
+
+
+class ExclusiveLock(LockBackend):
+    """Base of the backends which win the lock before writing the status"""
+    def claim(self, world: World, task: Task) -> Text:
+        """Takes the won task, or releases it if it's no longer runnable
+
+        The status is only read under the lock: a runner which read it
+        before could see the task pending while its previous holder
+        finishes it and unlocks, and would run it again.
+
+        Raises:
+            EnvironmentError
+        """
+        try:
+            self.check(world, task)
+            return self.notify(world, task)
+        except EnvironmentError:
+            self.release(world, task)
+            raise
+
+
+class FileLock(ExclusiveLock):
+    """Locks tasks with flock(2) for runners sharing a host
+
+    The kernel drops the lock together with a crashed runner's file
+    descriptors, so there are no stale locks to clean up.
+    """
+    def __init__(self, path: Text=LOCK_DIR) -> None:
+        self.path = path
+        self.files = {}
+
+    def lock_path(self, key: Text) -> Text:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.path, "{}.lock".format(digest))
+
+    def acquire(self, world: World, task: Task) -> Text:
+        key = task_key(world, task)
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(self.lock_path(key), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise EnvironmentError(
+                "Task '{}' PR#{} is locked by another runner.".format(
+                    task.name, task.pr_number
+                )
+            )
+
+        self.files[key] = lock_file
+        return self.claim(world, task)
+
+    def release(self, world: World, task: Task) -> None:
+        lock_file = self.files.pop(task_key(world, task), None)
+        if lock_file is not None:
+            # The file isn't removed, another runner could be holding
+            # a descriptor of it already
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+
+class LeaseStore(object):
+    """Grants time limited leases of keys to their owners"""
+    def acquire(self, key: Text, owner: Text, ttl: float) -> bool:
+        """Grants or renews the lease, returns False if someone holds it"""
+        raise NotImplementedError
+
+    def release(self, key: Text, owner: Text) -> None:
+        raise NotImplementedError
+
+
+class InMemoryLeaseStore(LeaseStore):
+    """Leases kept in the process, backs the coordination service"""
+    def __init__(self) -> None:
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key: Text, owner: Text, ttl: float) -> bool:
+        now = time()
+        with self.lock:
+            holder, expires = self.leases.get(key, (None, 0))
+            if holder not in (None, owner) and expires > now:
+                return False
+
+            self.leases[key] = (owner, now + ttl)
+            return True
+
+    def release(self, key: Text, owner: Text) -> None:
+        with self.lock:
+            holder, _ = self.leases.get(key, (None, 0))
+            if holder == owner:
+                del self.leases[key]
+
+    def holder(self, key: Text) -> Optional[Text]:
+        with self.lock:
+            holder, expires = self.leases.get(key, (None, 0))
+            return holder if expires > time() else None
+
+
+class HTTPLeaseStore(LeaseStore):
+    """Client of the coordination service run by LeaseService
+
+    Raises:
+        EnvironmentError: when the service can't be reached
+    """
+    def __init__(self, url: Text, session: requests.Session=None) -> None:
+        self.url = url.rstrip("/")
+        self.session = session if session is not None else requests.Session()
+        # The leases are renewed from the executor's thread
+        self.lock = threading.Lock()
+
+    def lease_url(self, key: Text) -> Text:
+        return "{}{}{}".format(self.url, LEASE_PATH, quote(key, safe=""))
+
+    def acquire(self, key: Text, owner: Text, ttl: float) -> bool:
+        with self.lock:
+            response = self.session.put(
+                self.lease_url(key), json={"owner": owner, "ttl": ttl},
+                timeout=LEASE_REQUEST_TIMEOUT
+            )
+        if response.status_code == 409:
+            return False
+        response.raise_for_status()
+        return True
+
+    def release(self, key: Text, owner: Text) -> None:
+        with self.lock:
+            response = self.session.delete(
+                self.lease_url(key), json={"owner": owner},
+                timeout=LEASE_REQUEST_TIMEOUT
+            )
+        response.raise_for_status()
+
+
+class LeaseLock(ExclusiveLock):
+    """Locks tasks with leases granted by a coordination service"""
+    def __init__(self, store: LeaseStore, ttl: float=LEASE_TTL) -> None:
+        self.store = store
+        self.ttl = ttl
+        # Leaves room for two failed renewals before the lease expires
+        self.renew_interval = ttl / 3
+
+    def acquire(self, world: World, task: Task) -> Text:
+        if not self.store.acquire(task_key(world, task), world.runner_id,
+                                  self.ttl):
+            raise EnvironmentError(
+                "Task '{}' PR#{} is leased by another runner.".format(
+                    task.name, task.pr_number
+                )
+            )
+
+        return self.claim(world, task)
+
+    def renew(self, world: World, task: Task) -> None:
+        if not self.store.acquire(task_key(world, task), world.runner_id,
+                                  self.ttl):
+            raise EnvironmentError(
+                "Lease of task '{}' PR#{} was taken by another "
+                "runner.".format(task.name, task.pr_number)
+            )
+
+    def release(self, world: World, task: Task) -> None:
+        try:
+            self.store.release(task_key(world, task), world.runner_id)
+        except EnvironmentError as e:
+            # The lease expires on its own
+            logger.warning(
+                "Failed to release lease of %s PR#%s: %s",
+                task.name, task.pr_number, e
+            )
+
+
+class LeaseService(object):
+    """Coordination service granting leases to the runners over HTTP
+
+    PUT /leases/<key> with {"owner": ..., "ttl": ...} grants or renews
+    the lease (200) or refuses it (409), DELETE /leases/<key> with
+    {"owner": ...} releases it (204).
+    """
+    def __init__(
+        self, store: InMemoryLeaseStore, address: Text="", port: int=8081
+    ) -> None:
+        self.store = store
+        self.address = address
+        self.port = port
+        self.server = None
+
+    def handle(self, method: Text, path: Text, body: bytes) -> int:
+        """Processes one request and returns the HTTP response code"""
+        if not path.startswith(LEASE_PATH):
+            return 404
+
+        key = unquote(path[len(LEASE_PATH):])
+        try:
+            data = json.loads(body.decode())
+            owner = data["owner"]
+        except (ValueError, KeyError, TypeError):
+            return 400
+
+        if method == "PUT":
+            try:
+                ttl = float(data.get("ttl", LEASE_TTL))
+            except (TypeError, ValueError):
+                return 400
+            return 200 if self.store.acquire(key, owner, ttl) else 409
+
+        if method == "DELETE":
+            self.store.release(key, owner)
+            return 204
+
+        return 405
+
+    def start(self) -> None:
+        """Starts the HTTP server in a daemon thread"""
+        self.server = ThreadingHTTPServer(
+            (self.address, self.port), make_handler(self)
+        )
+        thread = threading.Thread(
+            target=self.server.serve_forever, name="leases", daemon=True
+        )
+        thread.start()
+        logger.info("Granting leases on port %s", self.server.server_port)
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def make_handler(service: LeaseService) -> type:
+    """Creates the request handler class bound to the given service"""
+    class LeaseHandler(BaseHTTPRequestHandler):
+        def respond(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            self.send_response(service.handle(self.command, self.path, body))
+            self.end_headers()
+
+        do_PUT = respond
+        do_DELETE = respond
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return LeaseHandler
+
+
+def create_lock_backend(config: Optional[Dict]) -> LockBackend:
+    """Factory for LockBackend from the runner's lock configuration"""
+    config = config or {}
+    backend = config.get("backend", "github")
+    if backend == "github":
+        return GitHubStatusLock()
+    if backend == "file":
+        return FileLock(config.get("path", LOCK_DIR))
+    if backend == "lease":
+        return LeaseLock(
+            HTTPLeaseStore(config["url"]), config.get("ttl", LEASE_TTL)
+        )
+
+    raise ValueError("Unknown lock backend '{}'".format(backend))
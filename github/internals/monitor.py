@@ -0,0 +1,190 @@
+"""Sampling of the host resources the runner's jobs compete for
+
+The runner's own ledger (AvailableResources.take/give) only knows about
+the jobs it started. VMs leaked by crashed jobs, another runner on the
+same host or the host's own processes use resources as well, so the
+ledger is reconciled with what the host reports.
+"""
+import logging
+import os
+import subprocess
+from time import time
+from typing import Dict, Optional, Text, Tuple
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+LIBVIRT_URI = "qemu:///system"
+# Samples are reused for this many seconds
+SAMPLE_INTERVAL = 10
+VIRSH_TIMEOUT = 30
+# Memory (MB) kept for the host itself when none is configured
+RESERVED_MEMORY = 2048
+MB = float(1024 ** 2)
+
+
+class HostSample(object):
+    """Resources of the host at a point in time
+
+    Memory is in MB. Domains' allocations are None when libvirt couldn't
+    be asked.
+    """
+    def __init__(
+        self, load: float, available_memory: float,
+        domains_cpu: int=None, domains_memory: float=None
+    ) -> None:
+        self.load = load
+        self.available_memory = available_memory
+        self.domains_cpu = domains_cpu
+        self.domains_memory = domains_memory
+
+    def __str__(self) -> Text:
+        return "load {}, {:.0f}MB available, domains {} CPU, {}MB".format(
+            self.load, self.available_memory,
+            self.domains_cpu, self.domains_memory
+        )
+
+
+def parse_domstats(output: Text) -> Tuple[int, float]:
+    """Sums vCPUs and maximum memory (MB) of the domains in virsh domstats"""
+    cpu = 0
+    memory = 0
+    for line in output.splitlines():
+        key, _, value = line.strip().partition("=")
+        if key == "vcpu.current":
+            cpu += int(value)
+        elif key == "balloon.maximum":
+            memory += int(value) / 1024.0
+
+    return cpu, memory
+
+
+def available_disk(path: Text) -> float:
+    """Space (MB) available to unprivileged users on the path's filesystem"""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize / MB
+
+
+class ResourceMonitor(object):
+    """Reconciles the runner's ledger with the sampled host resources
+
+    Capacity of the host is its CPU count and total memory (without the
+    memory reserved for the host itself) multiplied by the overcommit
+    ratios. The free resources are the minimum of:
+
+    * the ledger: capacity minus the reservations of the runner's jobs,
+    * libvirt: capacity minus the allocations of all the running domains,
+      but at least the reservations (jobs which didn't boot their VMs yet
+      aren't visible to libvirt),
+    * the load: capacity minus the load average scaled by the ratio,
+    * the memory the host has available, without the reservations whose
+      VMs don't exist yet.
+
+    When libvirt can't be sampled, the memory is capped the way the ledger
+    without a monitor does it: the memory available when the runner
+    started, without all the reservations.
+    """
+    def __init__(
+        self, cpu_overcommit: float=1.0, memory_overcommit: float=1.0,
+        reserved_memory: float=RESERVED_MEMORY,
+        libvirt_uri: Text=LIBVIRT_URI,
+        sample_interval: float=SAMPLE_INTERVAL, io_capacity: float=None
+    ) -> None:
+        self.cpu_overcommit = cpu_overcommit
+        self.memory_overcommit = memory_overcommit
+        self.reserved_memory = reserved_memory
+        self.libvirt_uri = libvirt_uri
+        self.sample_interval = sample_interval
+        self.io_capacity = io_capacity
+        self.last_sample = None
+        self.sampled_at = 0
+        self.initial_memory = psutil.virtual_memory().available / MB
+
+    @staticmethod
+    def from_config(config: Optional[Dict]) -> "ResourceMonitor":
+        """Fabric of ResourceMonitor from the runner's configuration"""
+        config = config or {}
+        return ResourceMonitor(
+            cpu_overcommit=config.get("cpu_overcommit", 1.0),
+            memory_overcommit=config.get("memory_overcommit", 1.0),
+            reserved_memory=config.get("reserved_memory", RESERVED_MEMORY),
+            libvirt_uri=config.get("libvirt_uri", LIBVIRT_URI),
+            io_capacity=config.get("io_capacity")
+        )
+
+    def capacity(self) -> Tuple[float, float]:
+        """CPU and memory (MB) the jobs can allocate on the host"""
+        total_memory = psutil.virtual_memory().total / MB
+        return (
+            psutil.cpu_count() * self.cpu_overcommit,
+            (total_memory - self.reserved_memory) * self.memory_overcommit
+        )
+
+    def sample_libvirt(self) -> Tuple[Optional[int], Optional[float]]:
+        try:
+            output = subprocess.check_output(
+                [
+                    "virsh", "-c", self.libvirt_uri, "domstats",
+                    "--list-active", "--vcpu", "--balloon"
+                ],
+                stderr=subprocess.DEVNULL, timeout=VIRSH_TIMEOUT
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.debug("Failed to sample libvirt domains: %s", e)
+            return None, None
+
+        return parse_domstats(output.decode("utf-8", "replace"))
+
+    def sample(self) -> HostSample:
+        """Samples the host, recent samples are reused"""
+        now = time()
+        if self.last_sample is not None and (
+            now - self.sampled_at < self.sample_interval
+        ):
+            return self.last_sample
+
+        domains_cpu, domains_memory = self.sample_libvirt()
+        self.last_sample = HostSample(
+            load=os.getloadavg()[1],
+            available_memory=psutil.virtual_memory().available / MB,
+            domains_cpu=domains_cpu,
+            domains_memory=domains_memory
+        )
+        self.sampled_at = now
+        logger.debug("Host resources: %s", self.last_sample)
+        return self.last_sample
+
+    def free(
+        self, total: Tuple[float, float], ledger: Tuple[float, float]
+    ) -> Tuple[float, float]:
+        """Free CPU and memory reconciled with the host's sample
+
+        Args:
+            total: the capacity the ledger started with
+            ledger: what the ledger has free
+        """
+        total_cpu, total_memory = total
+        cpu, memory = ledger
+        reserved_cpu = total_cpu - cpu
+        reserved_memory = total_memory - memory
+        sample = self.sample()
+
+        cpus = [
+            cpu,
+            total_cpu - max(reserved_cpu, sample.load * self.cpu_overcommit),
+        ]
+        memories = [memory]
+        if sample.domains_cpu is not None:
+            cpus.append(total_cpu - max(reserved_cpu, sample.domains_cpu))
+            memories.append(
+                total_memory - max(reserved_memory, sample.domains_memory)
+            )
+            pending = max(reserved_memory - sample.domains_memory, 0)
+            memories.append(
+                sample.available_memory * self.memory_overcommit - pending
+            )
+        else:
+            memories.append(self.initial_memory - reserved_memory)
+
+        return max(min(cpus), 0), max(min(memories), 0)
@@ -0,0 +1,138 @@
+"""Background downloads of the vagrant boxes the open PRs need
+
+Every cycle the runner collects the templates named by the unfinished
+tasks of the open pull requests. The boxes missing on the host are
+downloaded by background processes with limited bandwidth, so the jobs
+find them locally instead of downloading several GB on their own time and
+in their locked slot. A job which needs a box being prefetched waits for
+the download to finish (see VagrantBox.locked).
+
+With a box store budget, the least recently used boxes no open PR needs are
+evicted every cycle and nothing is prefetched while the boxes in use take
+the whole budget.
+"""
+import logging
+import multiprocessing
+from collections import Counter
+from time import time
+from typing import Dict, List, Optional, Text, Tuple
+
+from .scheduler import TaskGraph
+
+from tasks.box_store import BoxStore
+from tasks.vagrant import VagrantBox, VagrantBoxPrefetch
+
+logger = logging.getLogger(__name__)
+
+# Download rate of a single box, in curl's --limit-rate format
+BOX_PREFETCH_RATE = "20M"
+# Number of boxes downloaded at once
+BOX_PREFETCH_CONCURRENCY = 1
+# Seconds before a failed download is tried again
+BOX_PREFETCH_RETRY_TIME = 3600
+
+BoxKey = Tuple[Text, Text]
+
+
+def referenced_boxes(graph: TaskGraph) -> Counter:
+    """Counts the boxes the unfinished tasks need"""
+    return Counter(
+        node.task.job.template for node in graph.nodes.values()
+        if not node.finished and node.task.job.template is not None
+    )
+
+
+def create_box_store(config: Optional[Dict]) -> Optional[BoxStore]:
+    """Factory for BoxStore, None when the boxes have no budget"""
+    if not config or not config.get("budget"):
+        return None
+    # The budget is configured in GB
+    return BoxStore(budget=int(config["budget"] * 1024 ** 3))
+
+
+def run_prefetch(job: VagrantBoxPrefetch) -> None:
+    """Entry point of the prefetch processes"""
+    try:
+        job()
+    except Exception as e:
+        logger.error("Prefetch of %s failed: %s", job, e)
+
+
+class BoxPrefetcher(object):
+    """Downloads the missing boxes, the most needed first"""
+    def __init__(
+        self, rate: Optional[Text]=BOX_PREFETCH_RATE,
+        concurrency: int=BOX_PREFETCH_CONCURRENCY,
+        retry_time: float=BOX_PREFETCH_RETRY_TIME, store: BoxStore=None
+    ) -> None:
+        self.rate = rate
+        self.concurrency = concurrency
+        self.retry_time = retry_time
+        self.store = store
+        self.wanted = Counter()
+        self.processes = {}
+        self.failed = {}
+
+    @staticmethod
+    def from_config(
+        config: Optional[Dict], store: BoxStore=None
+    ) -> Optional["BoxPrefetcher"]:
+        """Factory for BoxPrefetcher, None when prefetching is disabled"""
+        if not config:
+            return None
+        return BoxPrefetcher(
+            rate=config.get("rate", BOX_PREFETCH_RATE),
+            concurrency=config.get("concurrency", BOX_PREFETCH_CONCURRENCY),
+            retry_time=config.get("retry_time", BOX_PREFETCH_RETRY_TIME),
+            store=store
+        )
+
+    def collect(self, *graphs: TaskGraph) -> None:
+        self.wanted = sum(map(referenced_boxes, graphs), Counter())
+
+    def reap(self) -> None:
+        now = time()
+        for box, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.processes[box]
+            if not VagrantBox(*box).exists():
+                self.failed[box] = now
+
+    def missing(self) -> List[BoxKey]:
+        """Boxes to download, the ones most tasks need first"""
+        now = time()
+        return [
+            box for box, _ in self.wanted.most_common()
+            if all((
+                box not in self.processes,
+                now - self.failed.get(box, now - self.retry_time) >=
+                self.retry_time,
+                not VagrantBox(*box).exists()
+            ))
+        ]
+
+    def start(self, box: BoxKey) -> None:
+        job = VagrantBoxPrefetch(*box, rate=self.rate)
+        process = multiprocessing.Process(target=run_prefetch, args=(job,))
+        process.start()
+        self.processes[box] = process
+        logger.info("Prefetching box %s %s", *box)
+
+    def refill(self) -> None:
+        """Starts downloading the missing boxes the concurrency allows"""
+        self.reap()
+        if self.store is not None and self.store.over_budget():
+            logger.info("Boxes take the whole budget, not prefetching")
+            return
+
+        free = self.concurrency - len(self.processes)
+        for box in self.missing()[:max(free, 0)]:
+            self.start(box)
+
+    def shutdown(self) -> None:
+        """Stops the downloads, they start over on the next run"""
+        for process in self.processes.values():
+            process.terminate()
+            process.join()
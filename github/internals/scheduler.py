@@ -0,0 +1,426 @@
+"""Scheduling of the tasks of all open pull requests
+
+Every cycle the runner puts the tasks of all open PRs into a single
+dependency graph. Tasks which can never run (unknown requirements,
+dependency cycles) are reported, the ready ones are ranked so the work
+which unblocks the most of the remaining work starts first.
+"""
+import logging
+from time import time
+from typing import Dict, List, Optional, Text, Tuple
+
+from .entities import (
+    AvailableResources, PullRequest, Status, Task, Topology
+)
+
+logger = logging.getLogger(__name__)
+
+# Expected run time of a task without timeout, in seconds
+DEFAULT_TASK_COST = 3600
+# Number of the best ranked ready tasks the selection searches through
+SELECTION_CANDIDATES = 12
+# Ready tasks waiting longer than this many seconds get resources reserved
+STARVATION_TIME = 6 * 3600
+RANK_WEIGHT = 0.25
+AGING_WEIGHT = 0.5
+PRIORITIZED_WEIGHT = 2
+
+WHITE, GRAY, BLACK = range(3)
+
+
+def task_cost(task: Task) -> int:
+    """Expected run time of the task, its timeout is the upper bound"""
+    return task.timeout or DEFAULT_TASK_COST
+
+
+def expected_ends(
+    running_tasks: List[Tuple[Task, float]]
+) -> List[Tuple[float, Topology]]:
+    """Latest times the running tasks give their resources back"""
+    return [
+        (started_at + task_cost(task), task.topology)
+        for task, started_at in running_tasks
+    ]
+
+
+class TaskNode(object):
+    """A task of a pull request in the TaskGraph"""
+    def __init__(self, task: Task, pull_request: PullRequest) -> None:
+        self.task = task
+        self.pull_request = pull_request
+        self.dependents = []
+        self.critical_path = None
+        self.unblocks = None
+
+    def __repr__(self) -> Text:
+        return "<TaskNode {} PR#{}>".format(self.task.name, self.pr_number)
+
+    @property
+    def pr_number(self) -> int:
+        return self.pull_request.number
+
+    @property
+    def key(self) -> Tuple[int, Text]:
+        return self.pr_number, self.task.name
+
+    @property
+    def statuses(self) -> Dict[Text, Status]:
+        return self.pull_request.commit.statuses
+
+    @property
+    def status(self) -> Optional[Status]:
+        return self.statuses.get(self.task.name)
+
+    @property
+    def finished(self) -> bool:
+        status = self.status
+        return status is not None and (status.succeeded or status.failed)
+
+    @property
+    def runnable(self) -> bool:
+        """Tells if the task's status allows running it"""
+        status = self.status
+        return status is not None and (
+            status.unassigned or status.rerun_pending
+        )
+
+    @property
+    def ready(self) -> bool:
+        return self.runnable and self.task.check_dependencies(self.statuses)
+
+    @property
+    def cost(self) -> int:
+        return task_cost(self.task)
+
+    @property
+    def rank(self) -> Tuple:
+        """Sort key of the ready tasks, the most important first
+
+        Prioritized PRs go first, then the tasks with higher priority in
+        the tasks file. Ties are broken by the longest remaining chain of
+        work behind the task and by the number of tasks it unblocks.
+        """
+        return (
+            not self.pull_request.prioritized,
+            -self.task.priority,
+            -self.critical_path,
+            -self.unblocks,
+            self.pr_number,
+            self.task.name,
+        )
+
+
+class TaskGraph(object):
+    """Dependency graph of the tasks of all open pull requests"""
+    def __init__(self) -> None:
+        self.nodes = {}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def add(self, pull_request: PullRequest, task: Task) -> TaskNode:
+        node = TaskNode(task, pull_request)
+        self.nodes[node.key] = node
+        return node
+
+    def dependencies(self, node: TaskNode) -> List[TaskNode]:
+        return [
+            self.nodes[(node.pr_number, name)]
+            for name in node.task.dependencies
+            if (node.pr_number, name) in self.nodes
+        ]
+
+    def validate(self) -> List[Tuple[TaskNode, Text]]:
+        """Removes the tasks which can never run from the graph
+
+        A task is invalid if it requires a task its PR doesn't define or
+        if it's a part of a dependency cycle. Tasks which are defined, but
+        failed to load, still have their commit status and aren't missing.
+
+        Returns:
+            list: pairs of the removed tasks and the reasons
+        """
+        invalid = {}
+        for node in self.nodes.values():
+            for name in node.task.dependencies:
+                if all((
+                    (node.pr_number, name) not in self.nodes,
+                    name not in node.statuses
+                )):
+                    invalid[node.key] = (
+                        node, "requires unknown task {}".format(name)
+                    )
+
+        colors = {key: WHITE for key in self.nodes}
+        for node in self.nodes.values():
+            if colors[node.key] == WHITE:
+                self.__find_cycles(node, colors, [], invalid)
+
+        for key, (node, reason) in invalid.items():
+            logger.warning(
+                "Invalid task %s PR#%s: %s",
+                node.task.name, node.pr_number, reason
+            )
+            del self.nodes[key]
+
+        self.__link()
+        return list(invalid.values())
+
+    def __find_cycles(
+        self, node: TaskNode, colors: Dict, path: List[TaskNode],
+        invalid: Dict
+    ) -> None:
+        colors[node.key] = GRAY
+        path.append(node)
+        for dependency in self.dependencies(node):
+            if colors[dependency.key] == GRAY:
+                cycle = path[path.index(dependency):]
+                reason = "dependency cycle {}".format(" -> ".join(
+                    member.task.name for member in cycle + [dependency]
+                ))
+                for member in cycle:
+                    invalid[member.key] = (member, reason)
+            elif colors[dependency.key] == WHITE:
+                self.__find_cycles(dependency, colors, path, invalid)
+        path.pop()
+        colors[node.key] = BLACK
+
+    def __link(self) -> None:
+        for node in self.nodes.values():
+            node.dependents = []
+            node.critical_path = None
+            node.unblocks = None
+        for node in self.nodes.values():
+            for dependency in self.dependencies(node):
+                dependency.dependents.append(node)
+
+    def __measure(self, node: TaskNode) -> None:
+        """Computes the remaining work behind the task
+
+        critical_path is the longest chain of unfinished tasks starting
+        with this one weighted by their cost, unblocks is the number of
+        unfinished tasks waiting for it.
+        """
+        if node.critical_path is not None:
+            return
+
+        longest = 0
+        for dependent in node.dependents:
+            if dependent.finished:
+                continue
+            self.__measure(dependent)
+            longest = max(longest, dependent.critical_path)
+
+        node.critical_path = node.cost + longest
+        node.unblocks = len(self.__descendants(node))
+
+    def __descendants(self, node: TaskNode) -> List[TaskNode]:
+        seen = {}
+        stack = list(node.dependents)
+        while stack:
+            dependent = stack.pop()
+            if dependent.key in seen or dependent.finished:
+                continue
+            seen[dependent.key] = dependent
+            stack.extend(dependent.dependents)
+        return list(seen.values())
+
+    def ready(self) -> List[TaskNode]:
+        """Returns the tasks which can run now, the most important first
+
+        The graph has to be validated first.
+        """
+        ready = [node for node in self.nodes.values() if node.ready]
+        for node in ready:
+            self.__measure(node)
+
+        return sorted(ready, key=lambda node: node.rank)
+
+
+class BinPackingSelector(object):
+    """Picks the set of ready tasks which best fills the free resources
+
+    Taking the ready tasks one by one and skipping the ones which don't
+    fit strands capacity: a few tasks can leave the host half idle while
+    another combination would fill it. The selector searches the subsets
+    of the best ranked candidates instead, valuing each task by the share
+    of the free CPU and memory it fills, its rank and its waiting time.
+    A set only fits when its I/O and disk space needs fit as well.
+
+    Small tasks could still starve a large topology forever, so a task
+    waiting longer than starvation_time gets the resources reserved. Until
+    the running tasks give enough back, only the tasks which surely end
+    before that (by their timeouts) are started next to it.
+    """
+    def __init__(
+        self, candidates: int=SELECTION_CANDIDATES,
+        starvation_time: float=STARVATION_TIME
+    ) -> None:
+        self.candidates = candidates
+        self.starvation_time = starvation_time
+        self.waiting_since = {}
+
+    def age(self, node: TaskNode, now: float) -> float:
+        """Tells how long the task is waiting, relative to starvation"""
+        waiting = now - self.waiting_since.get(node.key, now)
+        return waiting / self.starvation_time
+
+    def __track(self, ready: List[TaskNode], now: float) -> None:
+        keys = {node.key for node in ready}
+        for key in list(self.waiting_since):
+            if key not in keys:
+                del self.waiting_since[key]
+        for key in keys:
+            self.waiting_since.setdefault(key, now)
+
+    @staticmethod
+    def fits(demand: Tuple[float, ...], free: Tuple[float, ...]) -> bool:
+        return all(needed <= left for needed, left in zip(demand, free))
+
+    @staticmethod
+    def subtract(
+        free: Tuple[float, ...], demand: Tuple[float, ...]
+    ) -> Tuple[float, ...]:
+        return tuple(left - needed for left, needed in zip(free, demand))
+
+    def reservation(
+        self, demand: Tuple[float, ...], free: Tuple[float, ...],
+        resources: AvailableResources,
+        running: List[Tuple[float, Topology]]
+    ) -> Optional[float]:
+        """Time when the running tasks give enough back for the task"""
+        for end, topology in sorted(running, key=lambda item: item[0]):
+            free = self.subtract(free, [
+                -needed for needed in resources.demand(topology)
+            ])
+            if self.fits(demand, free):
+                return end
+
+        return None
+
+    def select(
+        self, ready: List[TaskNode], resources: AvailableResources,
+        slots: int, running: List[Tuple[float, Topology]]=(),
+        now: float=None
+    ) -> List[TaskNode]:
+        """Selects the tasks to start from the ranked ready tasks
+
+        Args:
+            ready: the ready tasks, the best ranked first
+            resources: the free resources
+            slots: maximum number of tasks to select
+            running: expected ends and topologies of the running tasks
+        """
+        if now is None:
+            now = time()
+        self.__track(ready, now)
+        if slots <= 0:
+            return []
+
+        free = resources.headroom()
+        total = (
+            resources.total_cpu, resources.total_memory, resources.total_io
+        )
+        demands = {
+            node.key: resources.demand(node.task.topology) for node in ready
+        }
+        forced = []
+        deadline = None
+        starved = sorted(
+            (
+                node for node in ready
+                if self.age(node, now) >= 1 and self.fits(
+                    demands[node.key], total
+                )
+            ),
+            key=lambda node: -self.age(node, now)
+        )
+        if starved and self.fits(demands[starved[0].key], free):
+            forced.append(starved[0])
+            slots -= 1
+        elif starved:
+            deadline = self.reservation(
+                demands[starved[0].key], free, resources, running
+            )
+            logger.info(
+                "Reserving resources for %s PR#%s until %s",
+                starved[0].task.name, starved[0].pr_number, deadline
+            )
+            if deadline is None:
+                return []
+
+        left = free
+        for node in forced:
+            left = self.subtract(left, demands[node.key])
+
+        candidates = [
+            node for node in ready
+            if all((
+                node not in forced,
+                self.fits(demands[node.key], left),
+                deadline is None or now + node.cost <= deadline
+            ))
+        ][:self.candidates]
+        values = [
+            self.value(node, index, len(candidates), free, now)
+            for index, node in enumerate(candidates)
+        ]
+
+        return forced + [
+            candidates[index]
+            for index in self.__search(
+                [demands[node.key] for node in candidates], values, left,
+                slots
+            )
+        ]
+
+    def __search(
+        self, demands: List[Tuple[float, ...]], values: List[float],
+        free: Tuple[float, ...], slots: int
+    ) -> List[int]:
+        """Finds the most valuable subset of the candidates which fits
+
+        The search is exhaustive over at most 2^candidates subsets, the
+        branches which can't beat the best set found so far are cut.
+        """
+        best = []
+        best_value = 0
+        stack = [(0, [], free, slots, 0)]
+        while stack:
+            index, chosen, left, slots_left, value = stack.pop()
+            if value > best_value:
+                best, best_value = chosen, value
+            if index == len(demands) or slots_left <= 0:
+                continue
+            if value + sum(values[index:]) <= best_value:
+                continue
+
+            stack.append((index + 1, chosen, left, slots_left, value))
+            if self.fits(demands[index], left):
+                stack.append((
+                    index + 1, chosen + [index],
+                    self.subtract(left, demands[index]),
+                    slots_left - 1, value + values[index]
+                ))
+
+        return best
+
+    def value(
+        self, node: TaskNode, index: int, count: int,
+        free: Tuple[float, ...], now: float
+    ) -> float:
+        """Value of starting the task now
+
+        The filled share of the free resources dominates, the rank and
+        the waiting time decide between similar sets.
+        """
+        topology = node.task.topology
+        cpu, memory = free[:2]
+        fill = (
+            topology.cpu / max(cpu, 1) + topology.memory / max(memory, 1)
+        ) / 2
+        rank = RANK_WEIGHT * (count - index) / count
+        if node.pull_request.prioritized:
+            rank += PRIORITIZED_WEIGHT
+        aging = AGING_WEIGHT * min(self.age(node, now), 1)
+        return fill + rank + aging
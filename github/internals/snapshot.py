@@ -0,0 +1,142 @@
+"""Incrementally updated snapshot of the open pull requests"""
+import logging
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional, Text
+
+from dateutil import parser
+
+from .entities import PullRequest, World
+from .gql import util, queries
+
+logger = logging.getLogger(__name__)
+
+# Every n-th update re-downloads all open PRs, so changes which don't
+# touch the PR's updatedAt (e.g. mergeability after a push to the base
+# branch) aren't missed forever
+FULL_SYNC_INTERVAL = 12
+# Maximum number of IDs GitHub accepts in a single nodes() lookup
+NODES_LIMIT = 100
+
+
+class PullRequestSnapshot(object):
+    """Keeps the open pull requests between the runner's cycles
+
+    The first update downloads all open PRs. Following updates walk the
+    PRs ordered by updatedAt and stop at the last seen watermark, merging
+    only the changed ones. Commit statuses don't bump the PR's updatedAt,
+    so they're refreshed with a single lookup of the tracked commits.
+    """
+    def __init__(self, full_sync_interval: int=FULL_SYNC_INTERVAL) -> None:
+        self.full_sync_interval = full_sync_interval
+        self.pull_requests = {}
+        self.repo_url = None
+        self.watermark = None
+        self.updates = 0
+
+    def update(self, world: World) -> List[PullRequest]:
+        """Brings the snapshot up to date and returns the open PRs
+
+        Raises:
+            EnvironmentError
+        """
+        full_sync = self.updates % self.full_sync_interval == 0
+        if self.watermark is None or full_sync:
+            self.__full_sync(world)
+        else:
+            self.__delta_sync(world)
+
+        self.updates += 1
+        return list(self.pull_requests.values())
+
+    def __request(self, world: World, query: Dict) -> Dict:
+        world.check_graphql_limit()
+        return util.get_data(world.graphql_request(query=query))
+
+    def __pages(
+        self, world: World, make_query: Callable[[Optional[Text]], Dict]
+    ) -> Iterator[Dict]:
+        for repository in util.paginate(
+            partial(self.__request, world), make_query
+        ):
+            self.repo_url = util.get_repository_url(repository)
+            yield repository
+
+    def __full_sync(self, world: World) -> None:
+        # The open PRs aren't ordered by updatedAt, so the watermark is
+        # taken from the most recently updated PR of any state. It's read
+        # first: the PRs updated while the open ones are listed are newer
+        # and the next delta sync merges them.
+        watermark = None
+        for pr_data in self.__updated_pull_requests(world):
+            watermark = parser.parse(pr_data["updatedAt"])
+            break
+
+        self.pull_requests = {
+            pr.number: pr for pr in util.stream_pull_requests(
+                self.__pages(world, partial(
+                    queries.make_pull_requests_query,
+                    world.repo_owner, world.repo_name, world.tasks_path
+                )),
+                PullRequest.from_dict
+            )
+        }
+        self.watermark = watermark
+
+    def __updated_pull_requests(self, world: World) -> Iterator[Dict]:
+        return util.stream_pull_requests(
+            self.__pages(world, partial(
+                queries.make_updated_pull_requests_query,
+                world.repo_owner, world.repo_name, world.tasks_path
+            )),
+            lambda pr_data: pr_data
+        )
+
+    def __delta_sync(self, world: World) -> None:
+        watermark = self.watermark
+        changed = set()
+        for pr_data in self.__updated_pull_requests(world):
+            updated_at = parser.parse(pr_data["updatedAt"])
+            # GitHub's timestamps have a one second resolution, so the PRs
+            # updated in the same second as the watermark are merged again
+            if updated_at < watermark:
+                break
+
+            self.merge(pr_data)
+            changed.add(pr_data["number"])
+            self.watermark = max(self.watermark, updated_at)
+
+        self.__refresh_statuses(world, [
+            pr for number, pr in self.pull_requests.items()
+            if number not in changed
+        ])
+        logger.debug(
+            "Merged %s updated PRs into snapshot of %s open PRs",
+            len(changed), len(self.pull_requests)
+        )
+
+    def merge(self, pr_data: Dict) -> None:
+        """Merges a changed PR into the snapshot"""
+        number = pr_data["number"]
+        if pr_data["state"] == "OPEN":
+            self.pull_requests[number] = PullRequest.from_dict(pr_data)
+        else:
+            self.pull_requests.pop(number, None)
+
+    def __refresh_statuses(
+        self, world: World, pull_requests: List[PullRequest]
+    ) -> None:
+        commits = {
+            pr.commit.node_id: pr.commit for pr in pull_requests
+            if pr.commit.node_id is not None
+        }
+        ids = list(commits)
+        for start in range(0, len(ids), NODES_LIMIT):
+            data = self.__request(
+                world, queries.make_commits_statuses_query(
+                    ids[start:start + NODES_LIMIT]
+                )
+            )
+            for commit_data in util.get_nodes(data):
+                commits[util.get_commit_id(commit_data)].update_statuses(
+                    util.get_statuses(commit_data)
+                )
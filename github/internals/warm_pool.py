@@ -0,0 +1,221 @@
+"""Warm pool of booted and base-provisioned VMs
+
+The runner keeps a few idle slots (see tasks/warm_pool.py) for the
+(template, topology) pairs its jobs use the most, a job claims one and only
+installs the tested build into its VMs. The slots are provisioned in
+background processes with the resources left over by the jobs, and the idle
+slots hold their resources in the runner's ledger until a job claims them.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+from collections import Counter
+from time import time
+from typing import Dict, List, Optional, Text, Tuple
+
+from .entities import AvailableResources, Task, Topology
+
+from tasks import constants
+from tasks.tasks import WarmUp
+from tasks.warm_pool import IDLE, PROVISIONING, WarmPool
+
+logger = logging.getLogger(__name__)
+
+# Idle slots per pair
+WARM_POOL_SIZE = 1
+# Number of the most used pairs to keep slots for
+WARM_POOL_PAIRS = 2
+# Share of the host's CPU and memory the slots may hold
+WARM_POOL_BUDGET = 0.25
+# Idle slots are destroyed after this many seconds
+WARM_SLOT_MAX_IDLE = 6 * 3600
+
+SlotKey = Tuple[Text, Text, Text]
+
+
+class WarmSlot(object):
+    """A slot the runner holds resources for"""
+    def __init__(self, uuid: Text, key: SlotKey, topology: Topology) -> None:
+        self.uuid = uuid
+        self.key = key
+        self.topology = topology
+
+    @property
+    def path(self) -> Text:
+        return os.path.join(constants.JOBS_DIR, self.uuid)
+
+
+def run_warm_up(job: WarmUp) -> None:
+    """Entry point of the warm up processes"""
+    try:
+        job()
+    except Exception as e:
+        logger.error("Warm up of slot %s failed: %s", job.uuid, e)
+
+
+class WarmPoolManager(object):
+    """Keeps the warm pool filled for the most used pairs"""
+    def __init__(
+        self, resources: AvailableResources, pool: WarmPool=None,
+        size: int=WARM_POOL_SIZE, pairs: int=WARM_POOL_PAIRS,
+        budget: float=WARM_POOL_BUDGET, max_idle: float=WARM_SLOT_MAX_IDLE
+    ) -> None:
+        self.resources = resources
+        self.pool = pool if pool is not None else WarmPool()
+        self.size = size
+        self.pairs = pairs
+        self.budget = budget
+        self.max_idle = max_idle
+        self.usage = Counter()
+        self.topologies = {}
+        self.held = {}
+        self.processes = {}
+        self.retiring = {}
+        self.adopt()
+
+    @staticmethod
+    def from_config(
+        resources: AvailableResources, config: Optional[Dict]
+    ) -> Optional["WarmPoolManager"]:
+        """Factory for WarmPoolManager, None when the pool is disabled"""
+        if not config:
+            return None
+        return WarmPoolManager(
+            resources,
+            size=config.get("size", WARM_POOL_SIZE),
+            pairs=config.get("pairs", WARM_POOL_PAIRS),
+            budget=config.get("budget", WARM_POOL_BUDGET),
+            max_idle=config.get("max_idle", WARM_SLOT_MAX_IDLE)
+        )
+
+    @staticmethod
+    def slot_key(task: Task) -> Optional[SlotKey]:
+        job = task.job
+        if not job.warm_pool or job.template is None:
+            return None
+        return job.template + (task.topology.name,)
+
+    def adopt(self) -> None:
+        """Takes over the slots left by the previous run of the runner"""
+        for uuid, data in self.pool.read().items():
+            slot = WarmSlot(
+                uuid, tuple(data["template"]) + (data["topology"],),
+                Topology.from_dict(dict(data["resources"]))
+            )
+            self.hold(slot)
+            if data["state"] == PROVISIONING:
+                # Its warm up process is gone
+                self.retire(slot)
+
+    def record(self, task: Task) -> None:
+        """Counts the task's pair as used"""
+        key = self.slot_key(task)
+        if key is not None:
+            self.usage[key] += 1
+            self.topologies[key] = task.topology
+
+    def wanted(self) -> List[SlotKey]:
+        return [key for key, _ in self.usage.most_common(self.pairs)]
+
+    def hold(self, slot: WarmSlot) -> None:
+        self.held[slot.uuid] = slot
+        self.resources.take(slot)
+
+    def release(self, slot: WarmSlot) -> None:
+        del self.held[slot.uuid]
+        self.resources.give(slot)
+
+    def fits(self, topology: Topology) -> bool:
+        """Tells if the budget and the free resources allow another slot"""
+        cpu = sum(slot.topology.cpu for slot in self.held.values())
+        memory = sum(slot.topology.memory for slot in self.held.values())
+        candidate = WarmSlot("", ("", "", ""), topology)
+        return all((
+            cpu + topology.cpu <= self.budget * self.resources.total_cpu,
+            memory + topology.memory <= (
+                self.budget * self.resources.total_memory
+            ),
+            self.resources.check(candidate),
+        ))
+
+    def start(self, key: SlotKey) -> None:
+        """Registers a new slot and boots its VMs in the background"""
+        template_name, template_version, topology_name = key
+        topology = self.topologies[key]
+        job = WarmUp(
+            {"name": template_name, "version": template_version},
+            topology_name, pool=self.pool
+        )
+        slot = WarmSlot(job.uuid, key, topology)
+        self.pool.add(
+            job.uuid, template_name, template_version, topology_name,
+            resources=dict(vars(topology))
+        )
+        self.hold(slot)
+        process = multiprocessing.Process(target=run_warm_up, args=(job,))
+        process.start()
+        self.processes[job.uuid] = process
+        logger.info("Warming up slot %s of %s", job.uuid, key)
+
+    def retire(self, slot: WarmSlot) -> None:
+        """Destroys the slot's VMs in the background"""
+        self.pool.remove(slot.uuid)
+        if not os.path.isdir(slot.path):
+            self.release(slot)
+            return
+
+        logger.info("Destroying slot %s of %s", slot.uuid, slot.key)
+        self.retiring[slot.uuid] = subprocess.Popen(
+            ["vagrant", "destroy", "--force"], cwd=slot.path,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+    def reconcile(self) -> None:
+        """Releases the resources of the claimed and destroyed slots"""
+        for uuid, process in list(self.processes.items()):
+            if not process.is_alive():
+                process.join()
+                del self.processes[uuid]
+
+        for uuid, process in list(self.retiring.items()):
+            if process.poll() is not None:
+                del self.retiring[uuid]
+                shutil.rmtree(self.held[uuid].path, ignore_errors=True)
+                self.release(self.held[uuid])
+
+        registered = self.pool.read()
+        for uuid, slot in list(self.held.items()):
+            if uuid in self.retiring:
+                continue
+            data = registered.get(uuid)
+            if data is None:
+                # Claimed by a job (or its warm up failed)
+                self.release(slot)
+            elif data["state"] == PROVISIONING and uuid not in self.processes:
+                self.retire(slot)
+            elif data["state"] == IDLE and any((
+                time() - data["since"] > self.max_idle,
+                # Usage is unknown right after the runner started
+                self.usage and slot.key not in self.wanted(),
+            )):
+                self.retire(slot)
+
+    def refill(self) -> None:
+        """Starts warming up the missing slots the resources allow"""
+        self.reconcile()
+        for key in self.wanted():
+            slots = sum(
+                1 for uuid, slot in self.held.items()
+                if slot.key == key and uuid not in self.retiring
+            )
+            while slots < self.size and self.fits(self.topologies[key]):
+                self.start(key)
+                slots += 1
+
+    def shutdown(self) -> None:
+        """Stops the warm ups, their slots are cleaned up on the next start"""
+        for process in self.processes.values():
+            process.terminate()
+            process.join()
@@ -0,0 +1,179 @@
+"""Embedded receiver of GitHub webhooks
+
+GitHub can notify the runner about changes in the monitored repository
+instead of the runner finding them out by polling. Every relevant event
+wakes up the scheduler, polling is then only used as a safety net.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, Optional, Text
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADERS = [
+    ("X-Hub-Signature-256", "sha256", hashlib.sha256),
+    ("X-Hub-Signature", "sha1", hashlib.sha1),
+]
+PULL_REQUEST_ACTIONS = [
+    "opened", "reopened", "synchronize", "labeled", "unlabeled",
+    "ready_for_review",
+]
+SUPPORTED_EVENTS = ["pull_request", "status", "label"]
+TASK_TAKEN_PREFIX = "Taken by"
+
+
+def verify_signature(secret: bytes, body: bytes, headers: Dict) -> bool:
+    """Checks the HMAC signature GitHub computed over the payload"""
+    for header, algorithm, digestmod in SIGNATURE_HEADERS:
+        signature = headers.get(header)
+        if signature is None:
+            continue
+
+        expected = "{}={}".format(
+            algorithm, hmac.new(secret, body, digestmod).hexdigest()
+        )
+        return hmac.compare_digest(expected, signature)
+
+    return False
+
+
+class WebhookEvent(object):
+    """Represents a GitHub webhook delivery"""
+    def __init__(
+        self, name: Text, action: Text, repository: Text,
+        pr_number: int=None, description: Text=None
+    ) -> None:
+        self.name = name
+        self.action = action
+        self.repository = repository
+        self.pr_number = pr_number
+        self.description = description
+
+    def __str__(self) -> Text:
+        return "{name}:{action} {repository}#{pr_number}".format(
+            name=self.name, action=self.action,
+            repository=self.repository, pr_number=self.pr_number
+        )
+
+    @property
+    def relevant(self) -> bool:
+        """Tells if the event can change anything for the scheduler"""
+        if self.name == "pull_request":
+            return self.action in PULL_REQUEST_ACTIONS
+
+        if self.name == "status":
+            # Locks written by runners (including this one) don't make any
+            # task runnable, finished and unassigned ones do
+            return not (self.description or "").startswith(TASK_TAKEN_PREFIX)
+
+        return self.name in SUPPORTED_EVENTS
+
+    @staticmethod
+    def from_payload(name: Text, payload: Dict) -> "WebhookEvent":
+        """Fabric of WebhookEvent"""
+        pull_request = payload.get("pull_request") or {}
+        return WebhookEvent(
+            name=name,
+            action=payload.get("action"),
+            repository=payload.get("repository", {}).get("full_name"),
+            pr_number=pull_request.get("number"),
+            description=payload.get("description")
+        )
+
+
+class WebhookReceiver(object):
+    """Receives webhooks in a background thread and queues relevant events"""
+    def __init__(
+        self, secret: Text, repo_owner: Text, repo_name: Text,
+        address: Text="", port: int=8080
+    ) -> None:
+        self.secret = secret.encode()
+        self.repository = "{}/{}".format(repo_owner, repo_name)
+        self.address = address
+        self.port = port
+        self.events = queue.Queue()
+        self.server = None
+
+    def handle(self, name: Text, headers: Dict, body: bytes) -> int:
+        """Processes one delivery and returns the HTTP response code"""
+        if not verify_signature(self.secret, body, headers):
+            logger.warning("Rejecting %s webhook: bad signature", name)
+            return 401
+
+        if name not in SUPPORTED_EVENTS:
+            return 204
+
+        try:
+            event = WebhookEvent.from_payload(name, json.loads(body.decode()))
+        except (ValueError, AttributeError) as e:
+            logger.warning("Rejecting %s webhook: %s", name, e)
+            return 400
+
+        if event.repository != self.repository or not event.relevant:
+            return 204
+
+        logger.debug("Received webhook %s", event)
+        self.events.put(event)
+        return 202
+
+    def wait(self, timeout: float=0) -> Optional[WebhookEvent]:
+        """Waits for an event and discards the ones queued after it
+
+        A single scheduling cycle handles all the changes at once, so
+        there's no need to wake up the scheduler for each of them.
+        """
+        try:
+            event = self.events.get(timeout=timeout) if timeout else (
+                self.events.get_nowait()
+            )
+        except queue.Empty:
+            return None
+
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                return event
+
+    def start(self) -> None:
+        """Starts the HTTP server in a daemon thread"""
+        self.server = ThreadingHTTPServer(
+            (self.address, self.port), make_handler(self)
+        )
+        thread = threading.Thread(
+            target=self.server.serve_forever, name="webhook", daemon=True
+        )
+        thread.start()
+        logger.info("Listening for webhooks on port %s", self.port)
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(receiver: WebhookReceiver) -> type:
+    """Creates the request handler class bound to the given receiver"""
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            name = self.headers.get("X-GitHub-Event", "")
+            self.send_response(receiver.handle(name, self.headers, body))
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return WebhookHandler
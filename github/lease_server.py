@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+"""Coordination service granting task leases to PR CI runners"""
+
+import argparse
+import logging
+import signal
+import threading
+
+from internals.locks import InMemoryLeaseStore, LeaseService
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Grant task leases to the runners using the lease '
+                    'lock backend')
+    parser.add_argument(
+        '--address', default='',
+        help='Address to listen on')
+    parser.add_argument(
+        '--port', type=int, default=8081,
+        help='Port to listen on')
+
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+    service = LeaseService(InMemoryLeaseStore(), args.address, args.port)
+    service.start()
+    stopped.wait()
+    service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,7 @@ logger.addHandler(consoleHandler)
 def load_yaml(yml_path):
     try:
         with open(yml_path) as yml_file:
-            return yaml.load(yml_file)
+            return yaml.safe_load(yml_file)
     except IOError as exc:
         raise argparse.ArgumentTypeError(
             'Failed to open {}: {}'.format(yml_path, exc))
@@ -6,24 +6,39 @@ import logging.config
 import signal
 import sys
 from functools import partial
-from time import sleep
-from typing import Dict, Iterator, Optional, Text
+from itertools import chain, islice
+from time import time
+from typing import Dict, Iterator, List, Optional, Text, Tuple
 
 import github3
 import yaml
 from github3.exceptions import NotFoundError
 
+from internals.cache import TASKS_CACHE_SIZE, TasksDataCache
 from internals.entities import (
-    ExitHandler, JobDispatcher, PullRequest, Status, Task, World,
-    sentry_report_exception, JobYAMLError
+    ExitHandler, JobDispatcher, Label, PullRequest, Status, Task, World,
+    JobYAMLError, STATUS_SNAPSHOT_MAX_AGE
 )
+from internals.executor import Executor, create_executor
 from internals.gql import util, queries
+from internals.locks import create_lock_backend
+from internals.monitor import ResourceMonitor
+from internals.scheduler import (
+    BinPackingSelector, TaskGraph, TaskNode, expected_ends
+)
+from internals.snapshot import PullRequestSnapshot
+from internals.warm_pool import WarmPoolManager
+from internals.prefetch import (
+    BoxPrefetcher, create_box_store, referenced_boxes
+)
+from internals.webhook import WebhookReceiver
 
 
 logger = logging.getLogger(__name__)
 
 
-ERROR_BACKOFF_TIME = 600
+SAFETY_POLL_TIME = 1800
+WAKEUP_INTERVAL = 1
 
 
 def skipping_pr(reason: Text, number: int) -> None:
@@ -36,12 +51,91 @@ def skipping_task(reason: Text, task: Task) -> None:
     )
 
 
+def fetch_pull_requests(
+    world: World, snapshot: Optional[PullRequestSnapshot]
+) -> Tuple[Text, Iterator[PullRequest]]:
+    """Gets the repository URL and a stream of the open pull requests
+
+    Prioritized PRs come first. Only their first page is fetched right
+    away, the other pages are fetched while the stream is consumed, so
+    the first PRs can be processed before the last ones are downloaded.
+
+    Raises:
+        EnvironmentError, also while consuming the stream
+    """
+    if snapshot is not None:
+        pull_requests = sorted(
+            snapshot.update(world), key=lambda pr: not pr.prioritized
+        )
+        return snapshot.repo_url, iter(pull_requests)
+
+    def request(query: Dict) -> Dict:
+        world.check_graphql_limit()
+        return util.get_data(world.graphql_request(query=query))
+
+    def pages(labels: List[Text]=None) -> Iterator[Dict]:
+        return util.paginate(request, lambda cursor: (
+            queries.make_pull_requests_query(
+                world.repo_owner, world.repo_name, world.tasks_path,
+                cursor, labels
+            )
+        ))
+
+    prioritized_pages = pages([Label.PRIORITIZED.value])
+    first_page = next(prioritized_pages)
+    repo_url = util.get_repository_url(first_page)
+
+    def stream() -> Iterator[PullRequest]:
+        prioritized = set()
+        for pull_request in util.stream_pull_requests(
+            chain([first_page], prioritized_pages), PullRequest.from_dict
+        ):
+            prioritized.add(pull_request.number)
+            yield pull_request
+
+        for pull_request in util.stream_pull_requests(
+            pages(), PullRequest.from_dict
+        ):
+            if pull_request.number not in prioritized:
+                yield pull_request
+
+    return repo_url, stream()
+
+
+def batches(items: Iterator, size: int) -> Iterator[List]:
+    """Groups the items into lists of the given size while they arrive"""
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def idle(
+    executor: Executor, receiver: Optional[WebhookReceiver], timeout: float
+) -> None:
+    """Waits until a job finishes, a webhook arrives or timeout expires"""
+    if receiver is None:
+        executor.wait(timeout)
+        return
+
+    deadline = time() + timeout
+    while time() < deadline:
+        step = min(WAKEUP_INTERVAL, deadline - time())
+        if executor.wait(step):
+            return
+        event = receiver.wait()
+        if event is not None:
+            logger.info("Woken up by %s", event)
+            return
+
+
 def create_parser():
     def config_file(path):
         def load_yaml(yml_path):
             try:
                 with open(yml_path) as yml_file:
-                    return yaml.load(yml_file)
+                    return yaml.safe_load(yml_file)
             except IOError as e:
                 raise argparse.ArgumentTypeError(
                     'Failed to open {}: {}'.format(yml_path, e))
@@ -86,6 +180,11 @@ def create_parser():
 def process_pull_request(
     world: World, pull_request: PullRequest, repository_url: Text
 ) -> Optional[Iterator[Task]]:
+    """Generates all the tasks of the PR for the scheduler
+
+    Statuses of the PR's tasks are updated on the way (unassigned,
+    re-run), the scheduler then picks the tasks which are ready.
+    """
 
     if pull_request.postponed:
         skipping_pr("postponed", pull_request.number)
@@ -103,6 +202,17 @@ def process_pull_request(
         logger.error(e)
         return None
 
+    # Unassigning and re-running tasks below is served from the status
+    # snapshot, so refresh all statuses of the PR at once if it's stale
+    try:
+        world.poll_statuses(
+            [(pull_request.number, name) for name in tasks_data],
+            STATUS_SNAPSHOT_MAX_AGE
+        )
+    except EnvironmentError as e:
+        logger.error(e)
+        return None
+
     if pull_request.needs_rerun:
         # If all statuses are not failed (not in state ERROR or FAILURE) and
         # re-run label was set previously, remove the re-run label
@@ -142,21 +252,88 @@ def process_pull_request(
                     task.set_unassigned(world)
                 except EnvironmentError as e:
                     logger.error(e)
-                continue
 
         status = pull_request.commit.statuses.get(task.name)
         if status is not None:
-            task = process_status(
-                world, status, task, pull_request.needs_rerun
+            process_status(world, status, task, pull_request.needs_rerun)
+
+        yield task
+
+
+def backlog_tasks(
+    world: World, pull_request: PullRequest, repository_url: Text
+) -> Iterator[Task]:
+    """Generates the tasks of the PR the runner has no room for right now
+
+    Unlike process_pull_request, the statuses are left alone. The tasks
+    only tell which boxes the open PRs need.
+    """
+    if pull_request.postponed or not pull_request.mergeable:
+        return
+
+    try:
+        tasks_data = pull_request.get_tasks_data(world)
+    except (yaml.error.YAMLError, TypeError, KeyError) as e:
+        logger.debug(e)
+        return
+
+    for name, task_data in tasks_data.items():
+        try:
+            yield Task(
+                name, pull_request.number, pull_request.commit.sha,
+                pull_request.author, repository_url, task_data, JobDispatcher
             )
+        except JobYAMLError:
+            continue
+
+
+def report_invalid_task(world: World, node: TaskNode, reason: Text) -> None:
+    """Sets the error status of a task which can never run"""
+    status = node.status
+    if status is not None and status.failed:
+        return
+
+    try:
+        world.create_error_status(
+            node.task.commit_sha, node.task.name,
+            "Test not executed: {}".format(reason)
+        )
+    except EnvironmentError as e:
+        logger.error(e)
+
+
+def schedule(
+    world: World, graph: TaskGraph, selector: BinPackingSelector,
+    executor: Executor, exit_handler: ExitHandler,
+    warm_pool: WarmPoolManager=None
+) -> None:
+    """Locks and submits the set of ready tasks which fills the host best"""
+    for node, reason in graph.validate():
+        report_invalid_task(world, node, reason)
+
+    ready = graph.ready()
+    while ready and not (executor.full or exit_handler.done):
+        selected = selector.select(
+            ready, world.available_resources, executor.free_slots,
+            expected_ends(executor.running_tasks)
+        )
+        if not selected:
+            break
+
+        # Tasks which failed to lock are dropped, the selection is then
+        # repeated with the resources they'd have taken
+        for node in selected:
+            ready.remove(node)
+            task = process_task(world, node.task, node.statuses)
             if task is None:
                 continue
 
-        task = process_task(world, task, pull_request.commit.statuses)
-        if task is None:
-            continue
-
-        yield task
+            if warm_pool is not None:
+                warm_pool.record(task)
+            executor.submit(task, node.statuses)
+            executor.wait()
+            if executor.full or exit_handler.done:
+                break
 
 
 def process_status(
@@ -239,6 +416,15 @@ def main():
     tasks_path = config["tasks_file"]
     whitelist = config["whitelist"]
     no_task_backoff_time = config["no_task_backoff_time"]
+    parallel_jobs = config.get("parallel_jobs", 1)
+    webhook = config.get("webhook")
+    incremental_fetch = config.get("incremental_fetch", False)
+    tasks_cache = config.get("tasks_cache", {})
+    lock = config.get("lock")
+    resources = config.get("resources", {})
+    warm_pool_config = config.get("warm_pool")
+    box_prefetch_config = config.get("box_prefetch")
+    box_store = create_box_store(config.get("box_store"))
 
     logging.config.dictConfig(config["logging"])
 
@@ -247,6 +433,7 @@ def main():
     signal.signal(signal.SIGTERM, exit_handler.abort)
 
     gh = github3.login(token=credentials["token"])
+    util.mount_pool(gh.session)
     session = util.create_session(util.make_headers(credentials["token"]))
     do_request = partial(util.perform_request, session=session)
 
@@ -258,57 +445,101 @@ def main():
         repo_name=repo["name"],
         runner_id=runner_id,
         tasks_path=tasks_path,
-        whitelist=whitelist
+        whitelist=whitelist,
+        tasks_cache=TasksDataCache(
+            maxsize=tasks_cache.get("size", TASKS_CACHE_SIZE),
+            path=tasks_cache.get("path")
+        ),
+        lock_backend=create_lock_backend(lock),
+        resource_monitor=(
+            ResourceMonitor.from_config(resources)
+            if resources.get("monitor", False) else None
+        )
     )
 
-    while not exit_handler.done:
-        world.check_graphql_limit()
+    executor = create_executor(world, exit_handler, parallel_jobs)
+    snapshot = PullRequestSnapshot() if incremental_fetch else None
+    selector = BinPackingSelector()
+    warm_pool = WarmPoolManager.from_config(
+        world.available_resources, warm_pool_config
+    )
+    prefetcher = BoxPrefetcher.from_config(box_prefetch_config, box_store)
+    manage_boxes = box_store is not None or prefetcher is not None
+
+    receiver = None
+    backoff_time = no_task_backoff_time
+    if webhook is not None:
+        receiver = WebhookReceiver(
+            secret=webhook["secret"],
+            repo_owner=world.repo_owner,
+            repo_name=world.repo_name,
+            port=webhook.get("port", 8080)
+        )
+        receiver.start()
+        backoff_time = webhook.get("safety_poll_time", SAFETY_POLL_TIME)
 
+    while not exit_handler.done:
+        executor.wait()
         try:
-            response = do_request(
-                query=queries.make_pull_requests_query(
-                    world.repo_owner, world.repo_name
-                )
-            )
+            repo_url, pull_requests = fetch_pull_requests(world, snapshot)
         except EnvironmentError as e:
             logger.error(e)
+            executor.shutdown()
             sys.exit(1)
 
-        data = util.get_data(response)
-        repo = util.get_repository(data)
-        repo_url = util.get_repository_url(repo)
-        pull_requests_data = util.get_pull_requests(repo)
-
-        pull_requests = sorted(
-            (
-                PullRequest.from_dict(pr_data)
-                for pr_data in pull_requests_data
-            ),
-            key=lambda pr: not pr.prioritized
-        )
-        for pull_request in pull_requests:
-            for task in process_pull_request(world, pull_request, repo_url):
-                exit_handler.register_task(task)
-                world.available_resources.take(task)
-                logger.info(
-                    "Available resources: %s", world.available_resources
-                )
+        graph = TaskGraph()
+        # Tasks of the PRs left once the executor is full, the boxes are
+        # managed for all the open PRs
+        backlog = TaskGraph()
+        listed_all = False
+        try:
+            for batch in batches(pull_requests, queries.PAGE_SIZE):
+                if exit_handler.done or (executor.full and not manage_boxes):
+                    break
+                world.update_status_snapshot(batch)
                 try:
-                    task.execute(world, pull_request.commit.statuses)
-                except ReferenceError as e:
-                    logger.warning(e)
-                except (EnvironmentError, RuntimeError) as e:
-                    logger.error(e)
-                    sentry_report_exception({"module": "github"})
-                    sleep(ERROR_BACKOFF_TIME)
-                finally:
-                    exit_handler.unregister_task()
-                    world.available_resources.give(task)
-                    logger.info(
-                        "Available resources: %s", world.available_resources
-                    )
-
-        sleep(no_task_backoff_time)
+                    world.prefetch_tasks_files(batch)
+                except EnvironmentError as e:
+                    logger.warning("Failed to prefetch tasks files: %s", e)
+
+                for pull_request in batch:
+                    if exit_handler.done:
+                        break
+                    if executor.full:
+                        for task in backlog_tasks(
+                            world, pull_request, repo_url
+                        ):
+                            backlog.add(pull_request, task)
+                        continue
+                    for task in process_pull_request(
+                        world, pull_request, repo_url
+                    ):
+                        graph.add(pull_request, task)
+            else:
+                listed_all = not exit_handler.done
+        except EnvironmentError as e:
+            logger.error("Failed to fetch pull requests: %s", e)
+
+        schedule(world, graph, selector, executor, exit_handler, warm_pool)
+        if warm_pool is not None:
+            warm_pool.refill()
+        if box_store is not None and listed_all:
+            # Boxes of the PRs which weren't listed could be evicted
+            box_store.evict(
+                keep=referenced_boxes(graph) + referenced_boxes(backlog)
+            )
+        if prefetcher is not None:
+            prefetcher.collect(graph, backlog)
+            prefetcher.refill()
+        idle(executor, receiver, backoff_time)
+
+    executor.shutdown()
+    if warm_pool is not None:
+        warm_pool.shutdown()
+    if prefetcher is not None:
+        prefetcher.shutdown()
+    if receiver is not None:
+        receiver.stop()
 
 
 if __name__ == "__main__":
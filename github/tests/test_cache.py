@@ -0,0 +1,58 @@
+import pytest
+
+import github.internals.cache as c
+
+
+class TestLRUCache(object):
+    def test_eviction(self):
+        cache = c.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        cache.put("c", 3)
+        assert "a" in cache
+        assert "b" not in cache
+        assert len(cache) == 2
+
+    def test_default(self):
+        assert c.LRUCache(1).get("missing", 0) == 0
+
+
+class TestTasksDataCache(object):
+    def test_parse_once(self):
+        calls = []
+
+        def parser(link, content):
+            calls.append(content)
+            return {"build": {"job": {"args": {}}}}
+
+        cache = c.TasksDataCache()
+        assert cache.get("sha1", ".freeipa-pr-ci.yaml") is None
+        cache.parse("sha1", ".freeipa-pr-ci.yaml", parser, b"l", b"jobs")
+        cache.parse("sha2", ".freeipa-pr-ci.yaml", parser, b"l", b"jobs")
+        assert len(calls) == 1
+        assert cache.get("sha2", ".freeipa-pr-ci.yaml") == {
+            "build": {"job": {"args": {}}}
+        }
+
+    def test_copies(self):
+        cache = c.TasksDataCache()
+        cache.parse("sha", "path", lambda *_: {"a": {"b": 1}}, b"x")
+        cache.get("sha", "path")["a"]["b"] = 2
+        assert cache.get("sha", "path") == {"a": {"b": 1}}
+
+    def test_parser_error(self):
+        def parser(content):
+            raise KeyError("jobs")
+
+        cache = c.TasksDataCache()
+        with pytest.raises(KeyError):
+            cache.parse("sha", "path", parser, b"x")
+        assert cache.get("sha", "path") is None
+
+    def test_persistence(self, tmpdir):
+        path = str(tmpdir.join("cache", "tasks.json"))
+        cache = c.TasksDataCache(path=path)
+        cache.parse("sha", "path", lambda *_: {"a": 1}, b"x")
+
+        assert c.TasksDataCache(path=path).get("sha", "path") == {"a": 1}
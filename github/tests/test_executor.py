@@ -0,0 +1,131 @@
+import time
+
+import pytest
+
+import github.internals.entities as e
+import github.internals.executor as ex
+
+
+class RenewingLockBackend(e.LockBackend):
+    renew_interval = 0.01
+
+    def __init__(self):
+        self.renewed = []
+
+    def renew(self, world, task):
+        self.renewed.append(task.name)
+
+
+class FakeWorld(object):
+    repo_owner = "freeipa"
+
+    def __init__(self, lock_backend=None):
+        self.available_resources = e.AvailableResources()
+        self.lock_backend = (
+            lock_backend if lock_backend is not None else e.LockBackend()
+        )
+
+
+class FakeTask(object):
+    name = "fedora-28/build"
+    pr_number = 1
+
+    def __init__(self, job):
+        self.job = job
+        self.topology = e.Topology(memory=1, cpu=1)
+        self.reported = []
+        self.locked = True
+
+    def get_dependencies_results(self, statuses):
+        return {}
+
+    def execute(self, world, statuses):
+        self.report(world, self.job(world.repo_owner, {}))
+
+    def report(self, world, result):
+        self.reported.append(result)
+
+    def unlock(self, world):
+        self.locked = False
+
+
+def succeeding_job(repo_owner, dependencies_results):
+    return e.JobResult(e.State.SUCCESS, repo_owner)
+
+
+def sleeping_job(repo_owner, dependencies_results):
+    time.sleep(0.2)
+    return e.JobResult(e.State.SUCCESS, repo_owner)
+
+
+def crashing_job(repo_owner, dependencies_results):
+    raise ValueError("boom")
+
+
+class TestExecutor(object):
+    @pytest.mark.parametrize("workers,expected", [
+        (1, ex.Executor),
+        (2, ex.ProcessExecutor),
+    ])
+    def test_create_executor(self, workers, expected):
+        executor = ex.create_executor(FakeWorld(), e.ExitHandler(), workers)
+        assert type(executor) is expected
+
+    def test_inline(self):
+        world = FakeWorld()
+        task = FakeTask(succeeding_job)
+        executor = ex.create_executor(world, e.ExitHandler())
+        executor.submit(task, {})
+        assert task.reported[0].state == e.State.SUCCESS
+        assert not task.locked
+        assert world.available_resources.cpu == (
+            e.AvailableResources.initial_cpu
+        )
+
+    def test_renews_locks(self):
+        locks = RenewingLockBackend()
+        task = FakeTask(sleeping_job)
+        executor = ex.create_executor(FakeWorld(locks), e.ExitHandler())
+        executor.submit(task, {})
+        assert task.name in locks.renewed
+
+        # Not renewed once the task is unlocked
+        renewed = len(locks.renewed)
+        time.sleep(0.05)
+        assert len(locks.renewed) == renewed
+
+
+class TestProcessExecutor(object):
+    def test_full(self):
+        world = FakeWorld()
+        exit_handler = e.ExitHandler()
+        executor = ex.ProcessExecutor(world, exit_handler, 1)
+        task = FakeTask(succeeding_job)
+
+        executor.submit(task, {})
+        assert executor.full
+        assert executor.free_slots == 0
+        assert [t for t, _ in executor.running_tasks] == [task]
+        assert task.locked
+        assert exit_handler.tasks == [task]
+        assert world.available_resources.cpu == (
+            e.AvailableResources.initial_cpu - 1
+        )
+
+        executor.shutdown()
+        assert not executor.full
+        assert not task.locked
+        assert exit_handler.tasks == []
+        assert world.available_resources.cpu == (
+            e.AvailableResources.initial_cpu
+        )
+        assert task.reported[0].state == e.State.SUCCESS
+        assert task.reported[0].description == FakeWorld.repo_owner
+
+    def test_crashed_job(self):
+        executor = ex.ProcessExecutor(FakeWorld(), e.ExitHandler(), 2)
+        task = FakeTask(crashing_job)
+        executor.submit(task, {})
+        executor.shutdown()
+        assert task.reported[0].state == e.State.ERROR
+        assert task.reported[0].description == "boom"
@@ -0,0 +1,64 @@
+import pytest
+
+import github.internals.gql.queries as q
+import github.internals.gql.util as u
+
+
+def make_page(numbers, cursor=None):
+    return {"repository": {
+        "url": "https://github.com/freeipa/freeipa",
+        "pullRequests": {
+            "pageInfo": {
+                "hasNextPage": cursor is not None, "endCursor": cursor
+            },
+            "nodes": [{"number": number} for number in numbers]
+        }
+    }}
+
+
+class FakeRequest(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.cursors = []
+
+    def __call__(self, query):
+        cursor = query["query"]
+        self.cursors.append(cursor)
+        return self.pages[cursor]
+
+
+class TestPagination(object):
+    def test_stream(self):
+        request = FakeRequest({
+            None: make_page([1, 2], "c1"),
+            "c1": make_page([3], "c2"),
+            "c2": make_page([]),
+        })
+        stream = u.stream_pull_requests(
+            u.paginate(request, lambda cursor: {"query": cursor}),
+            lambda pr_data: pr_data["number"]
+        )
+
+        # The next page isn't requested before the first one is consumed
+        assert next(stream) == 1
+        assert next(stream) == 2
+        assert request.cursors == [None]
+
+        assert list(stream) == [3]
+        assert request.cursors == [None, "c1", "c2"]
+
+
+class TestPullRequestsQuery(object):
+    @pytest.mark.parametrize("cursor,labels,expected", [
+        (None, None, "pullRequests(first: 50, states: OPEN)"),
+        ("abc", None, 'pullRequests(first: 50, states: OPEN, after: "abc")'),
+        (None, ["prioritized"],
+         'pullRequests(first: 50, states: OPEN, labels: ["prioritized"])'),
+    ])
+    def test_arguments(self, cursor, labels, expected):
+        query = q.make_pull_requests_query(
+            "freeipa", "freeipa", ".freeipa-pr-ci.yaml", cursor, labels
+        )["query"]
+        assert expected in query
+        assert "endCursor" in query
+        assert "labels(first: 100)" in query
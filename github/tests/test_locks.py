@@ -0,0 +1,181 @@
+import pytest
+
+import github.internals.entities as e
+import github.internals.locks as l
+
+
+class FakeWorld(object):
+    repo_owner = "freeipa"
+    repo_name = "freeipa"
+
+    def __init__(self, runner_id="runner", description="unassigned"):
+        self.runner_id = runner_id
+        self.status = e.Status("build", description, e.State.PENDING, "")
+        self.created = []
+
+    def poll_status(self, pr_number, name, max_age=0):
+        return self.status
+
+    def create_status(self, task, state, description):
+        self.created.append(description)
+
+
+class FakeTask(object):
+    name = "fedora-28/build"
+    pr_number = 1
+    commit_sha = "abc"
+
+
+@pytest.fixture(params=["file", "lease"])
+def backends(request, tmpdir):
+    if request.param == "file":
+        return l.FileLock(str(tmpdir)), l.FileLock(str(tmpdir))
+
+    store = l.InMemoryLeaseStore()
+    return l.LeaseLock(store), l.LeaseLock(store)
+
+
+class TestLockBackends(object):
+    def test_exclusive(self, backends):
+        first, second = backends
+        task = FakeTask()
+        world = FakeWorld("first")
+        other_world = FakeWorld("second")
+
+        description = first.acquire(world, task)
+        assert world.created == [description]
+        assert description.startswith("Taken by first")
+
+        with pytest.raises(EnvironmentError):
+            second.acquire(other_world, task)
+        assert other_world.created == []
+
+        first.release(world, task)
+        second.acquire(other_world, task)
+        assert len(other_world.created) == 1
+
+    @pytest.mark.parametrize("state,description", [
+        (e.State.SUCCESS, ""),
+        (e.State.PENDING, "Taken by other on 2018-01-01 10:00 UTC"),
+    ])
+    def test_status_checked(self, backends, state, description):
+        world = FakeWorld()
+        world.status = e.Status("build", description, state, "")
+        with pytest.raises(EnvironmentError):
+            backends[0].acquire(world, FakeTask())
+        assert world.created == []
+
+    def test_status_checked_under_lock(self, backends):
+        first, second = backends
+        world = FakeWorld("first")
+        other_world = FakeWorld("second")
+
+        def poll_status(pr_number, name, max_age=0):
+            # The previous holder finished the task before unlocking
+            with pytest.raises(EnvironmentError):
+                second.acquire(other_world, FakeTask())
+            return e.Status("build", "", e.State.SUCCESS, "")
+
+        world.poll_status = poll_status
+        with pytest.raises(EnvironmentError):
+            first.acquire(world, FakeTask())
+        assert world.created == []
+
+        # Released again
+        second.acquire(other_world, FakeTask())
+        assert len(other_world.created) == 1
+
+    def test_github_status(self, monkeypatch):
+        monkeypatch.setattr(e, "sleep", lambda seconds: None)
+        world = FakeWorld()
+        with pytest.raises(EnvironmentError):
+            # Another runner's status replaced ours meanwhile
+            e.GitHubStatusLock().acquire(world, FakeTask())
+        assert len(world.created) == 1
+
+
+class TestLeaseLock(object):
+    def test_renew(self, monkeypatch):
+        store = l.InMemoryLeaseStore()
+        lock = l.LeaseLock(store, 60)
+        world = FakeWorld("first")
+        monkeypatch.setattr(l, "time", lambda: 1000)
+        lock.acquire(world, FakeTask())
+
+        monkeypatch.setattr(l, "time", lambda: 1050)
+        lock.renew(world, FakeTask())
+        monkeypatch.setattr(l, "time", lambda: 1100)
+        assert store.holder(l.task_key(world, FakeTask())) == "first"
+
+    def test_renew_expired(self, monkeypatch):
+        store = l.InMemoryLeaseStore()
+        world = FakeWorld("first")
+        monkeypatch.setattr(l, "time", lambda: 1000)
+        l.LeaseLock(store, 60).acquire(world, FakeTask())
+
+        # The runner stopped renewing and another one took over
+        monkeypatch.setattr(l, "time", lambda: 1061)
+        l.LeaseLock(store, 60).acquire(FakeWorld("second"), FakeTask())
+        with pytest.raises(EnvironmentError):
+            l.LeaseLock(store, 60).renew(world, FakeTask())
+
+
+class TestInMemoryLeaseStore(object):
+    def test_expired(self, monkeypatch):
+        store = l.InMemoryLeaseStore()
+        monkeypatch.setattr(l, "time", lambda: 1000)
+        assert store.acquire("key", "first", 60)
+        assert not store.acquire("key", "second", 60)
+        assert store.holder("key") == "first"
+
+        monkeypatch.setattr(l, "time", lambda: 1061)
+        assert store.holder("key") is None
+        assert store.acquire("key", "second", 60)
+
+    def test_release_by_owner_only(self):
+        store = l.InMemoryLeaseStore()
+        store.acquire("key", "first", 60)
+        store.release("key", "second")
+        assert store.holder("key") == "first"
+        store.release("key", "first")
+        assert store.holder("key") is None
+
+
+class TestLeaseService(object):
+    def test_http(self):
+        service = l.LeaseService(l.InMemoryLeaseStore(), "127.0.0.1", 0)
+        service.start()
+        try:
+            store = l.HTTPLeaseStore(
+                "http://127.0.0.1:{}/".format(service.server.server_port)
+            )
+            assert store.acquire("freeipa/abc/build", "first", 60)
+            assert not store.acquire("freeipa/abc/build", "second", 60)
+            store.release("freeipa/abc/build", "first")
+            assert store.acquire("freeipa/abc/build", "second", 60)
+        finally:
+            service.stop()
+
+    @pytest.mark.parametrize("method,path,body,expected", [
+        ("PUT", "/other/key", b'{"owner": "a"}', 404),
+        ("PUT", "/leases/key", b'{}', 400),
+        ("PUT", "/leases/key", b'{"owner": "a", "ttl": "x"}', 400),
+        ("POST", "/leases/key", b'{"owner": "a"}', 405),
+    ])
+    def test_invalid(self, method, path, body, expected):
+        service = l.LeaseService(l.InMemoryLeaseStore())
+        assert service.handle(method, path, body) == expected
+
+
+class TestCreateLockBackend(object):
+    @pytest.mark.parametrize("config,expected", [
+        (None, e.GitHubStatusLock),
+        ({"backend": "file", "path": "/tmp"}, l.FileLock),
+        ({"backend": "lease", "url": "http://localhost:8081"}, l.LeaseLock),
+    ])
+    def test_backends(self, config, expected):
+        assert type(l.create_lock_backend(config)) is expected
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            l.create_lock_backend({"backend": "zookeeper"})
@@ -0,0 +1,101 @@
+import pytest
+
+import github.internals.entities as e
+import github.internals.monitor as m
+
+
+DOMSTATS = """Domain: 'abc_master'
+  state.state=1
+  vcpu.current=2
+  vcpu.maximum=2
+  balloon.current=2457600
+  balloon.maximum=2457600
+
+Domain: 'abc_replica'
+  vcpu.current=1
+  balloon.maximum=972800
+"""
+
+
+class FakeMonitor(m.ResourceMonitor):
+    def __init__(self, sample, **kwargs):
+        super(FakeMonitor, self).__init__(**kwargs)
+        self.host_sample = sample
+
+    def capacity(self):
+        return 8 * self.cpu_overcommit, 16000 * self.memory_overcommit
+
+    def sample(self):
+        return self.host_sample
+
+
+def make_task(cpu, memory):
+    task = type("Task", (), {})()
+    task.topology = e.Topology(cpu=cpu, memory=memory)
+    return task
+
+
+class TestResourceMonitor(object):
+    def test_parse_domstats(self):
+        assert m.parse_domstats(DOMSTATS) == (3, 3350)
+
+    def test_idle_host(self):
+        resources = e.AvailableResources(
+            FakeMonitor(m.HostSample(0.5, 15000, 0, 0))
+        )
+        assert resources.free() == (7.5, 15000)
+
+    def test_reservations(self):
+        # The taken task's VMs didn't boot yet, so the host doesn't see
+        # them, the ledger does
+        resources = e.AvailableResources(
+            FakeMonitor(m.HostSample(0, 15000, 0, 0))
+        )
+        resources.take(make_task(4, 6000))
+        assert resources.free() == (4, 9000)
+
+    def test_leaked_domains(self):
+        # Domains nobody reserved (a leaked VM, another runner)
+        resources = e.AvailableResources(
+            FakeMonitor(m.HostSample(1, 9000, 6, 7000))
+        )
+        assert resources.free() == (2, 9000)
+        assert not resources.check(make_task(4, 2000))
+
+    def test_overcommit(self):
+        resources = e.AvailableResources(FakeMonitor(
+            m.HostSample(2, 12000, 2, 4000),
+            cpu_overcommit=2, memory_overcommit=1.5
+        ))
+        assert resources.total_cpu == 16
+        assert resources.free() == (12, 18000)
+
+    def test_libvirt_unavailable(self):
+        monitor = FakeMonitor(m.HostSample(0, 1000))
+        monitor.initial_memory = 10000
+        resources = e.AvailableResources(monitor)
+        # Memory is capped by what was available at the start then
+        assert resources.free() == (8, 10000)
+        resources.take(make_task(2, 4000))
+        assert resources.free() == (6, 6000)
+
+    @pytest.mark.parametrize("config,expected", [
+        (None, (1.0, 1.0, m.RESERVED_MEMORY)),
+        ({"cpu_overcommit": 2, "reserved_memory": 2048}, (2, 1.0, 2048)),
+    ])
+    def test_from_config(self, config, expected):
+        monitor = m.ResourceMonitor.from_config(config)
+        assert (
+            monitor.cpu_overcommit, monitor.memory_overcommit,
+            monitor.reserved_memory
+        ) == expected
+
+    def test_sample_cached(self, monkeypatch):
+        monitor = m.ResourceMonitor()
+        calls = []
+        monkeypatch.setattr(
+            monitor, "sample_libvirt", lambda: calls.append(1) or (None, None)
+        )
+        monitor.sample()
+        monitor.sample()
+        assert len(calls) == 1
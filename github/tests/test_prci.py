@@ -0,0 +1,177 @@
+import os
+import sys
+
+import pytest
+
+# prci.py is a script which imports the internals package as top-level
+GITHUB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GITHUB_DIR)
+import prci  # noqa: E402
+from internals import entities as e  # noqa: E402
+from internals import scheduler as s  # noqa: E402
+
+
+def make_pull_request(number, statuses):
+    return e.PullRequest(number, "me", "master", "MERGEABLE", [], {
+        "oid": "abc",
+        "status": {"contexts": [
+            {"context": name, "description": description,
+             "state": state, "targetUrl": ""}
+            for name, (state, description) in statuses.items()
+        ]}
+    })
+
+
+def make_task_data(name, requires=(), cpu=1):
+    return {
+        "requires": list(requires),
+        "job": {"class": "Build", "args": {
+            "timeout": None,
+            "topology": {"name": name, "cpu": cpu, "memory": 1000},
+        }},
+    }
+
+
+def make_task(pr_number, name, requires=(), cpu=1):
+    return e.Task(
+        name, pr_number, "abc", "me", "", make_task_data(name, requires, cpu),
+        lambda job_data, kwargs: None
+    )
+
+
+UNASSIGNED = ("PENDING", "unassigned")
+SUCCESS = ("SUCCESS", "")
+
+
+class FakeLockBackend(e.LockBackend):
+    def __init__(self, busy=()):
+        self.busy = set(busy)
+        self.attempts = []
+
+    def acquire(self, world, task):
+        self.attempts.append(task.name)
+        if task.name in self.busy:
+            raise EnvironmentError("{} is taken".format(task.name))
+        return "locked"
+
+    def release(self, world, task):
+        pass
+
+
+class FakeWorld(object):
+    def __init__(self, available_resources, lock_backend):
+        self.available_resources = available_resources
+        self.lock_backend = lock_backend
+
+
+class RecordingExecutor(prci.Executor):
+    """Takes the tasks' resources without running them"""
+    def __init__(self, world, exit_handler, slots):
+        super(RecordingExecutor, self).__init__(world, exit_handler)
+        self.slots = slots
+        self.submitted = []
+
+    @property
+    def full(self):
+        return len(self.submitted) >= self.slots
+
+    @property
+    def free_slots(self):
+        return self.slots - len(self.submitted)
+
+    def submit(self, task, statuses):
+        self._start(task)
+        self.submitted.append(task.name)
+
+
+@pytest.fixture()
+def host(monkeypatch):
+    monkeypatch.setattr(e.AvailableResources, "initial_cpu", 8)
+    monkeypatch.setattr(e.AvailableResources, "initial_memory", 16000)
+    monkeypatch.setattr(e.AvailableResources, "jobs_dir", None)
+    monkeypatch.setattr(e.AvailableResources, "pool_dir", None)
+    return e.AvailableResources()
+
+
+def run_schedule(world, graph, slots=4):
+    exit_handler = e.ExitHandler()
+    executor = RecordingExecutor(world, exit_handler, slots)
+    prci.schedule(
+        world, graph, s.BinPackingSelector(), executor, exit_handler
+    )
+    return executor.submitted
+
+
+class TestSchedule(object):
+    def test_locks_ready_tasks(self, host):
+        pr = make_pull_request(1, {
+            "build": SUCCESS, "test": UNASSIGNED, "lint": UNASSIGNED,
+            "deploy": UNASSIGNED,
+        })
+        graph = s.TaskGraph()
+        for task in (
+            make_task(1, "build"),
+            make_task(1, "test", ["build"]),
+            make_task(1, "lint"),
+            make_task(1, "deploy", ["test"]),
+        ):
+            graph.add(pr, task)
+        # Has no status, its author isn't whitelisted
+        graph.add(make_pull_request(2, {}), make_task(2, "build"))
+        locks = FakeLockBackend()
+        world = FakeWorld(host, locks)
+
+        assert sorted(run_schedule(world, graph)) == ["lint", "test"]
+        assert sorted(locks.attempts) == ["lint", "test"]
+        assert host.cpu == 6
+
+    def test_lock_failure_frees_resources(self, host):
+        pr = make_pull_request(1, {
+            "large": UNASSIGNED, "small-1": UNASSIGNED,
+            "small-2": UNASSIGNED,
+        })
+        graph = s.TaskGraph()
+        graph.add(pr, make_task(1, "large", cpu=8))
+        graph.add(pr, make_task(1, "small-1", cpu=4))
+        graph.add(pr, make_task(1, "small-2", cpu=3))
+        # Another runner took the large task
+        locks = FakeLockBackend(busy=["large"])
+        world = FakeWorld(host, locks)
+
+        assert sorted(run_schedule(world, graph)) == ["small-1", "small-2"]
+        assert locks.attempts[0] == "large"
+        assert host.cpu == 1
+
+    def test_full_executor(self, host):
+        pr = make_pull_request(1, {"a": UNASSIGNED, "b": UNASSIGNED})
+        graph = s.TaskGraph()
+        graph.add(pr, make_task(1, "a"))
+        graph.add(pr, make_task(1, "b"))
+        world = FakeWorld(host, FakeLockBackend())
+
+        assert len(run_schedule(world, graph, slots=1)) == 1
+
+
+class TestBacklogTasks(object):
+    def test_statuses_untouched(self, monkeypatch):
+        pr = make_pull_request(1, {"build": SUCCESS})
+        tasks_data = {
+            name: make_task_data(name) for name in ("build", "test")
+        }
+        monkeypatch.setattr(pr, "get_tasks_data", lambda world: tasks_data)
+        monkeypatch.setattr(
+            prci, "JobDispatcher", lambda job_data, kwargs: None
+        )
+        # Nothing is written on GitHub
+        world = object()
+
+        tasks = list(prci.backlog_tasks(world, pr, ""))
+        assert sorted(task.name for task in tasks) == ["build", "test"]
+
+    def test_postponed(self, monkeypatch):
+        pr = make_pull_request(1, {})
+        pr.labels = [e.Label.POSTPONE]
+        monkeypatch.setattr(
+            pr, "get_tasks_data", lambda world: pytest.fail("not needed")
+        )
+        assert list(prci.backlog_tasks(object(), pr, "")) == []
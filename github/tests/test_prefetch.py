@@ -0,0 +1,134 @@
+import os
+
+import pytest
+
+import github.internals.prefetch as p
+from tasks import constants
+from tasks.vagrant import VagrantBox
+
+
+class FakeProcess(object):
+    def __init__(self, target, args):
+        self.job = args[0]
+        self.alive = True
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self):
+        pass
+
+    def terminate(self):
+        self.alive = False
+
+
+class FakeJob(object):
+    def __init__(self, template):
+        self.template = template
+
+
+class FakeNode(object):
+    def __init__(self, template, finished=False):
+        self.task = FakeJob(None)
+        self.task.job = FakeJob(template)
+        self.finished = finished
+
+
+class FakeGraph(object):
+    def __init__(self, *nodes):
+        self.nodes = dict(enumerate(nodes))
+
+
+F27 = ("freeipa/ci-master-f27", "0.1")
+F28 = ("freeipa/ci-master-f28", "0.2")
+
+
+def add_box(box):
+    path = VagrantBox(*box).vagrant_path
+    os.makedirs(os.path.dirname(path))
+    open(path, "w").close()
+
+
+@pytest.fixture()
+def prefetcher(monkeypatch, tmpdir):
+    monkeypatch.setattr(
+        constants, "VAGRANT_IMAGE_PATH",
+        str(tmpdir) + "/{name}/{version}/{provider}/box.img"
+    )
+    monkeypatch.setattr(p.multiprocessing, "Process", FakeProcess)
+    return p.BoxPrefetcher(retry_time=60)
+
+
+class TestBoxPrefetcher(object):
+    def test_most_needed_first(self, prefetcher):
+        prefetcher.collect(FakeGraph(
+            FakeNode(F27), FakeNode(F28), FakeNode(F28), FakeNode(None),
+            FakeNode(F27, finished=True), FakeNode(F27, finished=True)
+        ))
+        assert prefetcher.missing() == [F28, F27]
+
+        prefetcher.refill()
+        assert list(prefetcher.processes) == [F28]
+        assert prefetcher.processes[F28].job.rate == p.BOX_PREFETCH_RATE
+
+        # Concurrency is 1, F27 waits for the running download
+        prefetcher.refill()
+        assert list(prefetcher.processes) == [F28]
+
+    def test_several_graphs(self, prefetcher):
+        prefetcher.collect(
+            FakeGraph(FakeNode(F27)), FakeGraph(FakeNode(F28), FakeNode(F28))
+        )
+        assert prefetcher.missing() == [F28, F27]
+
+    def test_present(self, prefetcher):
+        add_box(F27)
+        prefetcher.collect(FakeGraph(FakeNode(F27)))
+        prefetcher.refill()
+        assert prefetcher.processes == {}
+
+    def test_retry(self, prefetcher, monkeypatch):
+        prefetcher.collect(FakeGraph(FakeNode(F27)))
+        prefetcher.refill()
+        prefetcher.processes[F27].alive = False
+
+        # The process ended without the box
+        now = p.time()
+        prefetcher.refill()
+        assert prefetcher.processes == {}
+        assert prefetcher.failed[F27] >= now
+
+        monkeypatch.setattr(p, "time", lambda: now + 61)
+        prefetcher.refill()
+        assert list(prefetcher.processes) == [F27]
+
+    def test_downloaded(self, prefetcher):
+        prefetcher.collect(FakeGraph(FakeNode(F27)))
+        prefetcher.refill()
+        add_box(F27)
+        prefetcher.processes[F27].alive = False
+        prefetcher.refill()
+        assert prefetcher.processes == {}
+        assert prefetcher.failed == {}
+
+    def test_disabled(self):
+        assert p.BoxPrefetcher.from_config(None) is None
+
+    def test_over_budget(self, prefetcher, monkeypatch):
+        store = p.BoxStore(budget=100)
+        monkeypatch.setattr(store, "usage", lambda: 200)
+        prefetcher.store = store
+        prefetcher.collect(FakeGraph(FakeNode(F27)))
+        prefetcher.refill()
+        assert prefetcher.processes == {}
+
+        monkeypatch.setattr(store, "usage", lambda: 50)
+        prefetcher.refill()
+        assert list(prefetcher.processes) == [F27]
+
+    def test_box_store_config(self):
+        assert p.create_box_store(None) is None
+        assert p.create_box_store({"budget": 0.5}).budget == 512 * 1024 ** 2
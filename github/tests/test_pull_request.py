@@ -77,3 +77,64 @@ class TestPullRequest(object):
     ])
     def test_prioritized(self, test_input, expected):
         assert test_input.prioritized == expected
+
+
+def create_with_link(number, sha, link):
+    return e.PullRequest(
+        number, "me", "master", "MERGEABLE", [], {
+            "oid": sha,
+            "tasksLink": {"object": {"text": link}}
+        }
+    )
+
+
+class TestPrefetchTasksFiles(object):
+    def make_world(self, responses):
+        def graphql_request(query):
+            responses["queries"].append(query["query"])
+            return {"data": {"repository": responses["blobs"]}}
+
+        world = e.World(
+            graphql_request=graphql_request, github_api=None, session=None,
+            repo_owner="freeipa", repo_name="freeipa", runner_id="test",
+            tasks_path=".freeipa-pr-ci.yaml", whitelist=[]
+        )
+        world.check_graphql_limit = lambda: None
+        return world
+
+    def test_prefetch(self):
+        responses = {
+            "queries": [],
+            "blobs": {
+                "pr1": {"text": "jobs:\n  build: {}\n"},
+                "pr2": None,
+            }
+        }
+        world = self.make_world(responses)
+        prs = [
+            create_with_link(1, "sha1", "ipatests/prci_definitions/gating"),
+            create_with_link(2, "sha2", "ipatests/prci_definitions/gating"),
+        ]
+        world.prefetch_tasks_files(prs)
+
+        assert len(responses["queries"]) == 1
+        assert '"sha1:ipatests/prci_definitions/gating"' in (
+            responses["queries"][0]
+        )
+        assert prs[0].get_tasks_data(world) == {"build": {}}
+        assert prs[1].tasks_file_content is None
+
+        # The second cycle is served from the cache
+        world.prefetch_tasks_files([
+            create_with_link(1, "sha1", "ipatests/prci_definitions/gating")
+        ])
+        assert len(responses["queries"]) == 1
+
+    def test_inline_tasks(self):
+        responses = {"queries": [], "blobs": {}}
+        world = self.make_world(responses)
+        pr = create_with_link(1, "sha1", "jobs:\n  build: {}\n")
+        world.prefetch_tasks_files([pr])
+
+        assert responses["queries"] == []
+        assert pr.get_tasks_data(world) == {"build": {}}
@@ -21,3 +21,89 @@ class TestRateLimit(object):
     def test_available(self, test_input, expected):
         assert test_input.available == expected
 
+    def test_from_headers(self):
+        rl = e.RateLimit.from_headers({
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Remaining": "4999",
+            "X-RateLimit-Reset": "1522063348",
+        })
+        assert (rl.limit, rl.remaining, rl.reset_at) == (
+            5000, 4999, 1522063348
+        )
+
+    def test_from_graphql_dict(self):
+        rl = e.RateLimit.from_graphql_dict({
+            "limit": 5000, "cost": 1, "remaining": 4927,
+            "resetAt": "2018-03-26T11:58:24Z"
+        })
+        assert rl.remaining == 4927
+        assert rl.reset_at == 1522065504
+
+
+class TestRateLimitTracker(object):
+    def test_fresh(self):
+        tracker = e.RateLimitTracker()
+        assert tracker.get("core") is None
+        tracker.update("core", e.RateLimit(5000, 100, time() + 60))
+        assert tracker.get("core").remaining == 100
+
+    def test_reset(self):
+        tracker = e.RateLimitTracker()
+        tracker.update("core", e.RateLimit(5000, 100, time() - 1))
+        assert tracker.get("core") is None
+
+    def test_max_age(self):
+        tracker = e.RateLimitTracker(max_age=-1)
+        tracker.update("core", e.RateLimit(5000, 100, time() + 60))
+        assert tracker.get("core") is None
+
+    def test_update_from_headers(self):
+        tracker = e.RateLimitTracker()
+        tracker.update_from_headers({
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Remaining": "10",
+            "X-RateLimit-Reset": str(int(time()) + 60),
+            "X-RateLimit-Resource": "graphql",
+        })
+        tracker.update_from_headers({"Content-Type": "text/plain"})
+        assert tracker.get("graphql").remaining == 10
+        assert tracker.get("core") is None
+
+    def test_update_from_graphql(self):
+        tracker = e.RateLimitTracker()
+        tracker.update_from_graphql({"data": {"rateLimit": {
+            "limit": 5000, "remaining": 42, "resetAt": "2100-01-01T00:00:00Z"
+        }}})
+        tracker.update_from_graphql({"errors": []})
+        assert tracker.get("graphql").remaining == 42
+
+
+class FakeGitHub(object):
+    def __init__(self):
+        self.calls = 0
+        self.session = FakeSession()
+
+    def rate_limit(self):
+        self.calls += 1
+        return {"resources": {"core": {
+            "limit": 5000, "remaining": 4000, "reset": int(time()) + 60
+        }}}
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.hooks = {"response": []}
+
+
+class TestWorldRateLimit(object):
+    def test_api_called_when_stale(self):
+        github_api = FakeGitHub()
+        world = e.World(
+            graphql_request=None, github_api=github_api,
+            session=FakeSession(), repo_owner="freeipa", repo_name="freeipa",
+            runner_id="test", tasks_path="", whitelist=[]
+        )
+        world.check_rest_limit()
+        world.check_rest_limit()
+        assert github_api.calls == 1
+        assert len(github_api.session.hooks["response"]) == 1
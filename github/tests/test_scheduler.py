@@ -0,0 +1,207 @@
+import pytest
+
+import github.internals.entities as e
+import github.internals.scheduler as s
+
+
+def make_pull_request(number, statuses, labels=()):
+    return e.PullRequest(number, "me", "master", "MERGEABLE", list(labels), {
+        "oid": "abc",
+        "status": {"contexts": [
+            {"context": name, "description": description,
+             "state": state, "targetUrl": ""}
+            for name, (state, description) in statuses.items()
+        ]}
+    })
+
+
+def make_task(
+    pr_number, name, requires=(), priority=None, timeout=None, cpu=1,
+    disk=None, io=None
+):
+    task_data = {
+        "requires": list(requires),
+        "job": {"class": "Build", "args": {
+            "timeout": timeout,
+            "topology": {
+                "name": name, "cpu": cpu, "memory": 1000, "disk": disk,
+                "io": io,
+            },
+        }},
+    }
+    if priority is not None:
+        task_data["priority"] = priority
+    return e.Task(
+        name, pr_number, "abc", "me", "", task_data,
+        lambda job_data, kwargs: None
+    )
+
+
+UNASSIGNED = ("PENDING", "unassigned")
+SUCCESS = ("SUCCESS", "")
+
+
+def make_graph(pull_requests):
+    graph = s.TaskGraph()
+    for pull_request, tasks in pull_requests:
+        for task in tasks:
+            graph.add(pull_request, task)
+    return graph
+
+
+class TestTaskGraph(object):
+    def test_ready(self):
+        pr = make_pull_request(1, {
+            "build": SUCCESS, "test": UNASSIGNED, "lint": UNASSIGNED,
+        })
+        graph = make_graph([(pr, [
+            make_task(1, "build"),
+            make_task(1, "test", ["build"]),
+            make_task(1, "lint", ["missing-build"]),
+        ])])
+        invalid = graph.validate()
+        assert [(n.task.name, r) for n, r in invalid] == [
+            ("lint", "requires unknown task missing-build")
+        ]
+        assert [n.task.name for n in graph.ready()] == ["test"]
+
+    def test_cycle(self):
+        pr = make_pull_request(1, {"a": UNASSIGNED, "b": UNASSIGNED})
+        graph = make_graph([(pr, [
+            make_task(1, "a", ["b"]),
+            make_task(1, "b", ["a"]),
+            make_task(1, "c", ["a"]),
+        ])])
+        invalid = {n.task.name: r for n, r in graph.validate()}
+        assert sorted(invalid) == ["a", "b"]
+        assert "dependency cycle" in invalid["a"]
+        assert len(graph) == 1
+
+    def test_failed_definition_isnt_missing(self):
+        # The build's definition couldn't be loaded, but it has a status
+        pr = make_pull_request(1, {
+            "build": ("ERROR", "Wrong job definition"), "test": UNASSIGNED
+        })
+        graph = make_graph([(pr, [make_task(1, "test", ["build"])])])
+        assert graph.validate() == []
+        assert graph.ready() == []
+
+    def test_rank(self):
+        small = make_pull_request(1, {
+            "build": UNASSIGNED, "test": UNASSIGNED,
+        })
+        large = make_pull_request(2, {
+            "build": UNASSIGNED, "test1": UNASSIGNED, "test2": UNASSIGNED,
+        })
+        urgent = make_pull_request(3, {"build": UNASSIGNED})
+        prioritized = make_pull_request(
+            4, {"build": UNASSIGNED}, ["prioritized"]
+        )
+        graph = make_graph([
+            (small, [
+                make_task(1, "build", timeout=600),
+                make_task(1, "test", ["build"], timeout=600),
+            ]),
+            (large, [
+                make_task(2, "build", timeout=600),
+                make_task(2, "test1", ["build"], timeout=600),
+                make_task(2, "test2", ["build"], timeout=7200),
+            ]),
+            (urgent, [make_task(3, "build", priority=50)]),
+            (prioritized, [make_task(4, "build")]),
+        ])
+        graph.validate()
+        ready = graph.ready()
+        assert [n.pr_number for n in ready] == [4, 3, 2, 1]
+        assert ready[2].critical_path == 7800
+        assert ready[2].unblocks == 2
+
+    def test_wrong_priority(self):
+        with pytest.raises(e.JobYAMLError):
+            make_task(1, "build", priority="high")
+
+
+@pytest.fixture()
+def host(monkeypatch):
+    monkeypatch.setattr(e.AvailableResources, "initial_cpu", 8)
+    monkeypatch.setattr(e.AvailableResources, "initial_memory", 16000)
+    monkeypatch.setattr(e.AvailableResources, "jobs_dir", None)
+    monkeypatch.setattr(e.AvailableResources, "pool_dir", None)
+    return e.AvailableResources()
+
+
+def make_ready(*tasks):
+    pr = make_pull_request(1, {task.name: UNASSIGNED for task in tasks})
+    graph = make_graph([(pr, tasks)])
+    graph.validate()
+    return graph.ready()
+
+
+class TestBinPackingSelector(object):
+    def test_fills_host(self, host):
+        ready = make_ready(
+            make_task(1, "a", cpu=5),
+            make_task(1, "b", cpu=4),
+            make_task(1, "c", cpu=4),
+        )
+        selected = s.BinPackingSelector().select(ready, host, 3, now=0)
+        assert sorted(n.task.name for n in selected) == ["b", "c"]
+
+    def test_slots(self, host):
+        ready = make_ready(
+            make_task(1, "a", cpu=2), make_task(1, "b", cpu=2)
+        )
+        selector = s.BinPackingSelector()
+        assert len(selector.select(ready, host, 1, now=0)) == 1
+        assert selector.select(ready, host, 0, now=0) == []
+
+    def test_reservation(self, host):
+        selector = s.BinPackingSelector(starvation_time=100)
+        large = make_task(1, "large", cpu=6)
+        short = make_task(1, "short", cpu=1, timeout=50)
+        long = make_task(1, "long", cpu=1, timeout=500)
+        ready = make_ready(large, short, long)
+        selector.select(ready, host, 4, now=0)
+
+        host.cpu = 4
+        # A running task gives 4 CPUs back at 200 at the latest
+        running = [(200, e.Topology(cpu=4, memory=1000))]
+        selected = selector.select(ready, host, 4, running, now=100)
+        assert [n.task.name for n in selected] == ["short"]
+
+        # Nothing known to give the resources back, so nothing is started
+        assert selector.select(ready, host, 4, now=100) == []
+
+    def test_starved_goes_first(self, host):
+        selector = s.BinPackingSelector(starvation_time=100)
+        ready = make_ready(
+            make_task(1, "large", cpu=6),
+            make_task(1, "small1", cpu=4),
+            make_task(1, "small2", cpu=4),
+        )
+        selector.select(ready, host, 4, now=0)
+        selected = selector.select(ready, host, 4, now=100)
+        assert [n.task.name for n in selected] == ["large"]
+
+    def test_disk(self, host, monkeypatch, tmpdir):
+        monkeypatch.setattr(host, "pool_dir", str(tmpdir))
+        monkeypatch.setattr(e, "available_disk", lambda path: 10000)
+        ready = make_ready(
+            make_task(1, "a", cpu=1, disk=6000),
+            make_task(1, "b", cpu=1, disk=6000),
+            make_task(1, "c", cpu=1, disk=3000),
+        )
+        selected = s.BinPackingSelector().select(ready, host, 3, now=0)
+        assert sorted(n.task.name for n in selected) == ["a", "c"]
+
+    def test_io(self, host):
+        host.io = 3
+        ready = make_ready(
+            make_task(1, "a", cpu=1, io=2), make_task(1, "b", cpu=1, io=2)
+        )
+        selected = s.BinPackingSelector().select(ready, host, 2, now=0)
+        assert len(selected) == 1
+
+    def test_expected_ends(self):
+        task = make_task(1, "build", timeout=600, cpu=2)
+        assert s.expected_ends([(task, 100)]) == [(700, task.topology)]
@@ -0,0 +1,130 @@
+import github.internals.snapshot as s
+
+
+def make_pr(number, updated_at, state="OPEN", sha="abc", contexts=None):
+    return {
+        "number": number,
+        "state": state,
+        "updatedAt": updated_at,
+        "author": {"login": "me"},
+        "baseRefName": "master",
+        "mergeable": "MERGEABLE",
+        "labels": {"nodes": []},
+        "commits": {
+            "nodes": [{
+                "commit": {
+                    "id": "C_{}".format(number),
+                    "oid": sha,
+                    "status": {"contexts": contexts or []}
+                }
+            }]
+        }
+    }
+
+
+def make_context(name, state):
+    return {
+        "context": name, "description": "", "state": state, "targetUrl": ""
+    }
+
+
+def repository_response(nodes):
+    return {"data": {"repository": {
+        "url": "https://github.com/freeipa/freeipa",
+        "pullRequests": {
+            "pageInfo": {"hasNextPage": False, "endCursor": None},
+            "nodes": nodes
+        }
+    }}}
+
+
+class FakeWorld(object):
+    repo_owner = "freeipa"
+    repo_name = "freeipa"
+    tasks_path = ".freeipa-pr-ci.yaml"
+
+    def __init__(self, open_prs, updated_prs, commits=None):
+        self.open_prs = open_prs
+        self.updated_prs = updated_prs
+        self.commits = commits or []
+        self.queries = []
+
+    def check_graphql_limit(self):
+        pass
+
+    def graphql_request(self, query):
+        query = query["query"]
+        self.queries.append(query)
+        if "nodes(ids:" in query:
+            return {"data": {"nodes": self.commits}}
+        if "UPDATED_AT" in query:
+            return repository_response(self.updated_prs)
+        return repository_response(self.open_prs)
+
+
+class TestPullRequestSnapshot(object):
+    def test_full_sync(self):
+        snapshot = s.PullRequestSnapshot()
+        world = FakeWorld(
+            [make_pr(1, "2018-01-01T10:00:00Z")],
+            [make_pr(2, "2018-01-01T12:00:00Z", state="CLOSED")]
+        )
+        prs = snapshot.update(world)
+        assert [pr.number for pr in prs] == [1]
+        assert snapshot.repo_url == "https://github.com/freeipa/freeipa"
+        assert snapshot.watermark.hour == 12
+
+    def test_delta_sync(self):
+        snapshot = s.PullRequestSnapshot()
+        snapshot.update(FakeWorld(
+            [make_pr(1, "2018-01-01T10:00:00Z"),
+             make_pr(2, "2018-01-01T11:00:00Z")],
+            [make_pr(2, "2018-01-01T11:00:00Z")]
+        ))
+
+        world = FakeWorld([], [
+            make_pr(3, "2018-01-01T13:00:00Z"),
+            make_pr(2, "2018-01-01T12:00:00Z", state="MERGED"),
+            make_pr(1, "2018-01-01T10:00:00Z", sha="old"),
+        ], commits=[{
+            "id": "C_1", "oid": "abc",
+            "status": {"contexts": [make_context("build", "SUCCESS")]}
+        }])
+        prs = {pr.number: pr for pr in snapshot.update(world)}
+
+        assert sorted(prs) == [1, 3]
+        # PR 1 is older than the watermark, so only its statuses are updated
+        assert prs[1].commit.sha == "abc"
+        assert prs[1].commit.statuses["build"].succeeded
+        assert snapshot.watermark.hour == 13
+        assert not any(
+            "states: OPEN" in query for query in world.queries
+        )
+
+    def test_periodic_full_sync(self):
+        snapshot = s.PullRequestSnapshot(full_sync_interval=1)
+        world = FakeWorld([make_pr(1, "2018-01-01T10:00:00Z")], [])
+        snapshot.update(world)
+        snapshot.update(world)
+        assert sum("states: OPEN" in query for query in world.queries) == 2
+
+    def test_update_during_full_sync(self):
+        snapshot = s.PullRequestSnapshot()
+        world = FakeWorld(
+            [make_pr(1, "2018-01-01T10:00:00Z")],
+            [make_pr(1, "2018-01-01T10:00:00Z")]
+        )
+        graphql_request = world.graphql_request
+
+        def opened_while_listing(query):
+            response = graphql_request(query)
+            if "states: OPEN" in query["query"]:
+                world.updated_prs = [make_pr(2, "2018-01-01T11:00:00Z")]
+            return response
+
+        world.graphql_request = opened_while_listing
+        assert [pr.number for pr in snapshot.update(world)] == [1]
+        assert snapshot.watermark.hour == 10
+
+        prs = snapshot.update(world)
+        assert sorted(pr.number for pr in prs) == [1, 2]
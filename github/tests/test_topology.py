@@ -1,6 +1,7 @@
 import pytest
 
-from github.internals.entities import Topology
+import github.internals.entities as e
+from github.internals.entities import JobYAMLError, Topology
 
 
 class TestTopology(object):
@@ -13,3 +14,62 @@ class TestTopology(object):
     ])
     def test_from_dict(self, test_input, expected):
         assert Topology.from_dict(test_input) == expected
+
+    @pytest.mark.parametrize("name,vms", [
+        ("build", 1),
+        ("ipaserver", 1),
+        ("master_1repl", 3),
+        ("master_3repl_1client", 6),
+    ])
+    def test_defaults(self, name, vms):
+        topology = Topology(name=name, memory=1, cpu=1)
+        assert topology.io == vms
+        assert topology.disk == vms * e.VM_DISK
+
+    def test_wrong_disk(self):
+        with pytest.raises(JobYAMLError):
+            Topology.from_dict({"name": "topo", "disk": "large"})
+
+
+def make_task(**topology):
+    task = type("Task", (), {})()
+    task.topology = Topology(memory=1, cpu=1, **topology)
+    return task
+
+
+@pytest.fixture()
+def resources(monkeypatch, tmpdir):
+    jobs_dir = tmpdir.mkdir("jobs")
+    monkeypatch.setattr(e.AvailableResources, "jobs_dir", str(jobs_dir))
+    monkeypatch.setattr(
+        e.AvailableResources, "pool_dir", str(tmpdir.mkdir("images"))
+    )
+    monkeypatch.setattr(e, "available_disk", lambda path: 10000)
+    return e.AvailableResources()
+
+
+class TestAvailableResources(object):
+    def test_shared_filesystem(self, resources):
+        # The job's directory and its images add up on one filesystem
+        assert resources.check(make_task(disk=10000 - e.JOB_DISK))
+        assert not resources.check(make_task(disk=10000))
+
+    def test_separate_filesystems(self, resources, monkeypatch):
+        stat = e.os.stat
+        monkeypatch.setattr(e.os, "stat", lambda path: type(
+            "Stat", (), {"st_dev": hash(path)}
+        ) if path == resources.pool_dir else stat(path))
+        assert resources.check(make_task(disk=10000))
+
+    def test_reservations(self, resources):
+        task = make_task(disk=5000, io=2)
+        resources.take(task)
+        assert not resources.check(make_task(disk=5000))
+        assert resources.io == resources.total_io - 2
+        resources.give(task)
+        assert resources.check(make_task(disk=5000))
+        assert resources.io == resources.total_io
+
+    def test_missing_pool(self, resources, tmpdir):
+        resources.pool_dir = str(tmpdir.join("missing"))
+        assert resources.check(make_task(disk=100000))
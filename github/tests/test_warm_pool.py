@@ -0,0 +1,115 @@
+import pytest
+
+import github.internals.entities as e
+import github.internals.warm_pool as w
+from tasks import constants
+from tasks.warm_pool import IDLE, WarmPool
+
+
+class FakeProcess(object):
+    def __init__(self, target, args):
+        self.alive = True
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self):
+        pass
+
+
+class FakeJob(object):
+    warm_pool = True
+    template = ("ci-master-f27", "0.1")
+
+
+class FakeTask(object):
+    def __init__(self, topology_name="master_1repl", cpu=2):
+        self.job = FakeJob()
+        self.topology = e.Topology(topology_name, memory=3000, cpu=cpu)
+
+
+@pytest.fixture()
+def resources(monkeypatch, tmpdir):
+    monkeypatch.setattr(e.AvailableResources, "initial_cpu", 8)
+    monkeypatch.setattr(e.AvailableResources, "initial_memory", 16000)
+    monkeypatch.setattr(e.AvailableResources, "jobs_dir", None)
+    monkeypatch.setattr(e.AvailableResources, "pool_dir", None)
+    monkeypatch.setattr(constants, "JOBS_DIR", str(tmpdir))
+    monkeypatch.setattr(w.multiprocessing, "Process", FakeProcess)
+    return e.AvailableResources()
+
+
+@pytest.fixture()
+def pool(tmpdir):
+    return WarmPool(str(tmpdir.join("state", "warm_pool.json")))
+
+
+class TestWarmPoolManager(object):
+    def test_budget(self, resources, pool):
+        manager = w.WarmPoolManager(resources, pool, size=3, budget=0.5)
+        manager.record(FakeTask())
+        manager.refill()
+        # Two slots of 2 CPUs fill the half of the host
+        assert len(pool.read()) == 2
+        assert resources.cpu == 4
+
+    def test_most_used_pairs(self, resources, pool):
+        manager = w.WarmPoolManager(resources, pool, pairs=1, budget=1)
+        manager.record(FakeTask("master_1repl"))
+        manager.record(FakeTask("ipaserver", cpu=1))
+        manager.record(FakeTask("ipaserver", cpu=1))
+        manager.refill()
+        assert [slot["topology"] for slot in pool.read().values()] == [
+            "ipaserver"
+        ]
+
+    def test_claimed(self, resources, pool, tmpdir):
+        manager = w.WarmPoolManager(resources, pool)
+        manager.record(FakeTask())
+        manager.refill()
+        uuid, = pool.read()
+        tmpdir.mkdir(uuid)
+        manager.processes[uuid].alive = False
+        pool.mark_idle(uuid)
+
+        assert pool.claim("ci-master-f27", "0.1", "master_1repl") == uuid
+        manager.reconcile()
+        assert manager.held == {}
+        assert resources.cpu == 8
+
+    def test_adopt(self, resources, pool):
+        topology = vars(e.Topology("master_1repl", memory=3000, cpu=2))
+        pool.add("idle", "ci-master-f27", "0.1", "master_1repl", topology)
+        pool.mark_idle("idle")
+        pool.add("stale", "ci-master-f27", "0.1", "master_1repl", topology)
+
+        manager = w.WarmPoolManager(resources, pool)
+        # The stale slot's directory is gone, nothing to destroy
+        assert list(manager.held) == ["idle"]
+        assert resources.cpu == 6
+        assert list(pool.read()) == ["idle"]
+        assert pool.read()["idle"]["state"] == IDLE
+
+    def test_disabled(self, resources):
+        assert w.WarmPoolManager.from_config(resources, None) is None
+
+    @pytest.mark.parametrize("job_class,args,key", [
+        ("RunPytest", {}, ("ci-master-f27", "0.1", "master_1repl")),
+        ("RunPytest", {"warm_pool": False}, None),
+        ("RunWebuiTests", {}, None),
+        ("Build", {}, None),
+    ])
+    def test_slot_key(self, job_class, args, key):
+        args.update(
+            template={"name": "ci-master-f27", "version": "0.1"},
+            topology={"name": "master_1repl", "cpu": 2, "memory": 3000}
+        )
+        task = e.Task(
+            "fedora-27/test", 1, "abc", "author", "https://repo",
+            {"requires": [], "job": {"class": job_class, "args": args}},
+            e.JobDispatcher
+        )
+        assert w.WarmPoolManager.slot_key(task) == key
@@ -0,0 +1,103 @@
+import hashlib
+import hmac
+import json
+
+import pytest
+
+import github.internals.webhook as w
+
+
+SECRET = "s3cr3t"
+
+
+def sign(body, digestmod=hashlib.sha256, prefix="sha256"):
+    return "{}={}".format(
+        prefix, hmac.new(SECRET.encode(), body, digestmod).hexdigest()
+    )
+
+
+def pull_request_payload(action="opened", repository="freeipa/freeipa"):
+    return {
+        "action": action,
+        "repository": {"full_name": repository},
+        "pull_request": {"number": 42},
+    }
+
+
+def deliver(receiver, name, payload, signature=None):
+    body = json.dumps(payload).encode()
+    if signature is None:
+        signature = sign(body)
+    return receiver.handle(name, {"X-Hub-Signature-256": signature}, body)
+
+
+@pytest.fixture()
+def receiver():
+    return w.WebhookReceiver(SECRET, "freeipa", "freeipa")
+
+
+class TestVerifySignature(object):
+    def test_sha256(self):
+        body = b"{}"
+        headers = {"X-Hub-Signature-256": sign(body)}
+        assert w.verify_signature(SECRET.encode(), body, headers)
+
+    def test_sha1(self):
+        body = b"{}"
+        headers = {"X-Hub-Signature": sign(body, hashlib.sha1, "sha1")}
+        assert w.verify_signature(SECRET.encode(), body, headers)
+
+    @pytest.mark.parametrize("headers", [
+        {},
+        {"X-Hub-Signature-256": "sha256=deadbeef"},
+    ])
+    def test_invalid(self, headers):
+        assert not w.verify_signature(SECRET.encode(), b"{}", headers)
+
+
+class TestWebhookEvent(object):
+    def test_from_payload(self):
+        event = w.WebhookEvent.from_payload(
+            "pull_request", pull_request_payload()
+        )
+        assert event.name == "pull_request"
+        assert event.action == "opened"
+        assert event.repository == "freeipa/freeipa"
+        assert event.pr_number == 42
+
+    @pytest.mark.parametrize("test_input,expected", [
+        (w.WebhookEvent("pull_request", "opened", "r"), True),
+        (w.WebhookEvent("pull_request", "synchronize", "r"), True),
+        (w.WebhookEvent("pull_request", "closed", "r"), False),
+        (w.WebhookEvent("status", None, "r", description="unassigned"), True),
+        (w.WebhookEvent("status", None, "r", description="Taken by x"), False),
+        (w.WebhookEvent("label", "created", "r"), True),
+        (w.WebhookEvent("issues", "opened", "r"), False),
+    ])
+    def test_relevant(self, test_input, expected):
+        assert test_input.relevant == expected
+
+
+class TestWebhookReceiver(object):
+    def test_queued(self, receiver):
+        assert deliver(receiver, "pull_request", pull_request_payload()) == 202
+        assert deliver(receiver, "pull_request", pull_request_payload()) == 202
+        assert receiver.wait().pr_number == 42
+        # The second event was handled by the same wake up
+        assert receiver.wait() is None
+
+    def test_bad_signature(self, receiver):
+        code = deliver(
+            receiver, "pull_request", pull_request_payload(), "sha256=x"
+        )
+        assert code == 401
+        assert receiver.wait() is None
+
+    @pytest.mark.parametrize("name,payload", [
+        ("pull_request", pull_request_payload(repository="other/freeipa")),
+        ("pull_request", pull_request_payload(action="closed")),
+        ("ping", {"zen": "Keep it logically awesome."}),
+    ])
+    def test_ignored(self, receiver, name, payload):
+        assert deliver(receiver, name, payload) == 204
+        assert receiver.wait() is None
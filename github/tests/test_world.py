@@ -0,0 +1,155 @@
+import pytest
+
+import github.internals.entities as e
+
+
+def make_context(name, state="PENDING", description=""):
+    return {
+        "context": name, "description": description,
+        "state": state, "targetUrl": ""
+    }
+
+
+def make_pull_request(contexts):
+    return {"commits": {"nodes": [{
+        "commit": {"oid": "abc", "status": {"contexts": contexts}}
+    }]}}
+
+
+@pytest.fixture()
+def world(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(e, "sleep", sleeps.append)
+    queries = []
+
+    def graphql_request(query):
+        queries.append(query["query"])
+        return {"data": {"repository": {
+            "pr1": make_pull_request([make_context("build", "SUCCESS")]),
+            "pr2": make_pull_request([make_context("test")]),
+        }}}
+
+    world = e.World(
+        graphql_request=graphql_request, github_api=None, session=None,
+        repo_owner="freeipa", repo_name="freeipa", runner_id="test",
+        tasks_path="", whitelist=[]
+    )
+    world.check_graphql_limit = lambda: None
+    world.queries = queries
+    world.sleeps = sleeps
+    return world
+
+
+class TestPollStatuses(object):
+    def test_single_query(self, world):
+        statuses = world.poll_statuses([
+            (1, "build"), (2, "test"), (2, "missing")
+        ])
+        assert len(world.queries) == 1
+        # The batched query isn't staggered
+        assert world.sleeps == []
+        assert "pr1: pullRequest(number: 1)" in world.queries[0]
+        assert "pr2: pullRequest(number: 2)" in world.queries[0]
+        assert statuses[(1, "build")].succeeded
+        assert statuses[(2, "test")].pending
+        assert (2, "missing") not in statuses
+
+    def test_snapshot(self, world):
+        world.poll_statuses([(1, "build")])
+        status = world.poll_status(1, "build", max_age=60)
+        assert status.succeeded
+        assert len(world.queries) == 1
+
+        world.poll_status(1, "build")
+        assert len(world.queries) == 2
+
+    def test_missing(self, world):
+        with pytest.raises(EnvironmentError):
+            world.poll_status(3, "build")
+
+    def test_seeded_snapshot(self, world):
+        pr = e.PullRequest(
+            1, "me", "master", "MERGEABLE", [], {
+                "oid": "abc",
+                "status": {"contexts": [make_context("lint", "FAILURE")]}
+            }
+        )
+        world.update_status_snapshot([pr])
+        assert world.poll_status(1, "lint", max_age=60).failed
+        assert world.queries == []
+
+
+class TestStatusSnapshot(object):
+    def test_set(self):
+        snapshot = e.StatusSnapshot()
+        status = e.Status("build", "unassigned", e.State.PENDING, "")
+        snapshot.set(1, status)
+        # A single written status doesn't make the PR's statuses known
+        assert snapshot.get(1, 60) is None
+
+        snapshot.update(1, {})
+        snapshot.set(1, status)
+        assert snapshot.get(1, 60) == {"build": status}
+
+
+class FakeHandle(object):
+    def __init__(self, github_api, name):
+        self.github_api = github_api
+        self.name = name
+
+    def refresh(self, conditional=False):
+        self.github_api.calls.append(("refresh", self.name, conditional))
+        return self
+
+    def issue(self, number):
+        self.github_api.calls.append(("issue", number))
+        return FakeHandle(self.github_api, number)
+
+    def create_status(self, *args):
+        self.github_api.calls.append(("create_status",) + args)
+
+    def add_labels(self, *labels):
+        self.github_api.calls.append(("add_labels",) + labels)
+
+
+class FakeGitHub(object):
+    def __init__(self):
+        self.calls = []
+
+    def repository(self, owner, name):
+        self.calls.append(("repository", owner, name))
+        return FakeHandle(self, name)
+
+
+class TestHandles(object):
+    @pytest.fixture()
+    def world(self, world):
+        world.github_api = FakeGitHub()
+        world.check_rest_limit = lambda: None
+        return world
+
+    def test_reused(self, world):
+        task = type("Task", (), {
+            "name": "build", "pr_number": 1, "commit_sha": "abc"
+        })
+        world.create_status(task, e.State.PENDING, "unassigned")
+        world.create_error_status("abc", "build", "broken")
+        world.issue(1).add_labels("re-run")
+        world.issue(1).add_labels("prioritized")
+
+        fetches = [
+            call for call in world.github_api.calls
+            if call[0] in ("repository", "issue")
+        ]
+        assert fetches == [("repository", "freeipa", "freeipa"), ("issue", 1)]
+
+    def test_conditional_refresh(self, world, monkeypatch):
+        monkeypatch.setattr(e, "time", lambda: 1000)
+        world.repository()
+        monkeypatch.setattr(e, "time", lambda: 1000 + e.HANDLE_MAX_AGE)
+        world.repository()
+        world.repository()
+        assert world.github_api.calls == [
+            ("repository", "freeipa", "freeipa"),
+            ("refresh", "freeipa", True),
+        ]
@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+"""Rebuilds the root jobs index in the S3 bucket from the DynamoDB table
+
+The runners add every finished job to its month and PR shards of the index
+(see tasks/remote_storage.py). This scans the whole PRCI_JOB_RUN table,
+writes the job items of all the shards again and renders all the shards and
+the top page, it's meant for recovery only: lost job items or damaged
+pages, or the first deployment of the sharded index.
+
+Run from the repository root with the bucket's AWS credentials:
+
+PYTHONPATH=. scripts/rebuild_root_index.py
+"""
+
+from tasks.remote_storage import rebuild_jobs_root_index
+
+
+def main():
+    shards = rebuild_jobs_root_index()
+    print("Rewrote {} shards of the root jobs index".format(shards))
+
+
+if __name__ == "__main__":
+    main()
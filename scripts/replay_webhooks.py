@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+"""Replays recorded GitHub webhook deliveries against a runner
+
+Every recorded file is a JSON object with the event name and its payload:
+
+{"event": "pull_request", "payload": {"action": "opened", ...}}
+
+Payloads are signed with the given secret the same way GitHub does it.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import sys
+
+import requests
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Post recorded webhook payloads to a PR CI runner')
+    parser.add_argument(
+        'files', nargs='+',
+        help='JSON files with recorded deliveries')
+    parser.add_argument(
+        '--url', default='http://localhost:8080/',
+        help='URL of the runner webhook receiver')
+    parser.add_argument(
+        '--secret', required=True,
+        help='Webhook secret configured on the runner')
+
+    return parser.parse_args()
+
+
+def replay(url, secret, path):
+    with open(path) as delivery_file:
+        delivery = json.load(delivery_file)
+
+    body = json.dumps(delivery['payload']).encode()
+    signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    response = requests.post(url, data=body, headers={
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': delivery['event'],
+        'X-Hub-Signature-256': 'sha256={}'.format(signature),
+    })
+    print('{}: {} {}'.format(path, delivery['event'], response.status_code))
+
+    return response.ok
+
+
+def main():
+    args = parse_args()
+    results = [replay(args.url, args.secret, path) for path in args.files]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
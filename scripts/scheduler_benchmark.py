@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+"""Compares the runner's task selection policies on a simulated host
+
+A stream of PRs arrives at the runner, every PR has a build followed by
+test jobs of various topologies. The simulation runs the same workload
+with the first-fit selection (take the ready tasks in their order and
+skip the ones which don't fit) and with BinPackingSelector and reports
+the host utilisation while tasks are waiting and the waiting times.
+
+Run from the repository root:
+
+PYTHONPATH=. scripts/scheduler_benchmark.py
+"""
+
+import argparse
+import heapq
+import random
+from collections import namedtuple
+
+from github.internals.entities import AvailableResources, Topology
+from github.internals.scheduler import BinPackingSelector
+
+# Topologies and run times (minutes) of the jobs in the tasks files
+JOBS = [
+    (Topology("build", 3800, 2), (20, 30)),
+    (Topology("ipaserver", 2400, 1), (20, 60)),
+    (Topology("master_1repl", 5750, 4), (30, 90)),
+    (Topology("master_1repl_1client", 6700, 4), (40, 100)),
+    (Topology("master_2repl_1client", 8000, 5), (60, 120)),
+    (Topology("master_3repl_1client", 10150, 6), (60, 150)),
+]
+
+# Jobs of topologies with at least this many CPUs are considered large
+LARGE_CPU = 5
+
+Result = namedtuple(
+    "Result", "cpu memory makespan mean_wait max_wait large_wait"
+)
+
+
+class Usage(object):
+    """Integrates the used resources while some task is waiting
+
+    Idle resources only count against the selection if there's a ready
+    task which could use them, so the periods with an empty queue are
+    left out.
+    """
+    def __init__(self):
+        self.cpu = self.memory = self.time = 0
+        self.last = 0
+
+    def account(self, now, resources, args, backlog):
+        if backlog:
+            period = now - self.last
+            self.cpu += (args.cpu - resources.cpu) * period
+            self.memory += (args.memory - resources.memory) * period
+            self.time += period
+        self.last = now
+
+
+class SimPullRequest(object):
+    def __init__(self, number, prioritized=False):
+        self.number = number
+        self.prioritized = prioritized
+
+
+class SimTask(object):
+    def __init__(self, name, topology, duration, timeout, requires):
+        self.name = name
+        self.topology = topology
+        self.duration = duration
+        self.timeout = timeout
+        self.dependencies = requires
+
+
+class SimNode(object):
+    def __init__(self, pull_request, task):
+        self.pull_request = pull_request
+        self.task = task
+        self.ready_since = None
+
+    @property
+    def pr_number(self):
+        return self.pull_request.number
+
+    @property
+    def key(self):
+        return self.pr_number, self.task.name
+
+    @property
+    def cost(self):
+        return self.task.timeout
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare first-fit and bin-packing task selection')
+    parser.add_argument(
+        '--prs', type=int, default=200,
+        help='Number of simulated pull requests')
+    parser.add_argument(
+        '--interval', type=float, default=130,
+        help='Mean time between two PRs in minutes')
+    parser.add_argument(
+        '--cpu', type=int, default=16,
+        help='CPUs of the simulated host')
+    parser.add_argument(
+        '--memory', type=float, default=32000,
+        help='Memory of the simulated host in MB')
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='Maximum number of parallel jobs')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed of the workload generator')
+
+    return parser.parse_args()
+
+
+def generate_workload(args):
+    rng = random.Random(args.seed)
+    arrival = 0
+    workload = []
+    for number in range(args.prs):
+        arrival += rng.expovariate(1 / args.interval)
+        pull_request = SimPullRequest(number)
+        topology, (low, high) = JOBS[0]
+        nodes = [SimNode(pull_request, SimTask(
+            "build", topology, rng.uniform(low, high), high * 60, []
+        ))]
+        for index in range(rng.randint(2, 6)):
+            topology, (low, high) = rng.choice(JOBS[1:])
+            nodes.append(SimNode(pull_request, SimTask(
+                "test{}".format(index), topology, rng.uniform(low, high),
+                high * 60, ["build"]
+            )))
+        workload.append((arrival, nodes))
+
+    return workload
+
+
+def first_fit(ready, resources, slots, running, now):
+    selected = []
+    cpu, memory = resources.cpu, resources.memory
+    for node in ready:
+        if len(selected) == slots:
+            break
+        topology = node.task.topology
+        if topology.cpu <= cpu and topology.memory <= memory:
+            selected.append(node)
+            cpu -= topology.cpu
+            memory -= topology.memory
+
+    return selected
+
+
+def simulate(args, workload, select):
+    resources = AvailableResources()
+    resources.cpu, resources.memory = args.cpu, args.memory
+
+    events = []
+    for index, (arrival, nodes) in enumerate(workload):
+        heapq.heappush(events, (arrival, index, "arrival", nodes))
+
+    pending = []
+    done = set()
+    running = {}
+    waits = []
+    large_waits = [0]
+    usage = Usage()
+    backlog = False
+    now = 0
+    sequence = len(workload)
+    while events:
+        now, _, kind, payload = heapq.heappop(events)
+        usage.account(now, resources, args, backlog)
+        if kind == "arrival":
+            pending.extend(payload)
+        else:
+            del running[payload]
+            resources.give(payload.task)
+            done.add(payload.key)
+
+        ready = []
+        for node in pending:
+            if all((node.pr_number, d) in done
+                   for d in node.task.dependencies):
+                if node.ready_since is None:
+                    node.ready_since = now
+                ready.append(node)
+        # Builds unblock the tests, the runner ranks them first as well
+        ready.sort(key=lambda node: (
+            bool(node.task.dependencies), node.pr_number, node.task.name
+        ))
+
+        # The selector works with seconds, the simulation with minutes
+        selected = select(
+            ready, resources, args.workers - len(running),
+            [(end * 60, node.task.topology)
+             for node, end in running.items()],
+            now * 60
+        )
+        backlog = len(selected) < len(ready)
+        for node in selected:
+            pending.remove(node)
+            resources.take(node.task)
+            running[node] = now + node.task.timeout / 60
+            waits.append(now - node.ready_since)
+            if node.task.topology.cpu >= LARGE_CPU:
+                large_waits.append(now - node.ready_since)
+            sequence += 1
+            heapq.heappush(
+                events, (now + node.task.duration, sequence, "finish", node)
+            )
+
+    return Result(
+        cpu=usage.cpu / (args.cpu * usage.time),
+        memory=usage.memory / (args.memory * usage.time),
+        makespan=now,
+        mean_wait=sum(waits) / len(waits),
+        max_wait=max(waits),
+        large_wait=max(large_waits),
+    )
+
+
+def main():
+    args = parse_args()
+    AvailableResources.initial_cpu = args.cpu
+    AvailableResources.initial_memory = args.memory
+    # The simulated host's disks are unlimited
+    AvailableResources.jobs_dir = AvailableResources.pool_dir = None
+
+    results = [
+        ("first-fit", simulate(args, generate_workload(args), first_fit)),
+        ("bin-packing", simulate(
+            args, generate_workload(args), BinPackingSelector().select
+        )),
+    ]
+
+    print("{:<12} {:>6} {:>7} {:>9} {:>10} {:>10} {:>10}".format(
+        "policy", "cpu", "memory", "makespan", "mean wait", "max wait",
+        "max large"))
+    for name, result in results:
+        print("{:<12} {:>5.1f}% {:>6.1f}% {:>8.0f}m {:>9.1f}m {:>9.1f}m "
+              "{:>9.1f}m".format(
+                  name, result.cpu * 100, result.memory * 100,
+                  result.makespan, result.mean_wait, result.max_wait,
+                  result.large_wait))
+
+
+if __name__ == '__main__':
+    main()
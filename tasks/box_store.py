@@ -0,0 +1,176 @@
+"""
+Disk budget of the vagrant boxes.
+
+Boxes are downloaded to ~/.vagrant.d/boxes and linked to the libvirt pool
+by the jobs (see VagrantBoxDownload), every template version and
+provisioned image takes several GB. The store records when the jobs last
+used each box and the runner evicts the least recently used ones, the box
+together with its libvirt copy, when they take more than the budget.
+
+A box is never evicted while it's in use: the jobs hold a shared lease of
+the box until their VMs are destroyed and the eviction only takes the boxes
+it gets an exclusive lease of. The VMs of the warm pool slots outlive their
+jobs, so the boxes of the registered slots are kept as well, and a job
+claiming a slot leases its box before the slot leaves the registry. A job
+which needs a box being evicted waits for the eviction and downloads it
+again.
+"""
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import subprocess
+from time import time
+
+from . import constants
+from .vagrant import VagrantBox
+from .warm_pool import WarmPool
+
+
+class BoxStore(object):
+    def __init__(self, path=constants.BOX_STORE_REGISTRY, budget=None):
+        """
+        budget: bytes the boxes may take, None for no limit
+        """
+        self.path = path
+        self.budget = budget
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Yield the last use times by box, changes are saved on exit.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            used = self.read()
+            yield used
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as file_:
+                json.dump(used, file_)
+            os.rename(tmp_path, self.path)
+
+    def read(self):
+        try:
+            with open(self.path) as file_:
+                return json.load(file_)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def key(box):
+        return '{name} {version}'.format(name=box.name, version=box.version)
+
+    def touch(self, box):
+        with self.locked() as used:
+            used[self.key(box)] = time()
+
+    @staticmethod
+    def boxes():
+        """
+        The libvirt boxes downloaded to the host.
+        """
+        pattern = constants.VAGRANT_IMAGE_PATH.format(
+            name='*', version='*', provider='libvirt')
+        boxes = []
+        for path in glob.glob(pattern):
+            escaped_name, version = path.split(os.sep)[-4:-2]
+            boxes.append(VagrantBox(
+                escaped_name.replace('-VAGRANTSLASH-', '/'), version))
+        return boxes
+
+    @staticmethod
+    def size(box):
+        """
+        Disk space of the box, its libvirt copy is a hard link.
+        """
+        box_dir = os.path.dirname(box.vagrant_path)
+        size = 0
+        for name in os.listdir(box_dir):
+            size += os.lstat(os.path.join(box_dir, name)).st_blocks * 512
+        return size
+
+    def usage(self):
+        return sum(self.size(box) for box in self.boxes())
+
+    def over_budget(self):
+        return self.budget is not None and self.usage() > self.budget
+
+    def last_used(self, box, used):
+        """
+        The boxes no job used yet (e.g. prefetched) count as used when they
+        were downloaded.
+        """
+        try:
+            return used[self.key(box)]
+        except KeyError:
+            return os.stat(box.vagrant_path).st_mtime
+
+    @staticmethod
+    def warm_pool_boxes():
+        slots = WarmPool(constants.WARM_POOL_REGISTRY).read()
+        return {
+            '{} {}'.format(*slot['template']) for slot in slots.values()
+        }
+
+    def remove(self, box):
+        subprocess.check_call(
+            ['vagrant', 'box', 'remove', '--force',
+             '--box-version', box.version, '--provider', box.provider,
+             box.name],
+            stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+            timeout=constants.BOX_STORE_TIMEOUT)
+        if box.libvirt_exists():
+            os.unlink(box.libvirt_path)
+            subprocess.check_call(
+                ['virsh', 'pool-refresh', 'default'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                timeout=constants.BOX_STORE_TIMEOUT)
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used boxes until the rest fits the
+        budget, the boxes in use are skipped.
+
+        keep: (name, version) pairs of the boxes to keep anyway
+
+        Returns the disk space the boxes take.
+        """
+        sizes = {self.key(box): self.size(box) for box in self.boxes()}
+        total = sum(sizes.values())
+        if self.budget is None or total <= self.budget:
+            return total
+
+        keep = {'{} {}'.format(*box) for box in keep}
+        keep |= self.warm_pool_boxes()
+        with self.locked() as used:
+            for box in sorted(
+                    self.boxes(), key=lambda box: self.last_used(box, used)):
+                if total <= self.budget:
+                    break
+                key = self.key(box)
+                if key in keep:
+                    continue
+
+                lease = box.lease(exclusive=True)
+                if lease is None:
+                    continue
+                try:
+                    self.remove(box)
+                except (OSError, subprocess.SubprocessError) as exc:
+                    logging.warning('Failed to evict box %s: %s', key, exc)
+                    continue
+                finally:
+                    lease.close()
+
+                logging.info('Evicted box %s', key)
+                total -= sizes.get(key, 0)
+                used.pop(key, None)
+
+        if total > self.budget:
+            logging.warning(
+                'Boxes in use take %d bytes, over the budget of %d',
+                total, self.budget)
+        return total
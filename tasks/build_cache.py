@@ -0,0 +1,198 @@
+"""
+Content addressed cache of build results.
+
+A build only depends on the source tree, on the template box it runs in and
+on the build playbooks. Rebased PRs without conflicts and the nightly PRs
+opened on the same base build the very same tree, so the key of the cache is
+the tree hash of the built revision together with the template and a digest
+of the playbooks. The value is the URL of the job which published the RPMs.
+
+The index is kept locally and in the S3 bucket, so the runners share it.
+Cached URLs are checked before they're reused, a build whose job directory
+disappeared from the bucket is built again.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+import boto3
+import botocore.exceptions
+
+from . import constants
+
+
+def builder_digest(paths=constants.BUILD_CACHE_PLAYBOOKS):
+    """
+    Digest of the playbooks and roles which make the build, a change in them
+    invalidates all the cached builds.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(path)
+                for name in names
+            )
+        for file_path in files:
+            digest.update(os.path.relpath(file_path, path).encode())
+            with open(file_path, 'rb') as file_:
+                digest.update(file_.read())
+
+    return digest.hexdigest()
+
+
+class BuildCache(object):
+    """
+    Maps the build keys to the URLs of the published builds.
+    """
+    def __init__(self, index_path=constants.BUILD_CACHE_INDEX,
+                 git_dir=constants.BUILD_CACHE_GIT_DIR,
+                 bucket=constants.CLOUD_BUCKET):
+        self.index_path = index_path
+        self.git_dir = git_dir
+        self.bucket = bucket
+
+    def git(self, *args):
+        return subprocess.check_output(
+            ['git', '--git-dir', self.git_dir] + list(args),
+            stderr=subprocess.STDOUT,
+            timeout=constants.BUILD_CACHE_GIT_TIMEOUT
+        ).decode('utf-8').strip()
+
+    def tree_hash(self, git_repo, git_refspec=None, git_version=None):
+        """
+        Resolve the tree the build would check out, the same way the clone
+        in the build playbook does. Only the head commit is fetched, the
+        objects of earlier fetches are reused.
+
+        The jobs share the git dir, so every call fetches into a ref of its
+        own instead of FETCH_HEAD and deletes it afterwards. Git refuses
+        concurrent shallow fetches, they're serialized with a lock.
+
+        Returns None when the tree can't be resolved.
+        """
+        if git_refspec is not None:
+            ref, revision = git_refspec, git_version
+        else:
+            ref, revision = git_version or 'master', None
+        local_ref = 'refs/prci/{}'.format(uuid.uuid4())
+
+        try:
+            os.makedirs(os.path.dirname(self.git_dir), exist_ok=True)
+            with open(self.git_dir + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if not os.path.isdir(self.git_dir):
+                    self.git('init', '--bare', '--quiet')
+                self.git('fetch', '--quiet', '--depth=1', git_repo,
+                         '+{}:{}'.format(ref, local_ref))
+            try:
+                return self.git('rev-parse', '{}^{{tree}}'.format(
+                    revision or local_ref))
+            finally:
+                self.git('update-ref', '-d', local_ref)
+        except (OSError, subprocess.SubprocessError) as exc:
+            logging.warning('Failed to resolve tree of %s: %s', ref, exc)
+            return None
+
+    @staticmethod
+    def key(tree, template_name, template_version, digest=None):
+        if digest is None:
+            digest = builder_digest()
+        return hashlib.sha256('\n'.join([
+            tree, template_name, template_version, digest
+        ]).encode()).hexdigest()
+
+    def read_index(self):
+        try:
+            with open(self.index_path) as file_:
+                return json.load(file_)
+        except (OSError, ValueError):
+            return {}
+
+    def update_index(self, key, url):
+        """
+        Set (or drop, when url is None) the key in the local index. The jobs
+        running in parallel update it under a lock.
+        """
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with open(self.index_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = self.read_index()
+            if url is None:
+                index.pop(key, None)
+            else:
+                index[key] = url
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as file_:
+                json.dump(index, file_)
+            os.rename(tmp_path, self.index_path)
+
+    def cloud_key(self, key):
+        return os.path.join(constants.CLOUD_BUILDS_DIR, key + '.json')
+
+    def read_cloud(self, key):
+        try:
+            response = boto3.client('s3').get_object(
+                Bucket=self.bucket, Key=self.cloud_key(key))
+            return json.loads(response['Body'].read().decode())['url']
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError,
+                ValueError, KeyError) as exc:
+            logging.debug('Build %s not found in the cloud: %s', key, exc)
+            return None
+
+    def write_cloud(self, key, url):
+        try:
+            boto3.client('s3').put_object(
+                Body=json.dumps({'url': url}).encode(),
+                Bucket=self.bucket, Key=self.cloud_key(key),
+                ContentType='application/json')
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError) as exc:
+            logging.warning('Failed to share cached build %s: %s', key, exc)
+
+    @staticmethod
+    def published(url):
+        """
+        Check the build's repo file is still there.
+        """
+        repo_url = urllib.parse.urljoin(
+            url + '/', 'rpms/' + constants.FREEIPA_PRCI_REPOFILE)
+        request = urllib.request.Request(repo_url, method='HEAD')
+        try:
+            with urllib.request.urlopen(
+                    request, timeout=constants.BUILD_CACHE_HTTP_TIMEOUT):
+                return True
+        except (urllib.error.URLError, OSError) as exc:
+            logging.info('Cached build %s is gone: %s', url, exc)
+            return False
+
+    def lookup(self, key):
+        """
+        Return the URL of the published build or None.
+        """
+        url = self.read_index().get(key)
+        if url is None:
+            url = self.read_cloud(key)
+            if url is None:
+                return None
+
+        if not self.published(url):
+            self.update_index(key, None)
+            return None
+
+        self.update_index(key, url)
+        return url
+
+    def store(self, key, url):
+        self.update_index(key, url)
+        self.write_cloud(key, url)
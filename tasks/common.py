@@ -1,11 +1,16 @@
 import abc
+import codecs
 import collections
 import errno
+import gzip
+import heapq
+import itertools
 import logging
 import os
 import signal
 import subprocess
 import threading
+from time import monotonic, sleep
 from typing import Callable, List, Text
 
 import jinja2
@@ -14,6 +19,7 @@ import psutil
 from . import constants
 
 LOG_FILE_HANDLER = None
+JOB_SCOPE = None
 LOG_FORMAT = '%(asctime)-15s %(levelname)8s  %(message)s'
 
 
@@ -47,6 +53,135 @@ class PopenException(TaskException):
         super(PopenException, self).__init__(task)
         self.msg = 'exited with error code {error}'.format(
             error=self.task.returncode)
+        # Last output of the process, it's not a part of the message which
+        # ends up in the commit status
+        self.tail = self.task.tail.getvalue()
+
+
+class OutputTail(object):
+    """
+    Ring buffer with the last size bytes of a process' output.
+    """
+    def __init__(self, size=constants.POPEN_TAIL_SIZE):
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        data = b''.join(self.chunks)[-self.size:]
+        return data.decode('utf-8', errors='replace')
+
+
+class LogFileSink(object):
+    """
+    Writes the output of the processes right into the job's log file,
+    between the records of the log.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        # Characters can be split between the chunks
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def write(self, data):
+        self.handler.acquire()
+        try:
+            self.handler.stream.write(self.decoder.decode(data))
+            self.handler.flush()
+        finally:
+            self.handler.release()
+
+
+def output_sink():
+    """
+    The job's log file, None outside of jobs.
+    """
+    if LOG_FILE_HANDLER is None or LOG_FILE_HANDLER.stream is None:
+        return None
+    return LogFileSink(LOG_FILE_HANDLER)
+
+
+class Watchdog(object):
+    """
+    Terminates the tasks which run past their deadlines.
+
+    Tasks run on the thread which calls them, a single watchdog thread
+    sleeps until the earliest registered deadline and terminates the task.
+    Cancelled deadlines stay in the heap until they come up.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, deadline, task):
+        """
+        Register the deadline (in monotonic time) of the task, returns the
+        entry to cancel it with.
+        """
+        # A forked process (e.g. a job) doesn't inherit the thread
+        if self.pid != os.getpid():
+            self.reset()
+
+        entry = [deadline, next(self.counter), task]
+        with self.condition:
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name='watchdog', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self.condition:
+            entry[2] = None
+
+    def next_expired(self):
+        with self.condition:
+            while True:
+                while self.heap and self.heap[0][2] is None:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                return heapq.heappop(self.heap)[2]
+
+    def run(self):
+        while True:
+            task = self.next_expired()
+            try:
+                task.expire()
+            except Exception as exc:
+                logging.error('Failed to terminate {task}: {exc}'.format(
+                    task=task, exc=exc))
+                logging.debug(exc, exc_info=True)
+
+
+WATCHDOG = Watchdog()
+RUNNING_TASKS = threading.local()
+
+
+def running_task():
+    """
+    The innermost task running on the current thread.
+    """
+    stack = getattr(RUNNING_TASKS, 'stack', None)
+    return stack[-1] if stack else None
 
 
 class Task(collections.Callable):
@@ -55,7 +190,8 @@ class Task(collections.Callable):
     def __init__(self, timeout=120):
         self.timeout = timeout
         self.tasks = []
-        self.exc = None
+        self.deadline = None
+        self.expired = False
 
     def execute_subtask(self, task):
         """
@@ -86,29 +222,56 @@ class Task(collections.Callable):
             task.terminate()
         self._terminate()
 
-    def __target(self):
-        self.exc = None
+    def expire(self):
+        """
+        Called by the watchdog once the task's deadline passed.
+        """
+        self.expired = True
+        self.terminate()
+
+    def __deadline(self, parent):
+        """
+        Registers the task's deadline unless its parent's one comes first.
+        The subtasks of an expired task (e.g. cleanups) keep their own.
+        """
+        inherited = None
+        if parent is not None and not parent.expired:
+            inherited = parent.deadline
+
+        self.deadline = inherited
+        if self.timeout is None:
+            return None
+        deadline = monotonic() + self.timeout
+        if inherited is not None and inherited <= deadline:
+            return None
+        self.deadline = deadline
+        return WATCHDOG.add(deadline, self)
+
+    def __call__(self):
+        logging.info('Executing: {task}'.format(task=self))
+        self.expired = False
+        parent = running_task()
+        entry = self.__deadline(parent)
+        if not hasattr(RUNNING_TASKS, 'stack'):
+            RUNNING_TASKS.stack = []
+        RUNNING_TASKS.stack.append(self)
         try:
             try:
                 self._before()
                 self._run()
             finally:
                 self._after()
-        except Exception as exc:
-            self.exc = exc
-
-    def __call__(self):
-        logging.info('Executing: {task}'.format(task=self))
-        thread = threading.Thread(target=self.__target)
-        thread.start()
-        thread.join(self.timeout)
-        if thread.is_alive():
-            self.terminate()
-            thread.join()
+        except Exception:
+            # Terminated processes fail, the timeout is what happened
+            if not self.expired:
+                raise
+        finally:
+            RUNNING_TASKS.stack.pop()
+            if entry is not None:
+                WATCHDOG.cancel(entry)
+
+        if self.expired:
             raise TimeoutException(self)
-        if self.exc is not None:
-            # Re-raise exception from other thread
-            raise self.exc
 
     def __str__(self):
         return type(self).__name__
@@ -131,44 +294,86 @@ class FallibleTask(Task):
 
 
 class PopenTask(FallibleTask):
-    def __init__(self, cmd, shell=False, env=None, **kwargs):
+    def __init__(self, cmd, shell=False, env=None, sink=None, **kwargs):
+        """
+        sink: file-like object the output is written to, the job's log file
+              by default (the output is logged outside of jobs)
+        """
         super(PopenTask, self).__init__(**kwargs)
         self.cmd = cmd
         self.shell = shell
         self.env = env
+        self.sink = sink
         self.process = None
         self.returncode = None
+        self.tail = OutputTail()
+        # The watchdog can terminate the task before the process starts
+        self.process_lock = threading.Lock()
+        self.terminated = False
         if self.env is not None:
             self.env = os.environ.copy()
             self.env.update(env)
 
     def _run(self):
-        self.process = subprocess.Popen(
-            self.cmd,
-            shell=self.shell,
-            env=self.env,
-            preexec_fn=os.setsid,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-
-        for line in iter(self.process.stdout.readline, b''):
-            logging.debug(line.decode('utf-8').rstrip('\n'))
-
+        with self.process_lock:
+            if self.terminated:
+                raise TaskException(self, 'terminated before it started')
+            self.process = subprocess.Popen(
+                self.cmd,
+                shell=self.shell,
+                env=self.env,
+                preexec_fn=self.preexec(JOB_SCOPE),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+
+        self.stream_output(self.process.stdout.fileno())
         self.process.wait()
-        self.returncode = self.process.returncode
-        self.process = None
+        with self.process_lock:
+            self.returncode = self.process.returncode
+            self.process = None
         if self.returncode != 0:
             raise PopenException(self)
 
+    @staticmethod
+    def preexec(scope):
+        """
+        The child gets its own session, so it can be killed with all its
+        children, and joins the job's scope.
+        """
+        def start_child():
+            os.setsid()
+            if scope is not None:
+                scope.enter()
+        return start_child
+
+    def stream_output(self, fd):
+        sink = self.sink if self.sink is not None else output_sink()
+        self.tail = OutputTail()
+        while True:
+            chunk = os.read(fd, constants.POPEN_CHUNK_SIZE)
+            if not chunk:
+                break
+            self.tail.write(chunk)
+            if sink is not None:
+                sink.write(chunk)
+            else:
+                logging.debug(
+                    chunk.decode('utf-8', errors='replace').rstrip('\n'))
+
     def _terminate(self):
-        if self.process is None:
-            return
+        with self.process_lock:
+            self.terminated = True
+            if self.process is None:
+                return
 
-        # Make sure every child process is gone
-        os.killpg(self.process.pid, signal.SIGKILL)
-        # Make sure every Vagrant process and VM process is gone
-        kill_vagrant_processes()
-        kill_vagrant_vms()
+            # Make sure every child process is gone
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        # Make sure every process and VM of the job is gone
+        if JOB_SCOPE is not None:
+            JOB_SCOPE.kill()
 
     def __str__(self):
         if not isinstance(self.cmd, str):
@@ -190,11 +395,35 @@ def logging_init_stream_handler(noout=False):
     logger.addHandler(ch)
 
 
+class GzipFileHandler(logging.FileHandler):
+    """
+    Writes the log compressed. Every flush ends a deflate block, so the log
+    is flushed at most every LOG_FLUSH_INTERVAL seconds and the records in
+    between are compressed together.
+    """
+    def __init__(self, filename,
+                 compresslevel=constants.LOG_COMPRESS_LEVEL):
+        self.compresslevel = compresslevel
+        self.flushed_at = 0
+        super(GzipFileHandler, self).__init__(filename, mode='w')
+
+    def _open(self):
+        return gzip.open(
+            self.baseFilename, 'wt', compresslevel=self.compresslevel,
+            encoding='utf-8', errors='replace')
+
+    def flush(self):
+        now = monotonic()
+        if now - self.flushed_at >= constants.LOG_FLUSH_INTERVAL:
+            self.flushed_at = now
+            super(GzipFileHandler, self).flush()
+
+
 def logging_init_file_handler():
     global LOG_FILE_HANDLER
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
-    fh = logging.FileHandler(constants.RUNNER_LOG, mode='w')
+    fh = GzipFileHandler(constants.RUNNER_LOG)
     fh.setLevel(logging.DEBUG)
     formatter = logging.Formatter(LOG_FORMAT)
     fh.setFormatter(formatter)
@@ -202,6 +431,137 @@ def logging_init_file_handler():
     LOG_FILE_HANDLER = fh
 
 
+def logging_close_file_handler():
+    """
+    Finish the job's log, the records logged later aren't a part of it.
+    """
+    global LOG_FILE_HANDLER
+    if LOG_FILE_HANDLER is None:
+        return
+    logging.getLogger().removeHandler(LOG_FILE_HANDLER)
+    LOG_FILE_HANDLER.close()
+    LOG_FILE_HANDLER = None
+
+
+class JobScope(object):
+    """
+    Processes and VMs of a job.
+
+    The processes the job starts join the job's cgroup, so do all their
+    descendants, even the ones which start a new session or lose their
+    parent. The VMs run under libvirtd, vagrant-libvirt names their domains
+    after the job directory ("<uuid>_<machine>"). Killing the job kills
+    exactly its processes and VMs, the other jobs on the host are left
+    alone. Without a cgroup hierarchy the runner can write to, only the
+    process groups of the job's processes are killed (see PopenTask).
+    """
+    def __init__(self, uuid, mounts=constants.CGROUP_MOUNTS):
+        self.uuid = uuid
+        self.cgroup = self.create_cgroup(mounts)
+
+    def create_cgroup(self, mounts):
+        for mount in mounts:
+            if not os.path.exists(os.path.join(mount, 'cgroup.procs')):
+                continue
+            path = os.path.join(mount, constants.CGROUP_NAME, self.uuid)
+            try:
+                os.makedirs(path, exist_ok=True)
+            except OSError as exc:
+                logging.debug(exc, exc_info=True)
+                continue
+            return path
+
+        logging.warning('No cgroup for job {uuid}, its processes are not '
+                        'tracked'.format(uuid=self.uuid))
+        return None
+
+    def enter(self):
+        """
+        Move the calling process to the job's cgroup.
+        """
+        if self.cgroup is None:
+            return
+        with open(os.path.join(self.cgroup, 'cgroup.procs'), 'w') as file_:
+            file_.write(str(os.getpid()))
+
+    def pids(self):
+        if self.cgroup is None:
+            return []
+        try:
+            with open(os.path.join(self.cgroup, 'cgroup.procs')) as file_:
+                return [int(pid) for pid in file_.read().split()]
+        except OSError:
+            return []
+
+    def domains(self):
+        """
+        Names of the libvirt domains of the job's VMs.
+        """
+        try:
+            names = subprocess.check_output(
+                ['virsh', 'list', '--all', '--name'],
+                stderr=subprocess.DEVNULL,
+                timeout=constants.VIRSH_TIMEOUT).decode('utf-8').split()
+        except (OSError, subprocess.SubprocessError) as exc:
+            logging.warning('Failed to list libvirt domains: %s', exc)
+            return []
+        prefix = '{uuid}_'.format(uuid=self.uuid)
+        return [name for name in names if name.startswith(prefix)]
+
+    def kill_processes(self):
+        # Processes can fork while they're being killed, kill until the
+        # cgroup is empty
+        for _ in range(10):
+            pids = self.pids()
+            if not pids:
+                return
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            sleep(0.1)
+        logging.warning('Failed to kill processes of job {uuid}'.format(
+            uuid=self.uuid))
+
+    def kill(self):
+        """
+        Kill the job's processes and power off its VMs.
+        """
+        self.kill_processes()
+        for domain in self.domains():
+            subprocess.call(
+                ['virsh', 'destroy', domain],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                timeout=constants.VIRSH_TIMEOUT)
+
+    def close(self):
+        """
+        Kill the processes left behind and remove the cgroup, the VMs are
+        kept (the job could be run with no_destroy).
+        """
+        if self.cgroup is None:
+            return
+        self.kill_processes()
+        try:
+            os.rmdir(self.cgroup)
+        except OSError as exc:
+            logging.debug(exc, exc_info=True)
+
+
+def job_scope_init(uuid):
+    global JOB_SCOPE
+    JOB_SCOPE = JobScope(uuid)
+    return JOB_SCOPE
+
+
+def job_scope_close():
+    global JOB_SCOPE
+    if JOB_SCOPE is not None:
+        JOB_SCOPE.close()
+        JOB_SCOPE = None
+
+
 def create_file_from_template(template_path, dest, data):
     env = jinja2.Environment(
         loader=jinja2.FileSystemLoader(constants.TEMPLATES_DIR))
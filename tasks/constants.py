@@ -12,6 +12,12 @@ CLOUD_JOBS_DIR = 'jobs/'
 CLOUD_JOBS_URL = urllib.parse.urljoin(CLOUD_URL, CLOUD_JOBS_DIR)
 CLOUD_DB = 'PRCI_JOB_RUN'
 CLOUD_REGION = 'eu-central-1'
+# Uploads of the job directories
+CLOUD_UPLOAD_WORKERS = 10
+CLOUD_UPLOAD_RETRIES = 3
+CLOUD_MULTIPART_THRESHOLD = 16*1024*1024
+CLOUD_MULTIPART_CHUNKSIZE = 16*1024*1024
+CLOUD_INDEX_DIR = 'jobs/index/'
 
 TASKS_DIR = os.path.join(BASE_DIR, 'tasks')
 
@@ -20,16 +26,26 @@ BUILD_FAILED_DESCRIPTION = "(✖╭╮✖)"
 
 UUID_RE = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
 
-RUNNER_LOG = 'runner.log'
+RUNNER_LOG = 'runner.log.gz'
 FREEIPA_PRCI_REPOFILE = 'freeipa-prci.repo'
 ANSIBLE_VARS_TEMPLATE = '{action_name}.vars.yml'
 VAGRANTFILE_TEMPLATE = os.path.join('vagrantfiles', 'Vagrantfile.{vagrantfile_name}')
 VAGRANT_IMAGE_PATH = '/root/.vagrant.d/boxes/{name}/{version}/{provider}/box.img'
-LIBVIRT_IMAGE_PATH = '/var/lib/libvirt/images/{libvirt_name}_{version}.img'
+LIBVIRT_POOL_DIR = '/var/lib/libvirt/images'
+LIBVIRT_IMAGE_PATH = os.path.join(LIBVIRT_POOL_DIR, '{libvirt_name}_{version}.img')
 
 ANSIBLE_CFG_FILE = os.path.join(TEMPLATES_DIR, 'ansible.cfg')
 
 POPEN_TERM_TIMEOUT = 10
+# cgroup hierarchies the jobs' processes are tracked in, the first one
+# mounted is used (cgroup v2, v2 of a hybrid setup, v1 pids controller)
+CGROUP_MOUNTS = [
+    '/sys/fs/cgroup', '/sys/fs/cgroup/unified', '/sys/fs/cgroup/pids']
+CGROUP_NAME = 'freeipa-pr-ci'
+VIRSH_TIMEOUT = 60
+# Output of the processes is read in chunks, the tail is kept for errors
+POPEN_CHUNK_SIZE = 64*1024
+POPEN_TAIL_SIZE = 16*1024
 BUILD_TIMEOUT = 30*60
 RUN_PYTEST_TIMEOUT = 90*60
 
@@ -41,3 +57,45 @@ ANSIBLE_PLAYBOOK_DIR = os.path.join(BASE_DIR, 'ansible')
 ANSIBLE_PLAYBOOK_BUILD = os.path.join(ANSIBLE_PLAYBOOK_DIR, 'build.yml')
 ANSIBLE_PLAYBOOK_COLLECT_BUILD = os.path.join(ANSIBLE_PLAYBOOK_DIR,
                                               'collect_build.yml')
+
+# Build cache
+BUILD_CACHE_DIR = os.path.expanduser('~/.cache/freeipa-pr-ci')
+BUILD_CACHE_INDEX = os.path.join(BUILD_CACHE_DIR, 'builds.json')
+BUILD_CACHE_GIT_DIR = os.path.join(BUILD_CACHE_DIR, 'freeipa.git')
+BUILD_CACHE_PLAYBOOKS = [
+    ANSIBLE_PLAYBOOK_BUILD, ANSIBLE_PLAYBOOK_COLLECT_BUILD,
+    os.path.join(ANSIBLE_PLAYBOOK_DIR, 'roles', 'builder'),
+]
+BUILD_CACHE_GIT_TIMEOUT = 5*60
+BUILD_CACHE_HTTP_TIMEOUT = 30
+CLOUD_BUILDS_DIR = 'builds/'
+
+# Provisioned images
+PROVISION_PLAYBOOKS = [
+    os.path.join(ANSIBLE_PLAYBOOK_DIR, 'provision.yml'),
+    os.path.join(ANSIBLE_PLAYBOOK_DIR, 'roles', 'machine', 'provision'),
+]
+IMAGE_MAX_AGE = 7*24*60*60
+
+# Warm pool
+WARM_POOL_REGISTRY = os.path.join(BUILD_CACHE_DIR, 'warm_pool.json')
+WARM_UP_TIMEOUT = 60*60
+
+# Box store and prefetching
+VAGRANT_CLOUD_URL = 'https://vagrantcloud.com'
+BOX_STORE_DIR = os.path.join(BUILD_CACHE_DIR, 'boxes')
+BOX_STORE_REGISTRY = os.path.join(BOX_STORE_DIR, 'boxes.json')
+BOX_STORE_TIMEOUT = 5*60
+BOX_CATALOG_TIMEOUT = 30
+
+# Log compression
+LOG_COMPRESS_CODEC = 'gzip'
+LOG_COMPRESS_LEVEL = 6
+# The job's log is flushed to the disk at most this often, in seconds
+LOG_FLUSH_INTERVAL = 5
+# Directories and file names (shell patterns) which are never compressed
+LOG_COMPRESS_EXCLUDE_DIRS = ['.vagrant', 'assets', 'rpms']
+LOG_COMPRESS_EXCLUDE_FILES = [
+    '*.gz', '*.xz', '*.bz2', '*.png', 'Vagrantfile', 'ipa-test-config.yaml',
+    'vars.yml', 'ansible.cfg', 'report.html',
+]
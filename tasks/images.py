@@ -0,0 +1,164 @@
+"""
+Provisioned images of the topologies' machines.
+
+The part of the provisioning which depends neither on the tested build nor
+on the addresses the VMs get (the "image" stage of the provision playbook:
+hostnames, package updates) is the same for every job of a template and
+topology. The first job provisions it, halts its VMs and stores their disks
+as local vagrant boxes, one per machine. Later jobs boot the machines from
+those boxes, vagrant-libvirt gives every VM a copy-on-write overlay of the
+box image, and skip the stage.
+
+The images are keyed by the template, the topology, the package updates and
+a digest of the provisioning roles, so a new template version or a change of
+the roles provisions new images. Images older than IMAGE_MAX_AGE are
+provisioned again to pick up the package updates.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess
+from time import time
+
+from . import constants
+from .build_cache import builder_digest
+from .common import FallibleTask, PopenTask, TaskException
+from .vagrant import VagrantBox
+
+IMAGE_BOX_VERSION = '0'
+MACHINE_RE = re.compile(r'config\.vm\.define\s+"(\w+)"')
+
+
+def topology_machines(topology_name):
+    """
+    Names of the machines defined in the topology's Vagrantfile.
+    """
+    path = os.path.join(
+        constants.TEMPLATES_DIR,
+        constants.VAGRANTFILE_TEMPLATE.format(vagrantfile_name=topology_name))
+    with open(path) as file_:
+        return MACHINE_RE.findall(file_.read())
+
+
+class ProvisionedImage(object):
+    def __init__(self, template_name, template_version, topology_name,
+                 update_packages=False):
+        self.template_name = template_name
+        self.template_version = template_version
+        self.topology_name = topology_name
+        self.update_packages = update_packages
+
+    @property
+    def key(self):
+        return hashlib.sha256('\n'.join([
+            self.template_name, self.template_version, self.topology_name,
+            str(bool(self.update_packages)),
+            builder_digest(constants.PROVISION_PLAYBOOKS),
+        ]).encode()).hexdigest()[:16]
+
+    def box(self, machine, key=None):
+        return VagrantBox(
+            'prci-image/{key}-{machine}'.format(
+                key=key or self.key, machine=machine),
+            IMAGE_BOX_VERSION)
+
+    def boxes(self):
+        """
+        Boxes of the topology's machines by the machine names.
+        """
+        key = self.key
+        return {
+            machine: self.box(machine, key)
+            for machine in topology_machines(self.topology_name)
+        }
+
+    def exists(self):
+        key = self.key
+        for machine in topology_machines(self.topology_name):
+            path = self.box(machine, key).vagrant_path
+            try:
+                if time() - os.stat(path).st_mtime > constants.IMAGE_MAX_AGE:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def lock(self):
+        """
+        Lock the image for storing, None if another job stores it.
+        """
+        os.makedirs(constants.BUILD_CACHE_DIR, exist_ok=True)
+        lock_file = open(os.path.join(
+            constants.BUILD_CACHE_DIR, 'image-{}.lock'.format(self.key)), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+
+class StoreProvisionedImage(FallibleTask):
+    """
+    Store the disks of the halted VMs of a job as the image's boxes.
+    """
+    def __init__(self, image, job_uuid, **kwargs):
+        super(StoreProvisionedImage, self).__init__(**kwargs)
+        self.image = image
+        self.job_uuid = job_uuid
+
+    def volume_path(self, machine):
+        # vagrant-libvirt names the domains after the directory
+        return os.path.join(
+            constants.LIBVIRT_POOL_DIR,
+            '{uuid}_{machine}.img'.format(uuid=self.job_uuid, machine=machine))
+
+    def store(self, machine, box):
+        box_dir = os.path.dirname(box.vagrant_path)
+        tmp_dir = box_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        # Flatten the VM's overlay, the box mustn't depend on the template
+        image_path = os.path.join(tmp_dir, 'box.img')
+        self.execute_subtask(PopenTask([
+            'qemu-img', 'convert', '-O', 'qcow2',
+            self.volume_path(machine), image_path], timeout=None))
+        info = json.loads(subprocess.check_output(
+            ['qemu-img', 'info', '--output=json', image_path]).decode())
+        with open(os.path.join(tmp_dir, 'metadata.json'), 'w') as file_:
+            json.dump({
+                'provider': 'libvirt',
+                'format': 'qcow2',
+                'virtual_size': int(
+                    math.ceil(info['virtual-size'] / float(1024 ** 3))),
+            }, file_)
+
+        shutil.rmtree(box_dir, ignore_errors=True)
+        os.rename(tmp_dir, box_dir)
+        # Jobs link the new image to libvirt again
+        if box.libvirt_exists():
+            os.unlink(box.libvirt_path)
+
+    def _run(self):
+        lock_file = self.image.lock()
+        if lock_file is None:
+            logging.info('Image is being stored by another job')
+            return
+
+        try:
+            key = self.image.key
+            for machine in topology_machines(self.image.topology_name):
+                self.store(machine, self.image.box(machine, key))
+        except (OSError, ValueError, subprocess.CalledProcessError) as exc:
+            logging.debug(exc, exc_info=True)
+            raise TaskException(self, 'Failed to store provisioned image')
+        finally:
+            lock_file.close()
+
+        logging.info('Stored provisioned image {key}'.format(key=key))
@@ -1,16 +1,34 @@
+import bz2
+import concurrent.futures
+import fnmatch
+import gzip
 import json
+import logging
+import lzma
+import math
+import mimetypes
 import os
 import re
+import shutil
 import socket
 from datetime import datetime
+from time import monotonic, sleep
 
 import boto3
+import botocore.config
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
+from s3transfer.manager import TransferManager
 from jinja2 import Template
 
-from .common import PopenTask, TaskException, FallibleTask
-from .constants import (CLOUD_JOBS_DIR, CLOUD_JOBS_URL, CLOUD_URL, CLOUD_DIR,
+from .common import TaskException, FallibleTask
+from .constants import (CLOUD_JOBS_DIR, CLOUD_JOBS_URL, CLOUD_URL,
                         CLOUD_BUCKET, CLOUD_DB, CLOUD_REGION, UUID_RE,
-                        JOBS_DIR, TASKS_DIR)
+                        JOBS_DIR, TASKS_DIR, CLOUD_UPLOAD_WORKERS,
+                        CLOUD_UPLOAD_RETRIES, CLOUD_MULTIPART_THRESHOLD,
+                        CLOUD_MULTIPART_CHUNKSIZE, CLOUD_INDEX_DIR,
+                        LOG_COMPRESS_CODEC, LOG_COMPRESS_LEVEL,
+                        LOG_COMPRESS_EXCLUDE_DIRS, LOG_COMPRESS_EXCLUDE_FILES)
 
 """
 Previously we were updating test results in Fedora infra where the results were
@@ -18,20 +36,39 @@ directly served as part of web server directory listing capabilities. This is
 not case of AWS S3.
 In order to simulate same environment we are generating "index.html" using
 Jinja2 template and putting it into every directory. Then we upload particular
-job directory using awscli (which does parallelism for us) under S3 bucket
-"jobs" prefix (directory). Currently 2 awscli commands are needed in order to
-set correct encoding for gzip files. Content types are set automatically using
-"/etc/mime.types" file.
-At the end we create root jobs index to list all "freeipa" repo PR jobs in the
-bucket.
+job directory under S3 bucket "jobs" prefix (directory) in a single pass over
+its files, concurrently (see S3Uploader). Gzip files get their encoding set,
+content types are guessed using "/etc/mime.types" file.
+At the end we add the job to the root jobs index which lists all "freeipa"
+repo PR jobs in the bucket.
+
+The root index is split into shards, one per month and one per PR, under
+the "jobs/index" prefix. A finished job writes its DynamoDB item as an object
+of its own under the prefix of each of its two shards, so the jobs never
+overwrite each other's data. The shard's index.html page is then rendered
+from the listing of the prefix. The items rendered last time are cached in
+a JSON object next to the page and only the new jobs are read, so the cost
+doesn't grow with the history. The top "jobs/index.html" page lists the
+shards' prefixes and is rendered when a job's shard is missing from it.
+A page rendered concurrently with another job of the shard can miss that
+job until the next job of the shard renders it again. The index can be
+rebuilt from the DynamoDB table for recovery (see
+scripts/rebuild_root_index.py).
 """
 
+COMPRESSION_CODECS = {
+    'gzip': (gzip.open, '.gz'),
+    'bz2': (bz2.open, '.bz2'),
+    'xz': (lzma.open, '.xz'),
+}
+LEVEL_ARGS = {'gzip': 'compresslevel', 'bz2': 'compresslevel', 'xz': 'preset'}
+COMPRESS_CHUNK_SIZE = 1024 * 1024
 
-def create_jobs_root_index():
+
+def scan_jobdir_metadata():
     """
-    Generate root jobs index from AWS DynamoDB table.
+    All job dir metadata from AWS DynamoDB table.
     """
-    client = boto3.client('s3')
     dynamodb = boto3.resource('dynamodb', region_name=CLOUD_REGION)
     table = dynamodb.Table(CLOUD_DB)
 
@@ -41,29 +78,182 @@ def create_jobs_root_index():
     while response.get('LastEvaluatedKey'):
         response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
         objects.extend(response['Items'])
+    return objects
+
+
+def index_shards(item):
+    """
+    Shards of the root jobs index the job is listed in, as (kind, name).
+    """
+    shards = [('month', item['mtime'][:7])]
+    # Jobs without a PR have it 'None'
+    if str(item.get('pr_number', '')).isdigit():
+        shards.append(('pr', item['pr_number']))
+    return shards
+
+
+def index_key(*parts):
+    return os.path.join(CLOUD_INDEX_DIR, *parts)
+
+
+def item_key(kind, name, uuid):
+    return index_key(kind, name, uuid + '.json')
+
+
+def read_json_object(client, key, default):
+    try:
+        response = client.get_object(Bucket=CLOUD_BUCKET, Key=key)
+    except client.exceptions.NoSuchKey:
+        return default
+    return json.loads(response['Body'].read().decode('utf-8'))
 
-    obj_data = {'objects': objects}
 
-    client.put_object(Body=generate_index(obj_data, is_root=True),
-                      Bucket=CLOUD_BUCKET,
-                      Key=os.path.join(CLOUD_JOBS_DIR, 'index.html'),
+def put_json_object(client, key, data):
+    client.put_object(Body=json.dumps(data).encode('utf-8'),
+                      Bucket=CLOUD_BUCKET, Key=key,
+                      ContentType='application/json')
+
+
+def put_html_object(client, key, body):
+    client.put_object(Body=body, Bucket=CLOUD_BUCKET, Key=key,
                       ContentEncoding='utf-8', ContentType='text/html')
 
 
-def generate_index(obj_data, is_root=False):
+def list_objects(client, prefix, **kwargs):
+    """
+    All listing pages of the prefix.
+    """
+    paginator = client.get_paginator('list_objects_v2')
+    return paginator.paginate(Bucket=CLOUD_BUCKET, Prefix=prefix, **kwargs)
+
+
+def list_shard_items(client, kind, name):
+    """
+    Keys of the job items of the shard.
+    """
+    for page in list_objects(client, index_key(kind, name, '')):
+        for obj in page.get('Contents', []):
+            yield obj['Key']
+
+
+def list_shards(client):
+    """
+    Names of all the shards of the root jobs index, by kind.
+    """
+    shards = {}
+    for kind in ('month', 'pr'):
+        prefix = index_key(kind, '')
+        for page in list_objects(client, prefix, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                shards.setdefault(kind, []).append(
+                    common_prefix['Prefix'][len(prefix):].rstrip('/'))
+    return sort_shards(shards)
+
+
+def shard_title(kind, name):
+    if kind == 'pr':
+        return 'PR#{}'.format(name)
+    return name
+
+
+def write_index_shard(client, kind, name, items):
+    """
+    Write the shard's page and the cache of its items.
+    """
+    put_json_object(client, index_key(kind, name + '.json'), items)
+    obj_data = {'objects': items, 'title': shard_title(kind, name)}
+    put_html_object(client, index_key(kind, name + '.html'),
+                    generate_index(obj_data, is_root=True))
+
+
+def render_index_shard(client, kind, name):
+    """
+    Render the shard's page from the job items listed under its prefix,
+    only the items missing from the cache are read.
+    """
+    cached = {
+        item_key(kind, name, item['name']): item
+        for item in read_json_object(
+            client, index_key(kind, name + '.json'), [])
+    }
+    items = []
+    for key in list_shard_items(client, kind, name):
+        item = cached.get(key)
+        if item is None:
+            item = read_json_object(client, key, None)
+        if item is not None:
+            items.append(item)
+    write_index_shard(client, kind, name, items)
+
+
+def write_shards_index(client, shards):
+    put_json_object(client, index_key('shards.json'), shards)
+    put_html_object(client, os.path.join(CLOUD_JOBS_DIR, 'index.html'),
+                    generate_index(shards,
+                                   template='jobs_index_template.html'))
+
+
+def sort_shards(shards):
+    """
+    The newest months and PRs first.
+    """
+    return {
+        'month': sorted(shards.get('month', []), reverse=True),
+        'pr': sorted(shards.get('pr', []), key=int, reverse=True),
+    }
+
+
+def add_to_jobs_root_index(item):
+    """
+    Add the job dir metadata to its shards of the root jobs index.
+    """
+    client = boto3.client('s3')
+    shards = index_shards(item)
+    for kind, name in shards:
+        put_json_object(client, item_key(kind, name, item['name']), item)
+    for kind, name in shards:
+        render_index_shard(client, kind, name)
+
+    # The top page only changes with a new month or PR
+    rendered = read_json_object(client, index_key('shards.json'), {})
+    if any(name not in rendered.get(kind, []) for kind, name in shards):
+        write_shards_index(client, list_shards(client))
+
+
+def rebuild_jobs_root_index():
+    """
+    Write the job items of all shards of the root jobs index from AWS
+    DynamoDB table and render the shards again.
+    """
+    client = boto3.client('s3')
+    shards = {}
+    for item in scan_jobdir_metadata():
+        for kind, name in index_shards(item):
+            put_json_object(client, item_key(kind, name, item['name']), item)
+            shards.setdefault((kind, name), []).append(item)
+
+    for (kind, name), items in sorted(shards.items()):
+        write_index_shard(client, kind, name, items)
+
+    write_shards_index(client, list_shards(client))
+    return len(shards)
+
+
+def generate_index(obj_data, is_root=False, template=None):
     """
     Generate Jinja2 template for index.html with all AWS S3 objects
     (files and directories).
-    For jobs index we use different template.
+    For jobs index shards and their top page we use different templates.
     """
 
     jinja_ctx = {'obj_data': obj_data, 'cloud_jobs_url': CLOUD_JOBS_URL,
                  'cloud_url': CLOUD_URL}
 
-    if is_root:
-        template = 'root_index_template.html'
-    else:
-        template = 'index_template.html'
+    if template is None:
+        if is_root:
+            template = 'root_index_template.html'
+        else:
+            template = 'index_template.html'
 
     with open(os.path.join(TASKS_DIR, template), 'r') as file_:
         template = Template(file_.read())
@@ -115,7 +305,7 @@ def make_aws_data(remote_path, uuid, pr_number, pr_author, task_name,
     return {
         "remote_path": remote_path, "uuid": uuid, "pr_number": pr_number,
         "pr_author": pr_author, "task_name": task_name,
-        "returncode": returncode, "hostname": hostname,"objects": objects
+        "returncode": returncode, "hostname": hostname, "objects": objects
     }
 
 
@@ -142,24 +332,26 @@ def create_local_indeces(uuid, pr_number, pr_author, task_name, returncode,
 
 
 def save_jobdir_metadata(uuid, repo_owner, pr_number, pr_author, task_name,
-                           returncode):
+                         returncode):
     """
     Update particular job dir metadata to DynamoDB table.
+
+    Returns the saved item.
     """
     dynamodb = boto3.resource('dynamodb', region_name=CLOUD_REGION)
     table = dynamodb.Table(CLOUD_DB)
 
-    table.put_item(
-        Item={
-            'name': uuid,
-            'repo_owner': repo_owner,
-            'pr_number': pr_number,
-            'pr_author': pr_author,
-            'task_name': task_name,
-            'returncode': returncode,
-            'mtime': datetime.now().strftime('%Y-%m-%d %H:%M'),
-        }
-    )
+    item = {
+        'name': uuid,
+        'repo_owner': repo_owner,
+        'pr_number': pr_number,
+        'pr_author': pr_author,
+        'task_name': task_name,
+        'returncode': returncode,
+        'mtime': datetime.now().strftime('%Y-%m-%d %H:%M'),
+    }
+    table.put_item(Item=item)
+    return item
 
 
 def create_metadata_json(src, uuid, repo_owner, pr_number, pr_author,
@@ -181,26 +373,196 @@ def create_metadata_json(src, uuid, repo_owner, pr_number, pr_author,
         json.dump(metadata, file_obj)
 
 
-class GzipLogFiles(PopenTask):
-    def __init__(self, directory, **kwargs):
-        super(GzipLogFiles, self).__init__(self, **kwargs)
+def compress_file(path, codec, level):
+    """
+    Compress the file like the codec's command line tool does: the
+    compressed file keeps the permissions and times and replaces the file.
+    """
+    opener, extension = COMPRESSION_CODECS[codec]
+    dest = path + extension
+    tmp_dest = dest + '.tmp'
+    with open(path, 'rb') as src_file, \
+            opener(tmp_dest, 'wb', **{LEVEL_ARGS[codec]: level}) as dest_file:
+        shutil.copyfileobj(src_file, dest_file, COMPRESS_CHUNK_SIZE)
+    shutil.copystat(path, tmp_dest)
+    os.rename(tmp_dest, dest)
+    os.unlink(path)
+
+
+def compress_files(paths, codec, level):
+    for path in paths:
+        compress_file(path, codec, level)
+
+
+def log_files(directory, exclude_dirs=LOG_COMPRESS_EXCLUDE_DIRS,
+              exclude_files=LOG_COMPRESS_EXCLUDE_FILES):
+    """
+    Walk the directory for the files to compress.
+    """
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in exclude_dirs:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not any(
+                        fnmatch.fnmatch(entry.name, pattern)
+                        for pattern in exclude_files):
+                    yield entry.path
+
+
+def free_cpus():
+    """
+    Number of the CPUs the host doesn't use, at least one.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, cpus - int(math.ceil(os.getloadavg()[0])))
+
+
+class GzipLogFiles(FallibleTask):
+    """
+    Compress the log files of a job on a process pool, the files are split
+    to batches of similar total size.
+    """
+    def __init__(self, directory, codec=LOG_COMPRESS_CODEC,
+                 level=LOG_COMPRESS_LEVEL, workers=None, **kwargs):
+        if codec not in COMPRESSION_CODECS:
+            raise TaskException(self, 'Unknown codec {}'.format(codec))
+        super(GzipLogFiles, self).__init__(**kwargs)
         self.directory = directory
-        self.cmd = (
-            'find {directory} '
-            '-type f '
-            '! -path "*/.vagrant/*" '
-            '-a ! -path "*/assets/*" '
-            '-a ! -path "*/rpms/*" '
-            '-a ! -name "*.gz" '
-            '-a ! -name "*.png" '
-            '-a ! -name "Vagrantfile" '
-            '-a ! -name "ipa-test-config.yaml" '
-            '-a ! -name "vars.yml" '
-            '-a ! -name "ansible.cfg" '
-            '-a ! -name "report.html" '
-            '-exec gzip "{{}}" \;'
-        ).format(directory=directory)
-        self.shell = True
+        self.codec = codec
+        self.level = level
+        self.workers = workers
+
+    def batches(self, paths, count):
+        sizes = {path: os.lstat(path).st_size for path in paths}
+        batches = [[] for _ in range(count)]
+        totals = [0] * count
+        # The largest first, each to the smallest batch
+        for path in sorted(paths, key=sizes.get, reverse=True):
+            index = totals.index(min(totals))
+            batches[index].append(path)
+            totals[index] += sizes[path]
+        return [batch for batch in batches if batch]
+
+    def _run(self):
+        paths = list(log_files(self.directory))
+        workers = min(self.workers or free_cpus(), len(paths))
+        logging.info('Compressing {count} files with {workers} workers'.format(
+            count=len(paths), workers=workers))
+        if workers <= 1:
+            compress_files(paths, self.codec, self.level)
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(compress_files, batch, self.codec, self.level)
+                for batch in self.batches(paths, workers)
+            ]
+            for future in futures:
+                future.result()
+
+
+class S3Uploader(object):
+    """
+    Uploads a directory tree to the bucket with a pool of threads, large
+    files in multiple parts. Failed files are uploaded again with a backoff,
+    on top of the retries of the single requests.
+    """
+    def __init__(self, bucket=CLOUD_BUCKET, workers=CLOUD_UPLOAD_WORKERS,
+                 retries=CLOUD_UPLOAD_RETRIES, client=None):
+        self.bucket = bucket
+        self.retries = retries
+        self.client = client or boto3.client(
+            's3', config=botocore.config.Config(
+                max_pool_connections=workers,
+                retries={'max_attempts': retries}))
+        self.config = TransferConfig(
+            max_concurrency=workers,
+            multipart_threshold=CLOUD_MULTIPART_THRESHOLD,
+            multipart_chunksize=CLOUD_MULTIPART_CHUNKSIZE)
+        self.manager = None
+        self.cancelled = False
+
+    @staticmethod
+    def extra_args(path):
+        """
+        Content type and encoding of the object.
+        """
+        if path.endswith('.gz'):
+            # Served as text, browsers decompress it on their own
+            return {'ContentType': 'text/plain', 'ContentEncoding': 'gzip'}
+        content_type, _ = mimetypes.guess_type(path)
+        if content_type is None:
+            return {}
+        return {'ContentType': content_type}
+
+    @staticmethod
+    def files(src):
+        for root, _, names in os.walk(src, followlinks=True):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.isfile(path):
+                    yield path
+
+    def upload_files(self, src, dest, paths):
+        """
+        Upload the files once, returns the ones which failed.
+        """
+        failed = []
+        with TransferManager(self.client, self.config) as self.manager:
+            futures = [
+                (path, self.manager.upload(
+                    path, self.bucket,
+                    os.path.join(dest, os.path.relpath(path, src)),
+                    extra_args=self.extra_args(path)))
+                for path in paths
+            ]
+            for path, future in futures:
+                try:
+                    future.result()
+                except (botocore.exceptions.BotoCoreError,
+                        botocore.exceptions.ClientError, OSError) as exc:
+                    logging.warning('Failed to upload {path}: {exc}'.format(
+                        path=path, exc=exc))
+                    failed.append(path)
+        self.manager = None
+        return failed
+
+    def upload(self, src, dest):
+        """
+        Upload the files of the src directory under the dest prefix.
+        """
+        started = monotonic()
+        paths = list(self.files(src))
+        size = sum(os.path.getsize(path) for path in paths)
+
+        failed = self.upload_files(src, dest, paths)
+        for attempt in range(self.retries):
+            if not failed or self.cancelled:
+                break
+            sleep(2 ** attempt)
+            failed = self.upload_files(src, dest, failed)
+        if failed:
+            raise RuntimeError('Failed to upload {count} files'.format(
+                count=len(failed)))
+
+        elapsed = max(monotonic() - started, 0.001)
+        logging.info(
+            'Uploaded {count} files ({size:.1f} MB) in {elapsed:.1f}s, '
+            '{rate:.1f} MB/s'.format(
+                count=len(paths), size=size / 1024 ** 2, elapsed=elapsed,
+                rate=size / 1024 ** 2 / elapsed))
+
+    def cancel(self):
+        self.cancelled = True
+        manager = self.manager
+        if manager is not None:
+            manager.shutdown(cancel=True)
 
 
 class CloudUpload(FallibleTask):
@@ -218,12 +580,13 @@ class CloudUpload(FallibleTask):
         self.pr_author = pr_author if not None else ''
         self.task_name = task_name if not None else ''
         self.returncode = str(returncode) if not None else ''
+        self.uploader = None
 
     def _run(self):
         # make sure we don't leak fqdn
         self.hostname = socket.gethostname().split('.')[0]
         src = os.path.join(JOBS_DIR, self.uuid)
-        dest = os.path.join(CLOUD_DIR, CLOUD_JOBS_DIR, self.uuid)
+        dest = os.path.join(CLOUD_JOBS_DIR, self.uuid)
 
         create_metadata_json(src, self.uuid, self.repo_owner,
                              self.pr_number, self.pr_author,
@@ -232,15 +595,17 @@ class CloudUpload(FallibleTask):
         create_local_indeces(self.uuid, self.pr_number, self.pr_author,
                              self.task_name, self.returncode, self.hostname)
 
-        aws_sync_cmd = ['aws', 's3', 'sync', src, dest]
-        sync_all_except_gz = ['--include=*', '--exclude=*.gz']
-        sync_gz = ['--exclude=*', '--include=*.gz', '--content-encoding=gzip',
-                   '--content-type=text/plain']
+        self.uploader = S3Uploader()
+        try:
+            self.uploader.upload(src, dest)
+        except (RuntimeError, OSError,
+                botocore.exceptions.BotoCoreError) as exc:
+            logging.debug(exc, exc_info=True)
+            raise TaskException(self, str(exc))
 
-        # run 2 awscli commands so we can upload all "gzip" files with
-        # correct encoding.
-        self.execute_subtask(PopenTask(aws_sync_cmd + sync_all_except_gz))
-        self.execute_subtask(PopenTask(aws_sync_cmd + sync_gz))
+    def _terminate(self):
+        if self.uploader is not None:
+            self.uploader.cancel()
 
 
 class CreateRootIndex(FallibleTask):
@@ -260,7 +625,7 @@ class CreateRootIndex(FallibleTask):
         self.returncode = str(returncode) if not None else ''
 
     def _run(self):
-        save_jobdir_metadata(self.uuid, self.repo_owner,
-                             self.pr_number, self.pr_author,
-                             self.task_name, self.returncode)
-        create_jobs_root_index()
+        item = save_jobdir_metadata(self.uuid, self.repo_owner,
+                                    self.pr_number, self.pr_author,
+                                    self.task_name, self.returncode)
+        add_to_jobs_root_index(item)
@@ -7,13 +7,27 @@ import uuid
 
 from .ansible import AnsiblePlaybook
 from .common import (FallibleTask, TaskException, PopenTask,
-                     logging_init_file_handler, create_file_from_template)
+                     logging_init_file_handler, logging_close_file_handler,
+                     create_file_from_template, job_scope_close,
+                     job_scope_init)
 from . import constants
+from .box_store import BoxStore
+from .build_cache import BuildCache
+from .images import ProvisionedImage, StoreProvisionedImage
+from .warm_pool import WarmPool
 from .remote_storage import GzipLogFiles, CloudUpload, CreateRootIndex
-from .vagrant import with_vagrant
+from .vagrant import (with_vagrant, VagrantBox, VagrantBoxDownload,
+                      VagrantCleanup, VagrantHalt, VagrantProvision,
+                      VagrantUp)
 
 
 class JobTask(FallibleTask):
+    # UUID of the claimed warm pool slot, see RunPytest
+    warm_slot = None
+    # ProvisionedImage the VMs boot from, see RunPytest
+    provisioned_image = None
+    image_ready = False
+
     def __init__(self, template, no_destroy=False, publish_artifacts=True,
                  link_image=True, pr_number=None, pr_author=None,
                  task_name=None, repo_owner=None, **kwargs):
@@ -32,6 +46,8 @@ class JobTask(FallibleTask):
         self.pr_author = pr_author
         self.task_name = task_name
         self.repo_owner = repo_owner
+        self.box_leases = []
+        self.scope = None
 
     @property
     def vagrantfile(self):
@@ -42,9 +58,39 @@ class JobTask(FallibleTask):
     def data_dir(self):
         return os.path.join(constants.JOBS_DIR, self.uuid)
 
+    def image_boxes(self):
+        """
+        Boxes of the provisioned image to boot the machines from.
+        """
+        if self.provisioned_image is None or not self.image_ready:
+            return {}
+        return self.provisioned_image.boxes()
+
+    def download_box(self, box_name, box_version):
+        """
+        Download the box if it's missing and keep it from being evicted
+        until release_boxes() is called.
+        """
+        download = VagrantBoxDownload(
+            box_name=box_name,
+            box_version=box_version,
+            link_image=self.link_image,
+            timeout=None)
+        self.execute_subtask(download)
+        self.box_leases.append(download.lease)
+        BoxStore().touch(download.box)
+
+    def release_boxes(self):
+        for lease in self.box_leases:
+            lease.close()
+        self.box_leases = []
+
     def compress_logs(self):
         self.execute_subtask(
             GzipLogFiles(self.data_dir, raise_on_err=False))
+        # The job's log is compressed as it's written, finish it before
+        # it's uploaded
+        logging_close_file_handler()
 
     def write_hostname_to_file(self):
         try:
@@ -57,9 +103,9 @@ class JobTask(FallibleTask):
             logging.debug(exc, exc_info=True)
 
     def _before(self):
-        # Create job dir
+        # Create job dir, a warm pool slot's one exists already
         try:
-            os.makedirs(self.data_dir)
+            os.makedirs(self.data_dir, exist_ok=self.warm_slot is not None)
         except (OSError, IOError) as exc:
             msg = "Failed to create job directory"
             logging.critical(msg)
@@ -70,6 +116,9 @@ class JobTask(FallibleTask):
         os.chdir(self.data_dir)
         logging_init_file_handler()
 
+        # Track the job's processes and VMs
+        self.scope = job_scope_init(self.uuid)
+
         logging.info("Initializing job {uuid}".format(uuid=self.uuid))
 
         # Create a hostname file for debugging purposes
@@ -82,7 +131,8 @@ class JobTask(FallibleTask):
                 self.vagrantfile,
                 os.path.join(self.data_dir, 'Vagrantfile'),
                 dict(vagrant_template_name=self.template_name,
-                     vagrant_template_version=self.template_version))
+                     vagrant_template_version=self.template_version,
+                     image_boxes=self.image_boxes()))
         except (OSError, IOError) as exc:
             msg = "Failed to prepare job"
             logging.critical(msg)
@@ -135,6 +185,12 @@ class JobTask(FallibleTask):
                           'affect base PRCI functionality')
             logging.debug(exc, exc_info=True)
 
+    def __call__(self):
+        try:
+            super(JobTask, self).__call__()
+        finally:
+            job_scope_close()
+            logging_close_file_handler()
 
     def terminate(self):
         logging.critical(
@@ -147,20 +203,38 @@ class JobTask(FallibleTask):
             logging.critical('No free disk space')
 
         super(JobTask, self).terminate()
+        # Nothing of the job may survive, even without a running process
+        if self.scope is not None:
+            self.scope.kill()
 
 
 class Build(JobTask):
     action_name = 'build'
 
     def __init__(self, template, git_refspec=None, git_version=None, git_repo=None,
-                 timeout=constants.BUILD_TIMEOUT, topology=None, **kwargs):
+                 timeout=constants.BUILD_TIMEOUT, topology=None,
+                 build_cache=True, **kwargs):
         super(Build, self).__init__(template, timeout=timeout, **kwargs)
         self.git_refspec = git_refspec
         self.git_version = git_version
         self.git_repo = git_repo
+        self.build_cache = BuildCache() if build_cache else None
+        self.cache_key = None
+        self.cached_url = None
+
+    def _before(self):
+        super(Build, self)._before()
+        self.lookup_build_cache()
 
-    @with_vagrant
     def _run(self):
+        if self.cached_url is not None:
+            logging.info('>>>>>> BUILD CACHED <<<<<<')
+            self.returncode = 0
+        else:
+            self.build_in_vm()
+
+    @with_vagrant
+    def build_in_vm(self):
         try:
             self.build()
             logging.info('>>>>>> BUILD PASSED <<<<<<')
@@ -173,7 +247,12 @@ class Build(JobTask):
 
     def _after(self):
         self.compress_logs()
-        if self.publish_artifacts:
+        if self.cached_url is not None:
+            # Identical sources were built and published already
+            self.remote_url = self.cached_url
+            logging.info('Reusing build published at: {remote_url}'.format(
+                remote_url=self.remote_url))
+        elif self.publish_artifacts:
             try:
                 self.create_yum_repo()
             except TaskException:
@@ -181,6 +260,7 @@ class Build(JobTask):
                 self.returncode = 1
             finally:
                 self.upload_artifacts()
+                self.store_build_cache()
                 # list only "freeipa" repo PRs in root index
                 # (Jobs of PRs against forks are not listed)
                 if self.repo_owner == 'freeipa':
@@ -191,6 +271,41 @@ class Build(JobTask):
         else:
             self.description = constants.BUILD_FAILED_DESCRIPTION
 
+    def lookup_build_cache(self):
+        """
+        Find a published build of the same sources. The cache is only an
+        optimization, the build runs whenever the lookup fails.
+        """
+        if any((self.build_cache is None, not self.publish_artifacts,
+                self.git_repo is None)):
+            return
+
+        try:
+            tree = self.build_cache.tree_hash(
+                self.git_repo, self.git_refspec, self.git_version)
+            if tree is None:
+                return
+            self.cache_key = BuildCache.key(
+                tree, self.template_name, self.template_version)
+            self.cached_url = self.build_cache.lookup(self.cache_key)
+        except (OSError, ValueError) as exc:
+            logging.warning('Build cache lookup failed')
+            logging.debug(exc, exc_info=True)
+            return
+
+        logging.info('Build cache {result} for tree {tree}'.format(
+            result='hit' if self.cached_url else 'miss', tree=tree))
+
+    def store_build_cache(self):
+        if self.cache_key is None or self.returncode != 0:
+            return
+
+        try:
+            self.build_cache.store(self.cache_key, self.remote_url)
+        except OSError as exc:
+            logging.warning('Failed to cache the build')
+            logging.debug(exc, exc_info=True)
+
     def build(self):
         self.execute_subtask(
             AnsiblePlaybook(
@@ -226,15 +341,21 @@ class Build(JobTask):
 class RunPytest(JobTask):
     action_name = 'run_pytest'
     run_tests_cmd = 'ipa-run-tests'
+    # The provision playbook can be split for the warm pool
+    warm_pool_supported = True
 
     def __init__(self, template, build_url, test_suite, topology=None,
                  timeout=constants.RUN_PYTEST_TIMEOUT, update_packages=False,
-                 xmlrpc=False, **kwargs):
+                 xmlrpc=False, warm_pool=True, provisioned_image=False,
+                 **kwargs):
         super(RunPytest, self).__init__(template, timeout=timeout, **kwargs)
         self.build_url = build_url + '/'
         self.test_suite = test_suite
         self.update_packages = update_packages
         self.xmlrpc = xmlrpc
+        self.warm_pool = warm_pool and self.warm_pool_supported
+        self.use_provisioned_image = (
+            provisioned_image and self.warm_pool_supported)
 
         if not topology:
             topology = {'name': constants.DEFAULT_TOPOLOGY}
@@ -246,18 +367,112 @@ class RunPytest(JobTask):
         return constants.VAGRANTFILE_TEMPLATE.format(
             vagrantfile_name=self.topology_name)
 
+    def claim_warm_slot(self):
+        """
+        Take over the directory and VMs of an idle warm pool slot.
+
+        The slot's VMs use the template box. It's leased before the slot
+        leaves the registry, which kept the box from eviction until then.
+        """
+        box = VagrantBox(self.template_name, self.template_version)
+        lease = None
+        try:
+            lease = box.lease()
+            slot_uuid = WarmPool().claim(
+                self.template_name, self.template_version, self.topology_name)
+        except (OSError, IOError) as exc:
+            logging.debug(exc, exc_info=True)
+            slot_uuid = None
+
+        if slot_uuid is None:
+            if lease is not None:
+                lease.close()
+            return
+
+        self.uuid = slot_uuid
+        self.warm_slot = slot_uuid
+        self.box_leases.append(lease)
+        BoxStore().touch(box)
+
+    def release_warm_slot(self):
+        """
+        Give up the warm VMs, they are replaced by new ones.
+        """
+        self.warm_slot = None
+        self.write_vars()
+
+    def find_provisioned_image(self):
+        """
+        Boot from the provisioned image, it's created first if missing.
+        """
+        image = ProvisionedImage(
+            self.template_name, self.template_version, self.topology_name,
+            self.update_packages)
+        try:
+            self.image_ready = image.exists()
+        except (OSError, IOError) as exc:
+            logging.debug(exc, exc_info=True)
+            return
+
+        self.provisioned_image = image
+        logging.info('Provisioned image {key} {state}'.format(
+            key=image.key, state='found' if self.image_ready else 'missing'))
+
+    def release_provisioned_image(self):
+        """
+        Boot from the template and provision everything.
+        """
+        self.provisioned_image = None
+        self.image_ready = False
+        self.write_vars()
+
+    def create_provisioned_image(self):
+        """
+        Provision the image stage only, store the VMs' disks as the image
+        and continue with the rest of the provisioning.
+        """
+        self.download_box(self.template_name, self.template_version)
+        self.execute_subtask(VagrantUp(timeout=None))
+        self.execute_subtask(VagrantProvision(timeout=None))
+        self.execute_subtask(VagrantHalt(timeout=None))
+        self.execute_subtask(
+            StoreProvisionedImage(
+                self.provisioned_image, self.uuid, timeout=None))
+
+        self.image_ready = True
+        self.write_vars()
+        self.execute_subtask(VagrantUp(timeout=None))
+        self.execute_subtask(VagrantProvision(timeout=None))
+
+    def write_vars(self):
+        if self.warm_slot:
+            stage = 'job'
+        elif self.provisioned_image is not None and not self.image_ready:
+            stage = 'image'
+        else:
+            stage = 'all'
+
+        create_file_from_template(
+            constants.ANSIBLE_VARS_TEMPLATE.format(
+                action_name=self.action_name),
+            os.path.join(self.data_dir, 'vars.yml'),
+            dict(repofile_url=urllib.parse.urljoin(
+                    self.build_url, 'rpms/freeipa-prci.repo'),
+                 update_packages=self.update_packages,
+                 provision_stage=stage,
+                 provisioned_image=self.image_ready))
+
     def _before(self):
+        if self.warm_pool:
+            self.claim_warm_slot()
+        if self.use_provisioned_image and self.warm_slot is None:
+            self.find_provisioned_image()
+
         super(RunPytest, self)._before()
 
         # Prepare test config files
         try:
-            create_file_from_template(
-                constants.ANSIBLE_VARS_TEMPLATE.format(
-                    action_name=self.action_name),
-                os.path.join(self.data_dir, 'vars.yml'),
-                dict(repofile_url=urllib.parse.urljoin(
-                        self.build_url, 'rpms/freeipa-prci.repo'),
-                     update_packages=self.update_packages))
+            self.write_vars()
         except (OSError, IOError) as exc:
             msg = "Failed to prepare test config files"
             logging.debug(exc, exc_info=True)
@@ -310,6 +525,7 @@ class RunPytest3(RunPytest):
 
 class RunWebuiTests(RunPytest):
     action_name = 'webui'
+    warm_pool_supported = False
 
     @property
     def vagrantfile(self):
@@ -330,3 +546,54 @@ class RunWebuiTests(RunPytest):
         logging.error(
             '>>>>>> WEBUI TESTS FAILED (error code: {code}) <<<<<<'.format(
                 code=self.returncode))
+
+
+class WarmUp(JobTask):
+    """
+    Boot and base-provision the VMs of a warm pool slot. The slot has to be
+    added to the pool first, it's marked idle once its VMs are ready and
+    removed if they fail.
+    """
+    action_name = 'run_pytest'
+
+    def __init__(self, template, topology_name, pool=None,
+                 timeout=constants.WARM_UP_TIMEOUT, **kwargs):
+        super(WarmUp, self).__init__(
+            template, timeout=timeout, publish_artifacts=False, **kwargs)
+        self.topology_name = topology_name
+        self.pool = pool if pool is not None else WarmPool()
+
+    @property
+    def vagrantfile(self):
+        return constants.VAGRANTFILE_TEMPLATE.format(
+            vagrantfile_name=self.topology_name)
+
+    def _before(self):
+        super(WarmUp, self)._before()
+        create_file_from_template(
+            constants.ANSIBLE_VARS_TEMPLATE.format(
+                action_name=self.action_name),
+            os.path.join(self.data_dir, 'vars.yml'),
+            dict(repofile_url='', update_packages=False,
+                 provision_stage='base', provisioned_image=False))
+
+    def _run(self):
+        try:
+            # The idle slots keep the box from eviction, see BoxStore
+            self.download_box(self.template_name, self.template_version)
+            self.execute_subtask(VagrantUp(timeout=None))
+            self.execute_subtask(VagrantProvision(timeout=None))
+        except TaskException:
+            logging.error('>>>>>> WARM UP FAILED <<<<<<')
+            self.execute_subtask(VagrantCleanup(raise_on_err=False))
+            self.pool.remove(self.uuid)
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+            raise
+
+        self.returncode = 0
+        self.pool.mark_idle(self.uuid)
+        self.release_boxes()
+        logging.info('>>>>>> WARM UP PASSED <<<<<<')
+
+    def _after(self):
+        pass
@@ -1,9 +1,27 @@
+import gzip
+import io
+import json
+import logging
 import os
+import signal
+import subprocess
+import threading
+import uuid
+from datetime import datetime
 import pytest
 
 from .ansible import AnsiblePlaybook
-from .common import PopenTask, TimeoutException, TaskException
-from .vagrant import VagrantBoxDownload
+from . import common, constants, remote_storage, tasks
+from .box_store import BoxStore
+from .build_cache import BuildCache
+from .common import (
+    FallibleTask, JobScope, OutputTail, PopenException, PopenTask,
+    TimeoutException, TaskException
+)
+from .images import ProvisionedImage, topology_machines
+from .remote_storage import GzipLogFiles
+from .vagrant import VagrantBox, VagrantBoxDownload, VagrantBoxPrefetch
+from .warm_pool import WarmPool
 
 
 def test_timeout():
@@ -17,6 +35,48 @@ def test_timeout():
     assert exc_info.value.task == task
 
 
+class SubtasksTask(FallibleTask):
+    def __init__(self, *subtasks, **kwargs):
+        super(SubtasksTask, self).__init__(**kwargs)
+        self.subtasks = subtasks
+
+    def _run(self):
+        for task in self.subtasks:
+            self.execute_subtask(task)
+
+
+def test_nested_timeouts():
+    threads = threading.active_count()
+
+    # The parent's deadline comes first, the child inherits it
+    child = PopenTask(['sleep', '10'], timeout=60)
+    parent = SubtasksTask(PopenTask(['true']), child, timeout=0.2)
+    with pytest.raises(TimeoutException) as exc_info:
+        parent()
+    assert exc_info.value.task == parent
+    assert child.deadline == parent.deadline
+    assert child.returncode == -signal.SIGKILL
+
+    # The child's own deadline is narrower
+    child = PopenTask(['sleep', '10'], timeout=0.1)
+    parent = SubtasksTask(child, timeout=60)
+    with pytest.raises(TimeoutException) as exc_info:
+        parent()
+    assert exc_info.value.task == child
+    assert child.deadline < parent.deadline
+
+    # The tasks run on the caller's thread, there's one watchdog
+    assert threading.active_count() <= threads + 1
+
+
+def test_terminated_before_start():
+    task = PopenTask(['true'])
+    task.terminate()
+    with pytest.raises(TaskException):
+        task()
+    assert task.returncode is None
+
+
 def test_fallible_task():
     task = PopenTask(['ls', '/tmp/ag34feqfdafasdf'])
     with pytest.raises(TaskException) as exc_info:
@@ -50,6 +110,30 @@ def test_popen():
     assert task.returncode == 2
 
 
+def test_popen_output():
+    sink = io.BytesIO()
+    task = PopenTask('seq 1000; exit 3', shell=True, sink=sink)
+    with pytest.raises(PopenException) as exc_info:
+        task()
+    assert sink.getvalue().decode() == ''.join(
+        '{}\n'.format(i) for i in range(1, 1001))
+    assert exc_info.value.tail.endswith('999\n1000\n')
+    assert 'error code 3' in str(exc_info.value)
+    assert '999' not in str(exc_info.value)
+
+
+def test_output_tail():
+    tail = OutputTail(size=4)
+    assert tail.getvalue() == ''
+    for chunk in [b'ab', b'cd', b'efg', b'h']:
+        tail.write(chunk)
+    assert tail.getvalue() == 'efgh'
+    assert len(tail.chunks) == 2
+
+    tail.write(b'0123456789')
+    assert tail.getvalue() == '6789'
+
+
 def test_vagrant_box_download():
     path = os.path.dirname(os.path.realpath(__file__))
     task = VagrantBoxDownload(
@@ -73,3 +157,421 @@ def test_ansible_playbook():
 
     with pytest.raises(TaskException):
         AnsiblePlaybook()
+
+
+def make_git_repo(path):
+    def git(*args):
+        subprocess.check_call(['git', '-C', str(path)] + list(args),
+                              stdout=subprocess.DEVNULL)
+
+    git('init', '--quiet')
+    path.join('VERSION.m4').write('1')
+    git('add', 'VERSION.m4')
+    git('-c', 'user.name=ci', '-c', 'user.email=ci@example.com',
+        'commit', '--quiet', '-m', 'version')
+    git('update-ref', 'refs/pull/1/head', 'HEAD')
+    git('-c', 'user.name=ci', '-c', 'user.email=ci@example.com',
+        'commit', '--quiet', '--amend', '-m', 'rebased')
+    path.join('VERSION.m4').write('2')
+    git('-c', 'user.name=ci', '-c', 'user.email=ci@example.com',
+        'commit', '--quiet', '-a', '-m', 'version 2')
+    git('update-ref', 'refs/pull/2/head', 'HEAD')
+    git('reset', '--quiet', '--hard', 'HEAD^')
+    return str(path)
+
+
+def test_build_cache_tree_hash(tmpdir):
+    repo = make_git_repo(tmpdir.mkdir('repo'))
+    cache = BuildCache(git_dir=str(tmpdir.join('cache.git')))
+
+    # The amended commit has the same tree as the PR's head
+    tree = cache.tree_hash(repo, 'pull/1/head')
+    assert tree is not None
+    assert cache.tree_hash(repo, git_version='master') == tree
+    assert cache.tree_hash(repo, 'pull/3/head') is None
+    assert cache.git('for-each-ref', 'refs/prci/') == ''
+
+
+def test_build_cache_tree_hash_concurrent(tmpdir):
+    repo = make_git_repo(tmpdir.mkdir('repo'))
+    cache = BuildCache(git_dir=str(tmpdir.join('cache.git')))
+    expected = {
+        ref: cache.tree_hash(repo, ref)
+        for ref in ('pull/1/head', 'pull/2/head')
+    }
+    assert expected['pull/1/head'] != expected['pull/2/head']
+
+    # The jobs running in parallel share the git dir
+    results = {}
+
+    def resolve(ref):
+        results[ref] = cache.tree_hash(repo, ref)
+
+    for _ in range(5):
+        threads = [threading.Thread(target=resolve, args=(ref,))
+                   for ref in expected]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == expected
+
+
+def test_build_cache_lookup(tmpdir, monkeypatch):
+    cache = BuildCache(index_path=str(tmpdir.join('builds.json')))
+    published = {'http://jobs/a': True}
+    monkeypatch.setattr(cache, 'read_cloud', lambda key: None)
+    monkeypatch.setattr(cache, 'write_cloud', lambda key, url: None)
+    monkeypatch.setattr(cache, 'published', lambda url: published[url])
+
+    key = BuildCache.key('tree', 'ci-master-f27', '0.1', digest='x')
+    assert key != BuildCache.key('tree', 'ci-master-f27', '0.2', digest='x')
+    assert cache.lookup(key) is None
+
+    cache.store(key, 'http://jobs/a')
+    assert cache.lookup(key) == 'http://jobs/a'
+
+    # The job directory disappeared from the storage
+    published['http://jobs/a'] = False
+    assert cache.lookup(key) is None
+    assert cache.read_index() == {}
+
+
+def test_warm_pool_claim(tmpdir, monkeypatch):
+    monkeypatch.setattr(constants, 'JOBS_DIR', str(tmpdir))
+    pool = WarmPool(str(tmpdir.join('warm_pool.json')))
+    for slot_uuid, topology in [('a', 'master_1repl'), ('b', 'ipaserver'),
+                                ('c', 'master_1repl')]:
+        tmpdir.mkdir(slot_uuid)
+        pool.add(slot_uuid, 'ci-master-f27', '0.1', topology)
+    pool.mark_idle('b')
+    pool.mark_idle('c')
+
+    # "a" is still being provisioned
+    assert pool.claim('ci-master-f27', '0.1', 'master_1repl') == 'c'
+    assert pool.claim('ci-master-f27', '0.1', 'master_1repl') is None
+    assert pool.claim('ci-master-f28', '0.1', 'ipaserver') is None
+    assert sorted(pool.read()) == ['a', 'b']
+
+
+def test_warm_slot_box_lease(tmpdir, monkeypatch):
+    monkeypatch.setattr(constants, 'JOBS_DIR', str(tmpdir))
+    monkeypatch.setattr(constants, 'BOX_STORE_DIR', str(tmpdir))
+    monkeypatch.setattr(
+        constants, 'WARM_POOL_REGISTRY', str(tmpdir.join('warm_pool.json')))
+    pool = WarmPool(constants.WARM_POOL_REGISTRY)
+    store = BoxStore(str(tmpdir.join('boxes.json')))
+    monkeypatch.setattr(tasks, 'WarmPool', lambda: pool)
+    monkeypatch.setattr(tasks, 'BoxStore', lambda: store)
+    box = VagrantBox('freeipa/ci-master-f27', '0.1')
+    template = {'name': box.name, 'version': box.version}
+
+    job = tasks.RunPytest(template, 'http://build', 'test_suite')
+    job.claim_warm_slot()
+    assert job.warm_slot is None
+    assert job.box_leases == []
+
+    tmpdir.mkdir('a')
+    pool.add('a', box.name, box.version, constants.DEFAULT_TOPOLOGY)
+    pool.mark_idle('a')
+    job.claim_warm_slot()
+    assert job.warm_slot == 'a'
+    # The slot left the registry, the job's lease keeps the box
+    assert store.warm_pool_boxes() == set()
+    assert box.lease(exclusive=True) is None
+    assert store.key(box) in store.read()
+
+    job.release_boxes()
+    assert box.lease(exclusive=True) is not None
+
+
+def test_provisioned_image(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        constants, 'VAGRANT_IMAGE_PATH',
+        str(tmpdir) + '/{name}/{version}/{provider}/box.img')
+    assert topology_machines('master_1repl') == [
+        'controller', 'master', 'replica0']
+
+    image = ProvisionedImage('ci-master-f27', '0.1', 'master_1repl')
+    assert image.key != ProvisionedImage(
+        'ci-master-f27', '0.2', 'master_1repl').key
+    assert image.key != ProvisionedImage(
+        'ci-master-f27', '0.1', 'master_1repl', update_packages=True).key
+    assert not image.exists()
+
+    boxes = image.boxes()
+    assert sorted(boxes) == ['controller', 'master', 'replica0']
+    for box in boxes.values():
+        os.makedirs(os.path.dirname(box.vagrant_path))
+        open(box.vagrant_path, 'w').close()
+    assert image.exists()
+
+    # Old images are provisioned again
+    os.utime(boxes['master'].vagrant_path, (0, 0))
+    assert not image.exists()
+
+
+def test_box_prefetch_provider(tmpdir, monkeypatch):
+    monkeypatch.setattr(constants, 'BOX_STORE_DIR', str(tmpdir))
+    task = VagrantBoxPrefetch('freeipa/ci-master-f27', '0.1', rate='1M')
+    provider = {'name': 'libvirt', 'url': 'https://boxes/f27-0.1.box',
+                'checksum_type': 'sha256', 'checksum': 'abc'}
+    catalog = {
+        'name': 'freeipa/ci-master-f27',
+        'versions': [
+            {'version': '0.0', 'providers': [
+                {'name': 'libvirt', 'url': 'https://boxes/f27-0.0.box'}]},
+            {'version': '0.1', 'providers': [
+                {'name': 'virtualbox', 'url': 'https://boxes/vbox.box'},
+                provider]},
+        ],
+    }
+    assert task.provider(catalog) == provider
+    with pytest.raises(TaskException):
+        task.provider({'versions': []})
+
+    # The lock is shared with the jobs' downloads
+    with task.box.locked():
+        assert os.path.exists(task.box.lock_path)
+
+
+def test_box_store_evict(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        constants, 'VAGRANT_IMAGE_PATH',
+        str(tmpdir) + '/boxes/{name}/{version}/{provider}/box.img')
+    monkeypatch.setattr(constants, 'BOX_STORE_DIR', str(tmpdir))
+    monkeypatch.setattr(
+        constants, 'WARM_POOL_REGISTRY', str(tmpdir.join('warm_pool.json')))
+    monkeypatch.setattr(
+        constants, 'LIBVIRT_IMAGE_PATH',
+        str(tmpdir) + '/{libvirt_name}_{version}.img')
+
+    store = BoxStore(str(tmpdir.join('boxes.json')))
+    boxes = [VagrantBox('freeipa/ci-master-f27', version)
+             for version in ['0.1', '0.2', '0.3', '0.4']]
+    for box in boxes:
+        os.makedirs(os.path.dirname(box.vagrant_path))
+        with open(box.vagrant_path, 'wb') as file_:
+            file_.write(b'x' * 8192)
+    size = BoxStore.size(boxes[0])
+    for box in reversed(boxes):
+        store.touch(box)
+    assert sorted(box.version for box in store.boxes()) == [
+        '0.1', '0.2', '0.3', '0.4']
+
+    removed = []
+
+    def remove(box):
+        removed.append(box.version)
+        os.unlink(box.vagrant_path)
+    monkeypatch.setattr(store, 'remove', remove)
+
+    # No budget, nothing to evict
+    assert store.evict() == 4 * size
+    store.budget = size
+
+    # 0.4 is used the longest ago, but a job uses it, 0.3 is needed
+    lease = boxes[3].lease()
+    assert boxes[3].lease(exclusive=True) is None
+    assert store.evict(keep=[('freeipa/ci-master-f27', '0.3')]) == 2 * size
+    assert removed == ['0.2', '0.1']
+    assert sorted(store.read()) == [
+        'freeipa/ci-master-f27 0.3', 'freeipa/ci-master-f27 0.4']
+
+    lease.close()
+    assert store.evict() == size
+    assert removed == ['0.2', '0.1', '0.4']
+
+
+def test_job_scope(tmpdir, monkeypatch):
+    mount = tmpdir.mkdir('cgroup')
+    mount.join('cgroup.procs').write('')
+    scope = JobScope('abc', mounts=[str(tmpdir.join('none')), str(mount)])
+    assert scope.cgroup == str(mount.join(constants.CGROUP_NAME, 'abc'))
+
+    # The children join the scope before they execute the command
+    process = subprocess.Popen(
+        ['sleep', '60'], preexec_fn=PopenTask.preexec(scope))
+    assert scope.pids() == [process.pid]
+
+    pids = [[process.pid], []]
+    monkeypatch.setattr(scope, 'pids', lambda: pids.pop(0))
+    scope.kill_processes()
+    assert process.wait() == -signal.SIGKILL
+
+    monkeypatch.setattr(
+        common.subprocess, 'check_output',
+        lambda *args, **kwargs: b'abc_master\nabcd_master\nabc_replica0\n')
+    assert scope.domains() == ['abc_master', 'abc_replica0']
+
+    assert JobScope('abc', mounts=[str(tmpdir.join('none'))]).cgroup is None
+
+
+@pytest.mark.parametrize('codec,extension', [('gzip', '.gz'), ('xz', '.xz')])
+def test_gzip_log_files(tmpdir, codec, extension):
+    tmpdir.join('runner.log.gz').write('')
+    tmpdir.join('Vagrantfile').write('')
+    tmpdir.mkdir('.vagrant').join('machine.log').write('')
+    tmpdir.mkdir('rpms').join('freeipa.rpm').write('')
+    logs = tmpdir.mkdir('master').mkdir('logs')
+    for index in range(5):
+        logs.join('{}.log'.format(index)).write('line\n' * 1000 * index)
+    os.utime(str(logs.join('1.log')), (0, 0))
+
+    GzipLogFiles(str(tmpdir), codec=codec, workers=2)()
+
+    assert sorted(os.listdir(str(logs))) == [
+        '{}.log{}'.format(index, extension) for index in range(5)]
+    with remote_storage.COMPRESSION_CODECS[codec][0](
+            str(logs.join('3.log' + extension)), 'rt') as file_:
+        assert file_.read() == 'line\n' * 3000
+    assert os.stat(str(logs.join('1.log' + extension))).st_mtime == 0
+    for path in ['runner.log.gz', 'Vagrantfile', '.vagrant/machine.log',
+                 'rpms/freeipa.rpm']:
+        assert tmpdir.join(path).check()
+
+
+def test_gzip_file_handler(tmpdir):
+    path = str(tmpdir.join('runner.log.gz'))
+    handler = common.GzipFileHandler(path)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler.emit(logging.makeLogRecord({'msg': 'first'}))
+    sink = common.LogFileSink(handler)
+    # A character split between the chunks
+    sink.write('żółw\n'.encode()[:2])
+    sink.write('żółw\n'.encode()[2:])
+    handler.close()
+    with gzip.open(path, 'rt', encoding='utf-8') as file_:
+        assert file_.read() == 'first\nżółw\n'
+
+
+@pytest.fixture()
+def aws(monkeypatch):
+    """
+    Fake AWS services, nothing leaves the test.
+    """
+    moto = pytest.importorskip('moto')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', constants.CLOUD_REGION)
+    if hasattr(moto, 'mock_aws'):
+        with moto.mock_aws():
+            yield
+    else:
+        # moto < 5 mocks every service on its own
+        with moto.mock_s3(), moto.mock_dynamodb():
+            yield
+
+
+def test_s3_uploader(tmpdir, aws):
+    tmpdir.join('index.html').write('<html></html>')
+    tmpdir.mkdir('logs').join('runner.log.gz').write_binary(
+        gzip.compress(b'log'))
+    tmpdir.join('logs', 'big.rpm').write_binary(b'x' * 6*1024*1024)
+
+    client = remote_storage.boto3.client('s3')
+    client.create_bucket(
+        Bucket='bucket', CreateBucketConfiguration={
+            'LocationConstraint': constants.CLOUD_REGION})
+    uploader = remote_storage.S3Uploader(bucket='bucket', workers=4)
+    uploader.config.multipart_threshold = 5*1024*1024
+    uploader.config.multipart_chunksize = 5*1024*1024
+    uploader.upload(str(tmpdir), 'jobs/uuid')
+
+    objects = client.list_objects_v2(Bucket='bucket')['Contents']
+    assert sorted(obj['Key'] for obj in objects) == [
+        'jobs/uuid/index.html', 'jobs/uuid/logs/big.rpm',
+        'jobs/uuid/logs/runner.log.gz']
+    head = client.head_object(
+        Bucket='bucket', Key='jobs/uuid/logs/runner.log.gz')
+    assert head['ContentEncoding'] == 'gzip'
+    assert head['ContentType'] == 'text/plain'
+    head = client.head_object(Bucket='bucket', Key='jobs/uuid/index.html')
+    assert head['ContentType'] == 'text/html'
+    # Uploaded in parts
+    head = client.head_object(
+        Bucket='bucket', Key='jobs/uuid/logs/big.rpm')
+    assert head['ETag'].endswith('-2"')
+    assert head['ContentLength'] == 6*1024*1024
+
+
+def test_jobs_root_index(aws):
+    def read(key):
+        return json.loads(client.get_object(
+            Bucket=constants.CLOUD_BUCKET, Key=key)['Body'].read().decode())
+
+    def shards():
+        return {
+            key: read(key) for key in (
+                obj['Key'] for obj in client.list_objects_v2(
+                    Bucket=constants.CLOUD_BUCKET)['Contents'])
+            if key.endswith('.json')
+        }
+
+    client = remote_storage.boto3.client('s3')
+    client.create_bucket(
+        Bucket=constants.CLOUD_BUCKET, CreateBucketConfiguration={
+            'LocationConstraint': constants.CLOUD_REGION})
+    remote_storage.boto3.resource(
+        'dynamodb', region_name=constants.CLOUD_REGION).create_table(
+            TableName=constants.CLOUD_DB,
+            KeySchema=[{'AttributeName': 'name', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'name', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+
+    def page(key):
+        return client.get_object(
+            Bucket=constants.CLOUD_BUCKET,
+            Key=key)['Body'].read().decode()
+
+    def add_job(job_uuid, pr_number):
+        remote_storage.CreateRootIndex(
+            job_uuid, 'freeipa', pr_number, 'author', 'fedora/build', 0)()
+
+    uuids = [str(uuid.UUID(int=i)) for i in range(5)]
+    for job_uuid, pr_number in zip(uuids, (10, 9, 10, None)):
+        add_job(job_uuid, pr_number)
+
+    month = datetime.now().strftime('%Y-%m')
+    index = shards()
+    assert sorted(index) == sorted(
+        ['jobs/index/month/{}/{}.json'.format(month, job_uuid)
+         for job_uuid in uuids[:4]] +
+        ['jobs/index/pr/10/{}.json'.format(uuids[0]),
+         'jobs/index/pr/10/{}.json'.format(uuids[2]),
+         'jobs/index/pr/9/{}.json'.format(uuids[1]),
+         'jobs/index/month/{}.json'.format(month),
+         'jobs/index/pr/10.json', 'jobs/index/pr/9.json',
+         'jobs/index/shards.json'])
+    assert [item['name'] for item in index['jobs/index/pr/10.json']] == [
+        uuids[0], uuids[2]]
+    assert len(index['jobs/index/month/{}.json'.format(month)]) == 4
+    assert index['jobs/index/shards.json'] == {
+        'month': [month], 'pr': ['10', '9']}
+    assert 'index/pr/9.html' in page('jobs/index.html')
+    assert uuids[1] in page('jobs/index/pr/9.html')
+    assert uuids[0] not in page('jobs/index/pr/9.html')
+
+    # A concurrent render lost a job, the next job of the shard renders it
+    client.put_object(
+        Bucket=constants.CLOUD_BUCKET, Key='jobs/index/pr/10.json',
+        Body=json.dumps(index['jobs/index/pr/10.json'][:1]).encode())
+    add_job(uuids[4], 10)
+    assert all(job_uuid in page('jobs/index/pr/10.html')
+               for job_uuid in (uuids[0], uuids[2], uuids[4]))
+    index = shards()
+
+    client.delete_object(
+        Bucket=constants.CLOUD_BUCKET, Key='jobs/index/pr/9.json')
+    client.delete_object(
+        Bucket=constants.CLOUD_BUCKET,
+        Key='jobs/index/pr/9/{}.json'.format(uuids[1]))
+    assert remote_storage.rebuild_jobs_root_index() == 3
+    rebuilt = shards()
+    for key, items in index.items():
+        # The items cached for the shards' pages
+        if isinstance(items, list):
+            rebuilt[key].sort(key=lambda item: item['name'])
+            items.sort(key=lambda item: item['name'])
+    assert rebuilt == index
@@ -1,8 +1,14 @@
+import contextlib
+import fcntl
+import json
 import logging
 import os
+import shutil
 import signal
+import urllib.error
+import urllib.request
 
-from . import constants
+from . import common, constants
 from .common import (
     PopenTask, PopenException, FallibleTask, TaskException,
     kill_vagrant_processes, kill_vagrant_vms
@@ -22,6 +28,7 @@ def with_vagrant(func):
             if not self.no_destroy:
                 self.execute_subtask(
                     VagrantCleanup(raise_on_err=False))
+            self.release_boxes()
 
     return wrapper
 
@@ -30,13 +37,34 @@ def __setup_provision(task):
     """
     This tries to execute the provision twice due to
     problems described in issue #20
+
+    VMs of a claimed warm pool slot are booted and partially provisioned
+    already, they're replaced by new ones if the rest fails.
     """
-    task.execute_subtask(
-        VagrantBoxDownload(
-            box_name=task.template_name,
-            box_version=task.template_version,
-            link_image=task.link_image,
-            timeout=None))
+    if task.warm_slot is not None:
+        try:
+            task.execute_subtask(VagrantProvision(timeout=None))
+            return
+        except TaskException as exc:
+            logging.debug(exc, exc_info=True)
+            logging.info("Failed to provision warm VMs. Starting new ones")
+            task.execute_subtask(VagrantCleanup(raise_on_err=False))
+            task.release_warm_slot()
+
+    if task.provisioned_image is not None and not task.image_ready:
+        try:
+            task.create_provisioned_image()
+            return
+        except TaskException as exc:
+            logging.debug(exc, exc_info=True)
+            logging.info("Failed to create provisioned image. Trying it "
+                         "without")
+            task.execute_subtask(VagrantCleanup(raise_on_err=False))
+            task.release_provisioned_image()
+
+    for box in task.image_boxes().values():
+        task.download_box(box.name, box.version)
+    task.download_box(task.template_name, task.template_version)
     try:
         task.execute_subtask(VagrantUp(timeout=None))
         task.execute_subtask(VagrantProvision(timeout=None))
@@ -67,22 +95,35 @@ class VagrantProvision(VagrantTask):
             PopenTask(['vagrant', 'provision'], timeout=None))
 
 
+class VagrantHalt(VagrantTask):
+    def _run(self):
+        self.execute_subtask(
+            PopenTask(['vagrant', 'halt'], timeout=None))
+
+
 class VagrantCleanup(VagrantTask):
     def _run(self):
         try:
             self.execute_subtask(
                 PopenTask(['vagrant', 'destroy']))
         except PopenException:
-            # First kill all stuck Vagrant processes
-            kill_vagrant_processes()
+            # First kill all stuck Vagrant processes of the job
+            scope = common.JOB_SCOPE
+            if scope is not None:
+                scope.kill_processes()
+            else:
+                kill_vagrant_processes()
 
             # Then restart libvirt daemon
             self.execute_subtask(
                 PopenTask(['systemctl', 'restart', 'libvirtd'],
                           raise_on_err=False))
 
-            # Then remove all VMs related to tests
-            kill_vagrant_vms()
+            # Then remove all VMs related to the job
+            if scope is not None:
+                scope.kill()
+            else:
+                kill_vagrant_vms()
 
             # End finally remove all the images instances
             self.execute_subtask(
@@ -99,18 +140,20 @@ class VagrantBoxDownload(VagrantTask):
         self.box = VagrantBox(box_name, box_version)
         self.link_image = True
 
+        self.lease = None
+
     def _run(self):
-        if not self.box.exists():
-            try:
-                self.execute_subtask(
-                    PopenTask([
-                        'vagrant', 'box', 'add', self.box.name,
-                        '--box-version', self.box.version,
-                        '--provider', self.box.provider],
-                        timeout=None))
-            except TaskException as exc:
-                logging.error('Box download failed')
-                raise exc
+        # Waits while the box is being evicted, see BoxStore
+        self.lease = self.box.lease()
+        try:
+            if not self.box.exists():
+                # Wait for the runner's prefetch of the box, if there's any
+                with self.box.locked():
+                    self.download()
+        except Exception:
+            self.lease.close()
+            self.lease = None
+            raise
 
         # link box to libvirt
         if self.link_image and not self.box.libvirt_exists():
@@ -127,6 +170,116 @@ class VagrantBoxDownload(VagrantTask):
                 logging.warning('Failed to create libvirt link to image')
                 raise exc
 
+    def download(self):
+        if self.box.exists():
+            return
+
+        try:
+            self.execute_subtask(
+                PopenTask([
+                    'vagrant', 'box', 'add', self.box.name,
+                    '--box-version', self.box.version,
+                    '--provider', self.box.provider],
+                    timeout=None))
+        except TaskException as exc:
+            logging.error('Box download failed')
+            raise exc
+
+
+class VagrantBoxPrefetch(FallibleTask):
+    """
+    Download a box with limited bandwidth, the runner runs it in the
+    background for the boxes the open PRs need.
+
+    vagrant box add can't limit its download rate, so the box file is
+    downloaded by curl and added from a catalog of the local file.
+    """
+    def __init__(self, box_name, box_version, rate=None, **kwargs):
+        kwargs.setdefault('timeout', None)
+        super(VagrantBoxPrefetch, self).__init__(**kwargs)
+        self.box = VagrantBox(box_name, box_version)
+        self.rate = rate
+
+    @property
+    def work_dir(self):
+        return os.path.join(
+            constants.BOX_STORE_DIR,
+            '{name}_{version}'.format(
+                name=self.box.escaped_name, version=self.box.version))
+
+    def provider(self, catalog):
+        """
+        Find the box's provider entry (URL and checksum) in the catalog.
+        """
+        for version in catalog.get('versions', []):
+            if version.get('version') != self.box.version:
+                continue
+            for provider in version.get('providers', []):
+                if provider.get('name') == self.box.provider:
+                    return provider
+
+        raise TaskException(self, 'box not found in the catalog')
+
+    def fetch_catalog(self):
+        request = urllib.request.Request(
+            '{url}/{name}'.format(
+                url=constants.VAGRANT_CLOUD_URL, name=self.box.name),
+            headers={'Accept': 'application/json'})
+        try:
+            with urllib.request.urlopen(
+                    request, timeout=constants.BOX_CATALOG_TIMEOUT) as resp:
+                return json.loads(resp.read().decode('utf-8'))
+        except (urllib.error.URLError, OSError, ValueError) as exc:
+            logging.debug(exc, exc_info=True)
+            raise TaskException(self, 'failed to fetch the box catalog')
+
+    def download(self):
+        provider = dict(self.provider(self.fetch_catalog()))
+        box_file = os.path.join(self.work_dir, 'box')
+        cmd = [
+            'curl', '--silent', '--show-error', '--fail', '--location',
+            '--output', box_file]
+        if self.rate:
+            cmd.extend(['--limit-rate', str(self.rate)])
+        self.execute_subtask(PopenTask(cmd + [provider['url']], timeout=None))
+
+        provider['url'] = 'file://' + box_file
+        catalog_file = os.path.join(self.work_dir, 'metadata.json')
+        with open(catalog_file, 'w') as file_:
+            json.dump({
+                'name': self.box.name,
+                'versions': [{
+                    'version': self.box.version,
+                    'providers': [provider],
+                }],
+            }, file_)
+        self.execute_subtask(
+            PopenTask([
+                'vagrant', 'box', 'add', catalog_file,
+                '--box-version', self.box.version,
+                '--provider', self.box.provider],
+                timeout=None))
+
+    def _run(self):
+        with self.box.locked():
+            if self.box.exists():
+                return
+
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            os.makedirs(self.work_dir)
+            try:
+                self.download()
+            finally:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        logging.info('Prefetched box {name} {version}'.format(
+            name=self.box.name, version=self.box.version))
+
+    def __str__(self):
+        return '{task} {name} {version}'.format(
+            task=type(self).__name__, name=self.box.name,
+            version=self.box.version)
+
 
 class VagrantBox(object):
     def __init__(self, name, version, provider="libvirt"):
@@ -157,6 +310,50 @@ class VagrantBox(object):
             libvirt_name=self.libvirt_name,
             version=self.version)
 
+    @property
+    def lock_path(self):
+        return os.path.join(
+            constants.BOX_STORE_DIR,
+            '{name}_{version}.lock'.format(
+                name=self.escaped_name, version=self.version))
+
+    @property
+    def lease_path(self):
+        return os.path.join(
+            constants.BOX_STORE_DIR,
+            '{name}_{version}.lease'.format(
+                name=self.escaped_name, version=self.version))
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Serialize the downloads of the box by the jobs and the prefetcher.
+        """
+        os.makedirs(constants.BOX_STORE_DIR, exist_ok=True)
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def lease(self, exclusive=False):
+        """
+        Lock the box against eviction, jobs share the lock while their VMs
+        use the box and the eviction takes it exclusively.
+
+        Returns the locked file, closing it releases the lease. An exclusive
+        lease isn't waited for, None is returned if the box is in use.
+        """
+        os.makedirs(constants.BOX_STORE_DIR, exist_ok=True)
+        lease_file = open(self.lease_path, 'w')
+        try:
+            if exclusive:
+                fcntl.flock(lease_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                fcntl.flock(lease_file, fcntl.LOCK_SH)
+        except BlockingIOError:
+            lease_file.close()
+            return None
+        return lease_file
+
     def exists(self):
         return os.path.exists(self.vagrant_path)
 
@@ -0,0 +1,99 @@
+"""
+Registry of the warm pool slots.
+
+A slot is a job directory in JOBS_DIR whose VMs were booted and provisioned
+with everything that doesn't depend on the tested build (the "base" stage
+of the provision playbook). The runner keeps the registry filled, a job
+claims an idle slot of its template and topology, takes over its directory
+(and so its UUID and VMs) and only runs the "job" stage of the provisioning.
+
+The registry is a JSON file shared by the runner and the job processes,
+every change is done under an exclusive lock.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+from time import time
+
+from . import constants
+
+PROVISIONING = 'provisioning'
+IDLE = 'idle'
+
+
+class WarmPool(object):
+    def __init__(self, path=constants.WARM_POOL_REGISTRY):
+        self.path = path
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Yield the slots by UUID, changes are saved on exit.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            slots = self.read()
+            yield slots
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as file_:
+                json.dump(slots, file_)
+            os.rename(tmp_path, self.path)
+
+    def read(self):
+        try:
+            with open(self.path) as file_:
+                return json.load(file_)
+        except (OSError, ValueError):
+            return {}
+
+    def add(self, uuid, template_name, template_version, topology,
+            resources=None):
+        """
+        Register a slot which is being provisioned.
+
+        resources: what the slot's VMs take from the host, for the runner
+        """
+        with self.locked() as slots:
+            slots[uuid] = {
+                'template': [template_name, template_version],
+                'topology': topology,
+                'resources': resources or {},
+                'state': PROVISIONING,
+                'since': time(),
+            }
+
+    def mark_idle(self, uuid):
+        with self.locked() as slots:
+            if uuid in slots:
+                slots[uuid]['state'] = IDLE
+                slots[uuid]['since'] = time()
+
+    def remove(self, uuid):
+        with self.locked() as slots:
+            slots.pop(uuid, None)
+
+    def claim(self, template_name, template_version, topology):
+        """
+        Take the longest idle slot matching the job out of the registry.
+
+        Returns the slot's UUID or None.
+        """
+        with self.locked() as slots:
+            matching = sorted(
+                (slot['since'], uuid) for uuid, slot in slots.items()
+                if slot['state'] == IDLE
+                and slot['template'] == [template_name, template_version]
+                and slot['topology'] == topology
+                and os.path.isdir(os.path.join(constants.JOBS_DIR, uuid))
+            )
+            if not matching:
+                return None
+
+            _, uuid = matching[0]
+            del slots[uuid]
+
+        logging.info('Claimed warm pool slot {uuid}'.format(uuid=uuid))
+        return uuid